@@ -0,0 +1,364 @@
+import os
+import json
+import time
+import sqlite3
+import logging
+import sys
+import threading
+from collections import OrderedDict, deque
+from datetime import datetime
+
+# ⚙️ Backend del estado de conversaciones: "memoria" (un proceso) o "sqlite" (compartido)
+ESTADO_BACKEND = os.getenv("ESTADO_BACKEND", "memoria").lower()
+ESTADO_SQLITE_PATH = os.getenv("ESTADO_SQLITE_PATH", os.path.join(".cache", "estado_conversaciones.sqlite3"))
+# Usuarios sin actividad por más de este tiempo se eliminan del almacén
+ESTADO_TTL_HORAS = float(os.getenv("ESTADO_TTL_HORAS", 72))
+PURGAR_CADA_S = 300
+# Presupuesto de memoria para todos los historiales del proceso (backend memoria)
+ESTADO_MAX_BYTES = int(os.getenv("ESTADO_MAX_MB", 64)) * 1024 * 1024
+HISTORIAL_MAX_MENSAJES = 40
+
+
+class Mensaje:
+    """Mensaje compacto del historial; el rol se interna (solo hay unos cuantos)."""
+    __slots__ = ("role", "content")
+
+    def __init__(self, role, content):
+        self.role = sys.intern(role)
+        self.content = content
+
+    def como_dict(self):
+        return {"role": self.role, "content": self.content}
+
+
+class _EstadoUsuario:
+    __slots__ = ("historial", "ultimo_mensaje", "buffer", "hora_buffer", "tocado", "bytes")
+
+    def __init__(self):
+        self.historial = None
+        self.ultimo_mensaje = None
+        self.buffer = []
+        self.hora_buffer = None
+        self.tocado = time.monotonic()
+        self.bytes = 0
+
+
+def _tam_mensaje(mensaje):
+    return sys.getsizeof(mensaje) + sys.getsizeof(mensaje.content)
+
+
+class AlmacenMemoria:
+    """
+    Estado por usuario en memoria del proceso con presupuesto global de bytes.
+
+    Cada usuario tiene un ring buffer (deque) de a lo sumo max_mensajes
+    mensajes compactos. Cuando el total pasa de max_bytes se desaloja al
+    usuario usado hace más tiempo (LRU); si vuelve a escribir, su historial
+    se reconstruye bajo demanda con cargar_historial(conversation_id).
+    """
+
+    def __init__(self, ttl_horas=ESTADO_TTL_HORAS, max_bytes=ESTADO_MAX_BYTES,
+                 max_mensajes=HISTORIAL_MAX_MENSAJES, cargar_historial=None):
+        self.ttl_s = ttl_horas * 3600
+        self.max_bytes = max_bytes
+        self.max_mensajes = max_mensajes
+        self.cargar_historial = cargar_historial
+        self._usuarios = OrderedDict()
+        self._bytes = 0
+        self._desalojados = 0
+        self._rehidratados = 0
+        self._lock = threading.Lock()
+        self._ultima_purga = time.monotonic()
+
+    def _usuario(self, user_id, crear=True):
+        # Llamar con self._lock tomado
+        usuario = self._usuarios.get(user_id)
+        if usuario is None:
+            if not crear:
+                return None
+            usuario = self._usuarios[user_id] = _EstadoUsuario()
+        else:
+            self._usuarios.move_to_end(user_id)
+        usuario.tocado = time.monotonic()
+        return usuario
+
+    def _recalcular(self, usuario):
+        # Llamar con self._lock tomado
+        nuevo = sum(_tam_mensaje(m) for m in usuario.historial or ())
+        nuevo += sum(sys.getsizeof(f) for f in usuario.buffer)
+        self._bytes += nuevo - usuario.bytes
+        usuario.bytes = nuevo
+
+        while self._bytes > self.max_bytes and len(self._usuarios) > 1:
+            _, desalojado = self._usuarios.popitem(last=False)
+            self._bytes -= desalojado.bytes
+            self._desalojados += 1
+
+    def _despues_de_escribir(self):
+        if time.monotonic() - self._ultima_purga > PURGAR_CADA_S:
+            self.purgar_expirados()
+
+    def obtener_historial(self, user_id, conversation_id=None):
+        with self._lock:
+            usuario = self._usuario(user_id, crear=False)
+            if usuario is not None and usuario.historial is not None:
+                return [m.como_dict() for m in usuario.historial]
+
+        if not (self.cargar_historial and conversation_id):
+            return None
+        # Usuario desalojado o proceso reiniciado: se reconstruye desde la base
+        mensajes = self.cargar_historial(conversation_id)
+        if not mensajes:
+            return None
+        with self._lock:
+            usuario = self._usuario(user_id)
+            if usuario.historial is None:
+                usuario.historial = deque((Mensaje(m["role"], m["content"]) for m in mensajes), maxlen=self.max_mensajes)
+                self._rehidratados += 1
+                self._recalcular(usuario)
+            return [m.como_dict() for m in usuario.historial]
+
+    def agregar_al_historial(self, user_id, mensajes, max_mensajes=None):
+        with self._lock:
+            usuario = self._usuario(user_id)
+            if usuario.historial is None:
+                usuario.historial = deque(maxlen=self.max_mensajes)
+            usuario.historial.extend(Mensaje(m["role"], m["content"]) for m in mensajes)
+            while max_mensajes and len(usuario.historial) > max_mensajes:
+                usuario.historial.popleft()
+            historial = [m.como_dict() for m in usuario.historial]
+            self._recalcular(usuario)
+        self._despues_de_escribir()
+        return historial
+
+    def recortar_historial(self, user_id, max_mensajes):
+        with self._lock:
+            usuario = self._usuario(user_id)
+            if usuario.historial is None:
+                usuario.historial = deque(maxlen=self.max_mensajes)
+            while len(usuario.historial) > max_mensajes:
+                usuario.historial.popleft()
+            self._recalcular(usuario)
+            return [m.como_dict() for m in usuario.historial]
+
+    def obtener_ultimo_mensaje(self, user_id):
+        with self._lock:
+            usuario = self._usuario(user_id, crear=False)
+            return usuario.ultimo_mensaje if usuario else None
+
+    def registrar_ultimo_mensaje(self, user_id, cuando):
+        with self._lock:
+            self._usuario(user_id).ultimo_mensaje = cuando
+        self._despues_de_escribir()
+
+    def agregar_a_buffer(self, user_id, fragmento, cuando, ventana_s):
+        with self._lock:
+            usuario = self._usuario(user_id)
+            # Si pasó mucho tiempo desde el último → reiniciamos buffer
+            if not usuario.hora_buffer or (cuando - usuario.hora_buffer).total_seconds() > ventana_s:
+                usuario.buffer = []
+            usuario.buffer.append(fragmento)
+            usuario.hora_buffer = cuando
+            fragmentos = list(usuario.buffer)
+            self._recalcular(usuario)
+        self._despues_de_escribir()
+        return fragmentos
+
+    def vaciar_buffer(self, user_id):
+        with self._lock:
+            usuario = self._usuario(user_id, crear=False)
+            if usuario is not None:
+                usuario.buffer = []
+                self._recalcular(usuario)
+
+    def purgar_expirados(self):
+        self._ultima_purga = time.monotonic()
+        limite = time.monotonic() - self.ttl_s
+        expirados = 0
+        with self._lock:
+            # El OrderedDict está en orden LRU: los inactivos quedan al principio
+            while self._usuarios:
+                user_id, usuario = next(iter(self._usuarios.items()))
+                if usuario.tocado >= limite:
+                    break
+                del self._usuarios[user_id]
+                self._bytes -= usuario.bytes
+                expirados += 1
+        if expirados:
+            logging.info(f"🧹 {expirados} usuarios inactivos eliminados del estado en memoria")
+        return expirados
+
+    def metricas(self):
+        with self._lock:
+            return {
+                "usuarios": len(self._usuarios),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "desalojados": self._desalojados,
+                "rehidratados": self._rehidratados
+            }
+
+
+class AlmacenSQLite:
+    """
+    Estado por usuario en un archivo SQLite en modo WAL, compartido por todos
+    los workers de gunicorn (o procesos) de la misma máquina.
+    """
+
+    def __init__(self, ruta=ESTADO_SQLITE_PATH, ttl_horas=ESTADO_TTL_HORAS, cargar_historial=None):
+        self.ruta = ruta
+        self.ttl_s = ttl_horas * 3600
+        self.cargar_historial = cargar_historial
+        self._local = threading.local()
+        self._ultima_purga = time.monotonic()
+        self._lock = threading.Lock()
+        # El archivo y la tabla se crean con la primera conexión, no al construir el almacén
+        self._esquema_listo = False
+
+    def _conexion(self):
+        conexion = getattr(self._local, "conexion", None)
+        if conexion is None:
+            carpeta = os.path.dirname(self.ruta)
+            if carpeta:
+                os.makedirs(carpeta, exist_ok=True)
+            conexion = sqlite3.connect(self.ruta, timeout=10, isolation_level=None)
+            conexion.execute("PRAGMA journal_mode=WAL")
+            conexion.execute("PRAGMA synchronous=NORMAL")
+            self._local.conexion = conexion
+            with self._lock:
+                if not self._esquema_listo:
+                    conexion.executescript("""
+                        CREATE TABLE IF NOT EXISTS estado_conversaciones (
+                            user_id TEXT PRIMARY KEY,
+                            historial TEXT,
+                            ultimo_mensaje TEXT,
+                            buffer TEXT NOT NULL DEFAULT '[]',
+                            hora_buffer TEXT,
+                            tocado REAL NOT NULL
+                        );
+                        CREATE INDEX IF NOT EXISTS idx_estado_tocado ON estado_conversaciones (tocado);
+                    """)
+                    self._esquema_listo = True
+        return conexion
+
+    def _transaccion(self, funcion):
+        conexion = self._conexion()
+        conexion.execute("BEGIN IMMEDIATE")
+        try:
+            resultado = funcion(conexion)
+            conexion.execute("COMMIT")
+        except Exception:
+            conexion.execute("ROLLBACK")
+            raise
+        if time.monotonic() - self._ultima_purga > PURGAR_CADA_S:
+            self.purgar_expirados()
+        return resultado
+
+    @staticmethod
+    def _fila(conexion, user_id):
+        fila = conexion.execute(
+            "SELECT historial, ultimo_mensaje, buffer, hora_buffer FROM estado_conversaciones WHERE user_id = ?",
+            (user_id,)
+        ).fetchone()
+        if fila is None:
+            conexion.execute(
+                "INSERT INTO estado_conversaciones (user_id, tocado) VALUES (?, ?)",
+                (user_id, time.time())
+            )
+            return None, None, "[]", None
+        return fila
+
+    def obtener_historial(self, user_id, conversation_id=None):
+        fila = self._conexion().execute(
+            "SELECT historial FROM estado_conversaciones WHERE user_id = ?", (user_id,)
+        ).fetchone()
+        if fila and fila[0] is not None:
+            return json.loads(fila[0])
+
+        if not (self.cargar_historial and conversation_id):
+            return None
+        # Usuario purgado: se reconstruye desde la base
+        mensajes = self.cargar_historial(conversation_id)
+        return self.agregar_al_historial(user_id, mensajes) if mensajes else None
+
+    def agregar_al_historial(self, user_id, mensajes, max_mensajes=HISTORIAL_MAX_MENSAJES):
+        def operacion(conexion):
+            historial_json = self._fila(conexion, user_id)[0]
+            historial = (json.loads(historial_json) if historial_json else []) + list(mensajes)
+            historial = historial[-max_mensajes:]
+            conexion.execute(
+                "UPDATE estado_conversaciones SET historial = ?, tocado = ? WHERE user_id = ?",
+                (json.dumps(historial, ensure_ascii=False), time.time(), user_id)
+            )
+            return historial
+        return self._transaccion(operacion)
+
+    def recortar_historial(self, user_id, max_mensajes):
+        def operacion(conexion):
+            historial_json = self._fila(conexion, user_id)[0]
+            historial = (json.loads(historial_json) if historial_json else [])[-max_mensajes:]
+            conexion.execute(
+                "UPDATE estado_conversaciones SET historial = ? WHERE user_id = ?",
+                (json.dumps(historial, ensure_ascii=False), user_id)
+            )
+            return historial
+        return self._transaccion(operacion)
+
+    def obtener_ultimo_mensaje(self, user_id):
+        fila = self._conexion().execute(
+            "SELECT ultimo_mensaje FROM estado_conversaciones WHERE user_id = ?", (user_id,)
+        ).fetchone()
+        return datetime.fromisoformat(fila[0]) if fila and fila[0] else None
+
+    def registrar_ultimo_mensaje(self, user_id, cuando):
+        def operacion(conexion):
+            self._fila(conexion, user_id)
+            conexion.execute(
+                "UPDATE estado_conversaciones SET ultimo_mensaje = ?, tocado = ? WHERE user_id = ?",
+                (cuando.isoformat(), time.time(), user_id)
+            )
+        self._transaccion(operacion)
+
+    def agregar_a_buffer(self, user_id, fragmento, cuando, ventana_s):
+        def operacion(conexion):
+            _, _, buffer_json, hora_buffer = self._fila(conexion, user_id)
+            ultimo = datetime.fromisoformat(hora_buffer) if hora_buffer else None
+            fragmentos = json.loads(buffer_json or "[]")
+            # Si pasó mucho tiempo desde el último → reiniciamos buffer
+            if not ultimo or (cuando - ultimo).total_seconds() > ventana_s:
+                fragmentos = []
+            fragmentos.append(fragmento)
+            conexion.execute(
+                "UPDATE estado_conversaciones SET buffer = ?, hora_buffer = ?, tocado = ? WHERE user_id = ?",
+                (json.dumps(fragmentos, ensure_ascii=False), cuando.isoformat(), time.time(), user_id)
+            )
+            return fragmentos
+        return self._transaccion(operacion)
+
+    def vaciar_buffer(self, user_id):
+        self._conexion().execute(
+            "UPDATE estado_conversaciones SET buffer = '[]' WHERE user_id = ?", (user_id,)
+        )
+
+    def purgar_expirados(self):
+        self._ultima_purga = time.monotonic()
+        cursor = self._conexion().execute(
+            "DELETE FROM estado_conversaciones WHERE tocado < ?", (time.time() - self.ttl_s,)
+        )
+        if cursor.rowcount:
+            logging.info(f"🧹 {cursor.rowcount} usuarios inactivos eliminados del estado compartido")
+        return cursor.rowcount
+
+    def metricas(self):
+        usuarios = self._conexion().execute("SELECT COUNT(*) FROM estado_conversaciones").fetchone()[0]
+        return {"usuarios": usuarios, "ruta": self.ruta}
+
+
+# ✅ Crea el almacén configurado por ESTADO_BACKEND
+def crear_almacen(cargar_historial=None):
+    if ESTADO_BACKEND == "sqlite":
+        logging.info(f"🗄️ Estado de conversaciones compartido en SQLite: {ESTADO_SQLITE_PATH}")
+        return AlmacenSQLite(cargar_historial=cargar_historial)
+    if ESTADO_BACKEND != "memoria":
+        logging.warning(f"⚠️ ESTADO_BACKEND desconocido '{ESTADO_BACKEND}', se usa memoria")
+    return AlmacenMemoria(cargar_historial=cargar_historial)
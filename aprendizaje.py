@@ -1,16 +1,5 @@
-import os
 import logging
-from dotenv import load_dotenv
-from supabase import create_client
-
-# ✅ Cargar variables de entorno
-load_dotenv()
-
-# ✅ Inicializar Supabase
-supabase = create_client(
-    os.getenv("SUPABASE_URL"),
-    os.getenv("SUPABASE_SERVICE_ROLE_KEY")
-)
+from servicios import supabase
 
 # ✅ Función para guardar frases de conversión
 def guardar_frase_conversion(user_id, mensaje, tipo):
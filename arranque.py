@@ -0,0 +1,85 @@
+import os
+import time
+import logging
+import threading
+import importlib
+from dotenv import load_dotenv
+
+# ✅ Cargar variables de entorno
+load_dotenv()
+
+# 🔥 Precargar encoder, configuración e índices antes de declararse listo
+CALENTAR_AL_ARRANCAR = os.getenv("CALENTAR_AL_ARRANCAR", "true").lower() in ("1", "true", "si", "sí")
+
+_lock = threading.Lock()
+_estado = {"listo": False, "calentando": False, "segundos": None, "pasos": {}, "errores": {}}
+
+
+class _ModuloPerezoso:
+    """
+    Importa el módulo la primera vez que se usa uno de sus atributos
+    (`np.float32`), así importar un helper no carga numpy ni requests.
+    """
+
+    def __init__(self, nombre):
+        self._nombre = nombre
+
+    def __getattr__(self, atributo):
+        valor = getattr(importlib.import_module(self._nombre), atributo)
+        # La próxima vez es un atributo normal y no pasa por aquí
+        setattr(self, atributo, valor)
+        return valor
+
+    def __repr__(self):
+        return f"<módulo perezoso {self._nombre}>"
+
+
+def importar_perezoso(nombre):
+    return _ModuloPerezoso(nombre)
+
+
+# ✅ Corre cada paso (nombre, función) en orden; si uno falla el bot arranca igual
+def calentar(pasos):
+    with _lock:
+        if _estado["calentando"]:
+            return
+        _estado["calentando"] = True
+
+    inicio = time.perf_counter()
+    for nombre, funcion in pasos:
+        inicio_paso = time.perf_counter()
+        try:
+            funcion()
+        except Exception as e:
+            _estado["errores"][nombre] = str(e)
+            logging.warning(f"⚠️ Calentamiento '{nombre}' falló, se cargará al primer uso: {e}")
+        _estado["pasos"][nombre] = round(time.perf_counter() - inicio_paso, 3)
+
+    with _lock:
+        _estado["segundos"] = round(time.perf_counter() - inicio, 3)
+        _estado["listo"] = True
+        _estado["calentando"] = False
+    logging.info(f"🔥 Calentamiento terminado en {_estado['segundos']:.2f}s: {_estado['pasos']}")
+
+
+def calentar_en_segundo_plano(pasos):
+    if not CALENTAR_AL_ARRANCAR:
+        marcar_listo()
+        return None
+    hilo = threading.Thread(target=calentar, args=(pasos,), name="calentamiento", daemon=True)
+    hilo.start()
+    return hilo
+
+
+def marcar_listo():
+    with _lock:
+        _estado["listo"] = True
+
+
+def esta_listo():
+    return _estado["listo"]
+
+
+def estado_arranque():
+    with _lock:
+        return {**_estado, "pasos": dict(_estado["pasos"]), "errores": dict(_estado["errores"])}
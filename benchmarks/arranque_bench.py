@@ -0,0 +1,149 @@
+"""
+Arranque en frío del bot: cuánto tarda `import bot`, qué deja cargado o
+corriendo el import, cuánto tarda el calentamiento y cuánto el primer
+mensaje con y sin calentar.
+
+Cada medición corre en un intérprete nuevo con cachés en disco vacías
+(índices, embeddings, trabajos), contra los fakes locales (benchmarks/fakes.py).
+Uso: python benchmarks/arranque_bench.py --repeticiones 5
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+DIRECTORIO = os.path.dirname(os.path.abspath(__file__))
+RAIZ = os.path.dirname(DIRECTORIO)
+sys.path.insert(0, RAIZ)
+sys.path.insert(0, DIRECTORIO)
+
+MODULOS_PESADOS = ("numpy", "tiktoken", "openai", "supabase", "httpx", "requests", "twilio")
+
+EJEMPLOS_VENTAS = [
+    "quiero comprar",
+    "cuánto cuesta",
+    "me interesa contratar",
+    "precio del servicio",
+    "quiero una cotización",
+]
+
+
+def proceso_hijo(modo):
+    """Corre dentro del intérprete nuevo e imprime las mediciones en JSON."""
+    import threading
+    import logging
+    logging.basicConfig(level=logging.CRITICAL)
+    resultado = {}
+
+    inicio = time.perf_counter()
+    import bot
+    resultado["import_s"] = time.perf_counter() - inicio
+    resultado["hilos_tras_import"] = sorted(h.name for h in threading.enumerate() if h is not threading.main_thread())
+    resultado["pesados_tras_import"] = [m for m in MODULOS_PESADOS if m in sys.modules]
+
+    inicio = time.perf_counter()
+    app = bot.crear_app()
+    resultado["crear_app_s"] = time.perf_counter() - inicio
+
+    cliente = app.test_client()
+    resultado["health_antes"] = cliente.get("/health").status_code
+    if modo == "caliente":
+        from arranque import calentar, estado_arranque
+        inicio = time.perf_counter()
+        calentar(bot.pasos_calentamiento())
+        resultado["calentar_s"] = time.perf_counter() - inicio
+        resultado["pasos"] = estado_arranque()["pasos"]
+        resultado["errores"] = estado_arranque()["errores"]
+        resultado["health_despues"] = cliente.get("/health").status_code
+
+    datos = {"From": "whatsapp:+5215500000001", "Body": "Hola, ¿cuánto cuesta el servicio?",
+             "MessageSid": "SM0000000000000001", "NumMedia": "0"}
+    inicio = time.perf_counter()
+    cliente.post("/whatsapp", data=datos)
+    bot.mensajeria.esperar_pendientes()
+    resultado["primer_mensaje_s"] = time.perf_counter() - inicio
+    print(json.dumps(resultado))
+
+
+def medir(modo, entorno):
+    cache = tempfile.mkdtemp(prefix="arranque_bench_")
+    entorno = {
+        **entorno,
+        "PYTHONPATH": RAIZ,
+        "COALESCER_MENSAJES": "false",
+        "WEBHOOK_ASINCRONO": "false",
+        "TRABAJOS_SQLITE_PATH": os.path.join(cache, "trabajos.sqlite3"),
+        "EMBEDDINGS_SQLITE_PATH": os.path.join(cache, "embeddings.sqlite3"),
+        "ESTADO_SQLITE_PATH": os.path.join(cache, "estado.sqlite3"),
+        "INDICE_INTENCIONES_DIR": os.path.join(cache, "intenciones"),
+        "INDICE_FRAGMENTOS_DIR": os.path.join(cache, "fragmentos"),
+    }
+    salida = subprocess.run([sys.executable, os.path.abspath(__file__), "--hijo", modo],
+                            cwd=cache, env=entorno, capture_output=True, text=True, timeout=300)
+    if salida.returncode != 0:
+        raise RuntimeError(f"El proceso hijo falló:\n{salida.stderr[-2000:]}")
+    return json.loads(salida.stdout.strip().splitlines()[-1])
+
+
+def mediana(resultados, clave):
+    valores = [r[clave] for r in resultados if clave in r]
+    return statistics.median(valores) * 1000 if valores else float("nan")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Arranque en frío del bot")
+    parser.add_argument("--repeticiones", type=int, default=5)
+    parser.add_argument("--latencia-chat-ms", type=float, default=100)
+    parser.add_argument("--latencia-embeddings-ms", type=float, default=60)
+    parser.add_argument("--latencia-postgrest-ms", type=float, default=10)
+    parser.add_argument("--hijo", choices=["frio", "caliente"], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.hijo:
+        proceso_hijo(args.hijo)
+        return
+
+    from fakes import levantar_fakes
+    from carga_webhook import CONFIGURACION_BOT
+
+    fakes = levantar_fakes(args.latencia_chat_ms, args.latencia_embeddings_ms, args.latencia_postgrest_ms)
+    fakes.postgrest.sembrar("bot_configuracion", [CONFIGURACION_BOT])
+    fakes.postgrest.sembrar("ejemplos_intencion", [
+        {"tipo": "ventas", "negocio": "generico", "ejemplo": ejemplo} for ejemplo in EJEMPLOS_VENTAS
+    ])
+    entorno = {**os.environ, **fakes.entorno()}
+
+    frios, calientes = [], []
+    inicio = time.monotonic()
+    for _ in range(args.repeticiones):
+        frios.append(medir("frio", entorno))
+        calientes.append(medir("caliente", entorno))
+    fakes.detener()
+
+    todos = frios + calientes
+    print(f"Repeticiones: {args.repeticiones} por modo ({time.monotonic() - inicio:.1f} s) | "
+          f"latencias fake (ms): chat {args.latencia_chat_ms:g}, embeddings {args.latencia_embeddings_ms:g}, "
+          f"PostgREST {args.latencia_postgrest_ms:g}")
+    print(f"import bot                   {mediana(todos, 'import_s'):8.0f} ms")
+    print(f"crear_app()                  {mediana(todos, 'crear_app_s'):8.0f} ms")
+    print(f"Hilos tras importar:         {sorted({h for r in todos for h in r['hilos_tras_import']}) or 'ninguno'}")
+    print(f"Módulos pesados tras import: {sorted({m for r in todos for m in r['pesados_tras_import']}) or 'ninguno'}")
+    print(f"/health antes de calentar:   {sorted({r['health_antes'] for r in todos})}")
+    print(f"Calentamiento                {mediana(calientes, 'calentar_s'):8.0f} ms")
+    for paso in calientes[0]["pasos"]:
+        ms = statistics.median(r["pasos"][paso] for r in calientes) * 1000
+        print(f"  {paso:<26} {ms:8.0f} ms")
+    errores = {paso for r in calientes for paso in r["errores"]}
+    if errores:
+        print(f"  (pasos que fallaron y se cargarán al primer uso: {sorted(errores)})")
+    print(f"/health después de calentar: {sorted({r['health_despues'] for r in calientes})}")
+    print(f"Primer mensaje sin calentar  {mediana(frios, 'primer_mensaje_s'):8.0f} ms")
+    print(f"Primer mensaje calentado     {mediana(calientes, 'primer_mensaje_s'):8.0f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,274 @@
+"""
+Prueba de carga de /whatsapp contra los fakes locales (benchmarks/fakes.py).
+
+Levanta PostgREST, OpenAI y Twilio falsos, apunta el bot a ellos, lo
+sirve con werkzeug en un puerto local y simula usuarios de varios
+negocios que conversan en español: cada usuario manda sus mensajes uno
+tras otro (espera la respuesta antes del siguiente) y varios usuarios
+conversan a la vez.
+
+Mide:
+- acuse: lo que tarda el POST a /whatsapp en contestar (lo que ve Twilio)
+- respuesta: desde el POST hasta que el primer mensaje de vuelta llega al
+  fake de Twilio (lo que ve el usuario)
+- throughput y llamadas a OpenAI / PostgREST / Twilio por mensaje
+
+La configuración del bot es una por proceso (la primera fila de
+bot_configuracion), así que los "inquilinos" se distinguen por el
+vocabulario y los números de sus usuarios, no por su configuración.
+
+Uso:
+    python benchmarks/carga_webhook.py --usuarios 40 --concurrencia 16 --latencia-chat-ms 400
+    python benchmarks/carga_webhook.py --asincrono      # con WEBHOOK_ASINCRONO
+"""
+import os
+import sys
+import time
+import random
+import logging
+import argparse
+import tempfile
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+DIRECTORIO = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(DIRECTORIO))
+sys.path.insert(0, DIRECTORIO)
+
+from fakes import levantar_fakes  # noqa: E402
+
+# Mensajes típicos por tipo de negocio; {dia} y {hora} se rellenan al azar
+NEGOCIOS = {
+    "restaurante": [
+        "Hola, buenas tardes",
+        "¿Tienen mesa para 4 personas el {dia} a las {hora}?",
+        "¿Cuál es el menú del día?",
+        "¿Tienen opciones vegetarianas?",
+        "¿Dónde están ubicados?",
+        "¿Cuánto cuesta el paquete para eventos?",
+        "Quiero reservar para mi cumpleaños",
+        "Gracias, eso es todo",
+    ],
+    "spa": [
+        "Hola! Quería información de masajes",
+        "¿Cuánto cuesta el masaje relajante?",
+        "Quiero agendar un facial el {dia} a las {hora}",
+        "¿Tienen promoción de parejas?",
+        "¿Cuál es su horario?",
+        "¿Aceptan tarjeta?",
+        "Ok gracias, lo voy a pensar",
+    ],
+    "autos": [
+        "Buen día, me interesa una SUV",
+        "¿Qué planes de financiamiento manejan?",
+        "¿Cuánto es el enganche mínimo?",
+        "Quiero agendar una prueba de manejo el {dia} a las {hora}",
+        "¿Tienen seminuevos con garantía?",
+        "Me pueden mandar una cotización",
+        "¿Reciben mi auto a cuenta?",
+        "Lo platico con mi esposa y les aviso",
+    ],
+    "pensiones": [
+        "Hola, quiero saber si ya me puedo pensionar",
+        "Tengo 58 años y 900 semanas cotizadas",
+        "¿Qué documentos necesito?",
+        "¿Cuánto cobran por el trámite?",
+        "¿Me pueden ayudar con mi crédito INFONAVIT?",
+        "¿Puedo hacer una cita el {dia} a las {hora}?",
+        "Muchas gracias por la información",
+    ],
+}
+DIAS = ["lunes", "martes", "miércoles", "jueves", "viernes", "sábado", "mañana", "pasado mañana"]
+HORAS = ["10", "11:30", "1 de la tarde", "4pm", "5", "6 de la tarde", "7:30 pm"]
+
+CONFIGURACION_BOT = {
+    "bot_type": ["ventas", "reservas"],
+    "tipo_negocio": "generico",
+    "negocio": "Negocio de Prueba",
+    "nombre_bot": "Negocio de Prueba",
+    "ubicacion": "Av. Reforma 222, CDMX",
+    "latitud": 19.4326,
+    "longitud": -99.1332,
+    "contexto": "Negocio de prueba para medir la carga del bot.",
+    "tipo_reservas": "único_horario",
+    "requiere_zona": False,
+    "zonas_permitidas": ["Salón", "Terraza"],
+}
+
+
+class ContadorErrores(logging.Handler):
+    """Cuenta los logging.error del bot sin imprimirlos (salvo --verbose)."""
+
+    def __init__(self):
+        super().__init__(logging.ERROR)
+        self.mensajes = Counter()
+
+    def emit(self, record):
+        self.mensajes[record.getMessage()[:120]] += 1
+
+
+def percentil(valores, p):
+    if not valores:
+        return None
+    ordenados = sorted(valores)
+    return ordenados[min(len(ordenados) - 1, int(p / 100 * len(ordenados)))]
+
+
+def conversacion(negocio, num_mensajes, aleatorio):
+    plantillas = NEGOCIOS[negocio]
+    mensajes = [plantillas[0]] + aleatorio.sample(plantillas[1:], min(num_mensajes - 1, len(plantillas) - 1))
+    return [m.format(dia=aleatorio.choice(DIAS), hora=aleatorio.choice(HORAS)) for m in mensajes]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Carga sobre /whatsapp con fakes locales")
+    parser.add_argument("--usuarios", type=int, default=40)
+    parser.add_argument("--mensajes", type=int, default=5, help="Mensajes por conversación")
+    parser.add_argument("--concurrencia", type=int, default=16, help="Usuarios conversando a la vez")
+    parser.add_argument("--pausa-ms", type=float, default=300, help="Lo que el usuario tarda en contestar")
+    parser.add_argument("--timeout", type=float, default=30, help="Espera máxima por respuesta (s)")
+    parser.add_argument("--latencia-chat-ms", type=float, default=400)
+    parser.add_argument("--latencia-embeddings-ms", type=float, default=60)
+    parser.add_argument("--latencia-postgrest-ms", type=float, default=15)
+    parser.add_argument("--latencia-twilio-ms", type=float, default=40)
+    parser.add_argument("--asincrono", action="store_true", help="WEBHOOK_ASINCRONO=true")
+    parser.add_argument("--semilla", type=int, default=7)
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    fakes = levantar_fakes(args.latencia_chat_ms, args.latencia_embeddings_ms,
+                           args.latencia_postgrest_ms, args.latencia_twilio_ms)
+    fakes.postgrest.sembrar("bot_configuracion", [CONFIGURACION_BOT])
+
+    # ⚠️ Todo esto antes de importar el bot: la configuración se lee del entorno al importar
+    os.environ.update(fakes.entorno())
+    cache = tempfile.mkdtemp(prefix="carga_webhook_")
+    os.environ.update({
+        "WEBHOOK_ASINCRONO": "true" if args.asincrono else "false",
+        "COALESCER_MENSAJES": "false",
+        "TRABAJOS_SQLITE_PATH": os.path.join(cache, "trabajos.sqlite3"),
+        "EMBEDDINGS_SQLITE_PATH": os.path.join(cache, "embeddings.sqlite3"),
+        "ESTADO_SQLITE_PATH": os.path.join(cache, "estado.sqlite3"),
+    })
+    errores = ContadorErrores()
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.CRITICAL)
+    logging.getLogger().addHandler(errores)
+    for ruidoso in ("httpx", "werkzeug", "urllib3"):
+        logging.getLogger(ruidoso).setLevel(logging.WARNING)
+
+    inicio_import = time.perf_counter()
+    import requests
+    from werkzeug.serving import make_server
+    import bot
+    importado_en = time.perf_counter() - inicio_import
+    if hasattr(bot, "iniciar_servicios_en_segundo_plano"):
+        bot.iniciar_servicios_en_segundo_plano()
+
+    app = bot.crear_app() if hasattr(bot, "crear_app") else bot.app
+    servidor = make_server("127.0.0.1", 0, app, threaded=True)
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{servidor.server_port}/whatsapp"
+    local = threading.local()
+
+    def enviar(numero, texto):
+        sesion = getattr(local, "sesion", None)
+        if sesion is None:
+            sesion = local.sesion = requests.Session()
+        datos = {"From": f"whatsapp:{numero}", "To": fakes.entorno()["TWILIO_WHATSAPP_NUMBER"],
+                 "Body": texto, "MessageSid": f"SM{random.getrandbits(64):016x}", "NumMedia": "0"}
+        return sesion.post(url, data=datos, timeout=args.timeout + 30)
+
+    acuses, respuestas, sin_respuesta, http_fallidos = [], [], [0], Counter()
+    lock = threading.Lock()
+
+    def conversar(numero, mensajes):
+        for texto in mensajes:
+            vistos = len(fakes.twilio.enviados_a(numero))
+            inicio = time.monotonic()
+            respuesta_http = enviar(numero, texto)
+            acuse = time.monotonic() - inicio
+            envio = fakes.twilio.esperar(numero, vistos, timeout=args.timeout)
+            with lock:
+                acuses.append(acuse)
+                if respuesta_http.status_code >= 400:
+                    http_fallidos[respuesta_http.status_code] += 1
+                if envio is None:
+                    sin_respuesta[0] += 1
+                else:
+                    respuestas.append(envio["t"] - inicio)
+            # El usuario lee y contesta; de paso llegan los mensajes que quedaban de esta vuelta
+            time.sleep(args.pausa_ms / 1000)
+
+    # 🔥 Calentamiento: carga configuración, índices y conexiones; no se mide
+    conversar("+5210000000000", ["Hola"])
+    if hasattr(bot, "mensajeria"):
+        bot.mensajeria.esperar_pendientes()
+    acuses.clear()
+    respuestas.clear()
+    sin_respuesta[0] = 0
+    fakes.reiniciar_contadores()
+    errores.mensajes.clear()
+
+    aleatorio = random.Random(args.semilla)
+    negocios = list(NEGOCIOS)
+    usuarios = []
+    for i in range(args.usuarios):
+        negocio = negocios[i % len(negocios)]
+        numero = f"+521{negocios.index(negocio) + 1:02d}{i:08d}"
+        usuarios.append((numero, conversacion(negocio, args.mensajes, aleatorio)))
+    total_mensajes = sum(len(m) for _, m in usuarios)
+
+    print(f"Usuarios: {args.usuarios} ({len(negocios)} negocios) | mensajes: {total_mensajes} | "
+          f"concurrencia: {args.concurrencia} | modo: {'asíncrono' if args.asincrono else 'síncrono'}")
+    print(f"Latencias fake (ms): chat {args.latencia_chat_ms:g}, embeddings {args.latencia_embeddings_ms:g}, "
+          f"PostgREST {args.latencia_postgrest_ms:g}, Twilio {args.latencia_twilio_ms:g}")
+
+    inicio = time.monotonic()
+    with ThreadPoolExecutor(max_workers=args.concurrencia) as executor:
+        for futuro in [executor.submit(conversar, numero, mensajes) for numero, mensajes in usuarios]:
+            futuro.result()
+    duracion = time.monotonic() - inicio
+    if hasattr(bot, "mensajeria"):
+        bot.mensajeria.esperar_pendientes()
+
+    def fila(nombre, valores):
+        ms = [v * 1000 for v in valores]
+        print(f"{nombre:<12} p50 {percentil(ms, 50) or 0:8.0f}   p95 {percentil(ms, 95) or 0:8.0f}   "
+              f"p99 {percentil(ms, 99) or 0:8.0f}   máx {max(ms, default=0):8.0f}")
+
+    contadores = fakes.contadores()
+    chat = sum(v for k, v in contadores["openai"].items() if k.startswith("chat "))
+    embeddings = sum(v for k, v in contadores["openai"].items() if k.startswith("embeddings "))
+    postgrest = sum(contadores["postgrest"].values())
+    twilio = sum(v for k, v in contadores["twilio"].items() if k in ("whatsapp", "messenger"))
+
+    print(f"\nImportar el bot: {importado_en:.2f} s")
+    print(f"Duración: {duracion:.1f} s | throughput: {total_mensajes / duracion:.2f} mensajes/s")
+    print(f"Sin respuesta en {args.timeout:g} s: {sin_respuesta[0]} | HTTP con error: {dict(http_fallidos) or 0}")
+    print("\nLatencia (ms)")
+    fila("acuse", acuses)
+    fila("respuesta", respuestas)
+
+    print("\nLlamadas por mensaje")
+    print(f"  OpenAI chat:       {chat / total_mensajes:.2f}")
+    for clave, valor in sorted(contadores["openai"].items()):
+        if clave.startswith("chat "):
+            print(f"    {clave[5:]:<28} {valor / total_mensajes:.2f}")
+    print(f"  OpenAI embeddings: {embeddings / total_mensajes:.2f}")
+    print(f"  PostgREST:         {postgrest / total_mensajes:.2f}")
+    for clave, valor in Counter(contadores["postgrest"]).most_common(8):
+        print(f"    {clave:<28} {valor / total_mensajes:.2f}")
+    print(f"  Twilio/Messenger:  {twilio / total_mensajes:.2f}")
+
+    if errores.mensajes:
+        print(f"\nErrores registrados por el bot: {sum(errores.mensajes.values())}")
+        for mensaje, veces in errores.mensajes.most_common(5):
+            print(f"  {veces:>4} × {mensaje}")
+
+    servidor.shutdown()
+    return 1 if sin_respuesta[0] or http_fallidos else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
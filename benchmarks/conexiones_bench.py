@@ -0,0 +1,96 @@
+"""
+Clientes y sockets que abre el bot: cuánto tarda `import bot`, cuántos
+clientes de Supabase/OpenAI existen y cuántas conexiones TCP quedan
+abiertas hacia cada backend después de atender mensajes concurrentes.
+
+Corre contra los fakes locales (benchmarks/fakes.py).
+Uso: python benchmarks/conexiones_bench.py --mensajes 40 --concurrencia 8
+"""
+import os
+import gc
+import sys
+import time
+import logging
+import argparse
+import tempfile
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+DIRECTORIO = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(DIRECTORIO))
+sys.path.insert(0, DIRECTORIO)
+
+import psutil  # noqa: E402
+from fakes import levantar_fakes  # noqa: E402
+from carga_webhook import CONFIGURACION_BOT, NEGOCIOS  # noqa: E402
+
+
+def sockets_por_backend(fakes):
+    puertos = {
+        fakes.postgrest._servidor.server_address[1]: "postgrest",
+        fakes.openai._servidor.server_address[1]: "openai",
+        fakes.twilio._servidor.server_address[1]: "twilio",
+    }
+    conteo = Counter()
+    for conexion in psutil.Process().net_connections(kind="tcp"):
+        if conexion.raddr and conexion.raddr.port in puertos and conexion.status == psutil.CONN_ESTABLISHED:
+            conteo[puertos[conexion.raddr.port]] += 1
+    return conteo
+
+
+def clientes_creados():
+    from supabase import Client
+    from openai import OpenAI
+    objetos = gc.get_objects()
+    return {
+        "supabase": sum(1 for o in objetos if issubclass(type(o), Client)),
+        "openai": sum(1 for o in objetos if issubclass(type(o), OpenAI)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Clientes y sockets abiertos por el bot")
+    parser.add_argument("--mensajes", type=int, default=40)
+    parser.add_argument("--concurrencia", type=int, default=8)
+    args = parser.parse_args()
+
+    fakes = levantar_fakes(latencia_chat_ms=50, latencia_embeddings_ms=10, latencia_postgrest_ms=10)
+    fakes.postgrest.sembrar("bot_configuracion", [CONFIGURACION_BOT])
+    os.environ.update(fakes.entorno())
+    cache = tempfile.mkdtemp(prefix="conexiones_bench_")
+    os.environ.update({
+        "COALESCER_MENSAJES": "false",
+        "WEBHOOK_ASINCRONO": "false",
+        "TRABAJOS_SQLITE_PATH": os.path.join(cache, "trabajos.sqlite3"),
+        "EMBEDDINGS_SQLITE_PATH": os.path.join(cache, "embeddings.sqlite3"),
+    })
+    logging.basicConfig(level=logging.CRITICAL)
+
+    inicio = time.perf_counter()
+    import bot
+    importado_en = time.perf_counter() - inicio
+    tras_importar = clientes_creados()
+    bot.iniciar_servicios_en_segundo_plano()
+
+    cliente_http = bot.crear_app().test_client
+    plantillas = [m for mensajes in NEGOCIOS.values() for m in mensajes]
+
+    def enviar(i):
+        datos = {"From": f"whatsapp:+52155{i % args.concurrencia:08d}", "Body": plantillas[i % len(plantillas)]}
+        return cliente_http().post("/whatsapp", data=datos).status_code
+
+    with ThreadPoolExecutor(max_workers=args.concurrencia) as executor:
+        estados = Counter(executor.map(enviar, range(args.mensajes)))
+    bot.mensajeria.esperar_pendientes()
+    sockets = sockets_por_backend(fakes)
+
+    print(f"import bot:               {importado_en:.2f} s")
+    print(f"Clientes tras importar:   {tras_importar}")
+    print(f"Clientes tras la carga:   {clientes_creados()}")
+    print(f"Respuestas HTTP:          {dict(estados)}")
+    print(f"Sockets abiertos ({args.mensajes} mensajes, concurrencia {args.concurrencia}): "
+          f"{dict(sockets)} (total {sum(sockets.values())})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,837 @@
+"""
+Dobles locales de Supabase/PostgREST, OpenAI y Twilio/Messenger.
+
+Son servidores HTTP de verdad en 127.0.0.1, así que los clientes reales
+(supabase-py, openai, requests) no se tocan: basta con apuntar las
+variables de entorno a ellos ANTES de importar bot.py y compañía.
+
+    fakes = levantar_fakes(latencia_chat_ms=400)
+    os.environ.update(fakes.entorno())
+    import bot
+
+- FakePostgrest: tablas en memoria sin esquema fijo (cada fila guarda las
+  columnas que le mandan), filtros eq/neq/gt/gte/lt/lte/like/ilike/is/in,
+  árboles or=()/and=(), order, limit/offset, insert, upsert con
+  on_conflict, update, delete, single() y rpc.
+- FakeOpenAI: chat completions con respuestas enlatadas según el prompt
+  (incluye function calls) y embeddings deterministas, con latencia
+  configurable.
+- FakeTwilio: registra cada WhatsApp/Messenger enviado y permite esperar
+  la respuesta a un destino; puede devolver 429 para probar reintentos.
+
+Uso suelto (para correr el bot en otro proceso):
+    python benchmarks/fakes.py --puerto 9100
+"""
+import os
+import re
+import sys
+import json
+import time
+import uuid
+import zlib
+import base64
+import random
+import struct
+import logging
+import argparse
+import threading
+from datetime import datetime, date, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qsl
+
+# Clave con forma de JWT: supabase-py valida el formato, no la firma
+CLAVE_SUPABASE_FAKE = "fake.fake.fake"
+TWILIO_SID_FAKE = "ACfake"
+TWILIO_NUMERO_FAKE = "whatsapp:+14155238886"
+
+# === Servidor base ===
+class _Manejador(BaseHTTPRequestHandler):
+    # Keep-alive: las sesiones de requests/httpx reutilizan la conexión como en producción
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _atender(self):
+        self.server.fake.atender(self)
+
+    do_GET = do_POST = do_PATCH = do_PUT = do_DELETE = do_HEAD = _atender
+
+
+class ServidorFake:
+    """Servidor HTTP en un hilo daemon; las subclases implementan manejar()."""
+
+    def __init__(self, latencia_ms=0, puerto=0):
+        self.latencia_ms = latencia_ms
+        self.puerto = puerto
+        self._servidor = None
+        self._lock_contadores = threading.Lock()
+        self.contadores = {}
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self._servidor.server_address[1]}"
+
+    def iniciar(self):
+        self._servidor = ThreadingHTTPServer(("127.0.0.1", self.puerto), _Manejador)
+        self._servidor.daemon_threads = True
+        self._servidor.fake = self
+        threading.Thread(target=self._servidor.serve_forever, name=type(self).__name__, daemon=True).start()
+        return self
+
+    def detener(self):
+        if self._servidor:
+            self._servidor.shutdown()
+            self._servidor.server_close()
+
+    def contar(self, clave, n=1):
+        with self._lock_contadores:
+            self.contadores[clave] = self.contadores.get(clave, 0) + n
+
+    def total(self, prefijo=""):
+        with self._lock_contadores:
+            return sum(v for k, v in self.contadores.items() if k.startswith(prefijo))
+
+    def reiniciar_contadores(self):
+        with self._lock_contadores:
+            self.contadores = {}
+
+    def dormir(self, latencia_ms):
+        if latencia_ms:
+            # ±20 % para que las llamadas concurrentes no terminen todas juntas
+            time.sleep(latencia_ms / 1000 * random.uniform(0.8, 1.2))
+
+    def atender(self, peticion):
+        partes = urlsplit(peticion.path)
+        largo = int(peticion.headers.get("Content-Length") or 0)
+        cuerpo = peticion.rfile.read(largo) if largo else b""
+        try:
+            status, datos, encabezados = self.manejar(
+                peticion.command, partes.path, partes.query, peticion.headers, cuerpo
+            )
+        except Exception as e:
+            logging.error(f"❌ Error en {type(self).__name__}: {e}")
+            status, datos, encabezados = 500, {"message": str(e)}, {}
+
+        salida = b"" if datos is None else datos if isinstance(datos, bytes) else json.dumps(datos, default=str).encode("utf-8")
+        peticion.send_response(status)
+        peticion.send_header("Content-Type", "application/json; charset=utf-8")
+        peticion.send_header("Content-Length", str(len(salida)))
+        for clave, valor in (encabezados or {}).items():
+            peticion.send_header(clave, valor)
+        peticion.end_headers()
+        if peticion.command != "HEAD":
+            peticion.wfile.write(salida)
+
+    def manejar(self, metodo, ruta, query, encabezados, cuerpo):
+        raise NotImplementedError
+
+
+# === PostgREST ===
+# Clave primaria por tabla (el resto usa "id" entero autoincremental)
+CLAVES_PRIMARIAS = {"conversation_history": "conversation_id"}
+# Valores por defecto que en Supabase pone la tabla y de los que dependen los filtros del bot
+VALORES_POR_DEFECTO = {
+    "conversation_history": {"intentos_seguimiento": 0, "is_human": False, "status": "bot"},
+    "reservaciones": {
+        "estado": "pendiente", "recordatorio_24h_enviado": False,
+        "recordatorio_1h_enviado": False, "encuesta_enviada": False
+    },
+}
+_RE_FECHA = re.compile(r"^\d{4}-\d{2}-\d{2}([T ]\d{2}:\d{2}|$)")
+_PARAMETROS_RESERVADOS = {"select", "order", "limit", "offset", "on_conflict", "columns"}
+
+
+class ErrorPostgrest(Exception):
+    def __init__(self, mensaje, status=400, codigo="PGRST100"):
+        super().__init__(mensaje)
+        self.status = status
+        self.codigo = codigo
+
+
+def _dividir(texto):
+    """Separa por comas de primer nivel, respetando paréntesis y comillas."""
+    partes, actual, nivel, comillas, escape = [], [], 0, False, False
+    for c in texto:
+        if escape:
+            actual.append(c)
+            escape = False
+        elif c == "\\" and comillas:
+            actual.append(c)
+            escape = True
+        elif c == '"':
+            comillas = not comillas
+            actual.append(c)
+        elif c == "(" and not comillas:
+            nivel += 1
+            actual.append(c)
+        elif c == ")" and not comillas:
+            nivel -= 1
+            actual.append(c)
+        elif c == "," and nivel == 0 and not comillas:
+            partes.append("".join(actual))
+            actual = []
+        else:
+            actual.append(c)
+    partes.append("".join(actual))
+    return [p.strip() for p in partes if p.strip()]
+
+
+def _sin_comillas(valor):
+    if len(valor) >= 2 and valor[0] == valor[-1] == '"':
+        return valor[1:-1].replace('\\"', '"').replace("\\\\", "\\")
+    return valor
+
+
+def _a_datetime(valor):
+    if isinstance(valor, datetime):
+        fecha = valor
+    elif isinstance(valor, date):
+        fecha = datetime.combine(valor, datetime.min.time())
+    else:
+        fecha = datetime.fromisoformat(str(valor).strip().replace("Z", "+00:00"))
+    return fecha if fecha.tzinfo else fecha.replace(tzinfo=timezone.utc)
+
+
+def _convertir(celda, texto):
+    """(celda, filtro) en tipos comparables, o None si la celda es NULL."""
+    if celda is None:
+        return None
+    if isinstance(celda, bool):
+        return celda, texto.lower() in ("true", "t", "1")
+    if isinstance(celda, (int, float)):
+        try:
+            return celda, float(texto)
+        except ValueError:
+            return str(celda), texto
+    if isinstance(celda, str):
+        if _RE_FECHA.match(celda) and _RE_FECHA.match(texto):
+            try:
+                return _a_datetime(celda), _a_datetime(texto)
+            except ValueError:
+                pass
+        return celda, texto
+    return json.dumps(celda, sort_keys=True), texto
+
+
+def _comparar(comparador):
+    def predicado(celda, texto):
+        par = _convertir(celda, texto)
+        return par is not None and comparador(*par)
+    return predicado
+
+
+def _patron(texto, ignorar_mayusculas):
+    regex = "".join(".*" if c in "%*" else "." if c == "_" else re.escape(c) for c in texto)
+    return re.compile(regex, re.S | (re.I if ignorar_mayusculas else 0))
+
+
+def _filtro_is(celda, texto):
+    texto = texto.lower()
+    if texto == "null":
+        return celda is None
+    if texto in ("true", "false"):
+        return celda is (texto == "true")
+    if texto == "unknown":
+        return celda is None
+    raise ErrorPostgrest(f"is.{texto} no soportado")
+
+
+def _filtro_in(celda, texto):
+    if not (texto.startswith("(") and texto.endswith(")")):
+        raise ErrorPostgrest(f"in.{texto}: se esperaba (a,b,...)")
+    igual = OPERADORES["eq"]
+    return any(igual(celda, _sin_comillas(v)) for v in _dividir(texto[1:-1]))
+
+
+OPERADORES = {
+    "eq": _comparar(lambda a, b: a == b),
+    "neq": _comparar(lambda a, b: a != b),
+    "gt": _comparar(lambda a, b: a > b),
+    "gte": _comparar(lambda a, b: a >= b),
+    "lt": _comparar(lambda a, b: a < b),
+    "lte": _comparar(lambda a, b: a <= b),
+    "like": lambda celda, texto: celda is not None and bool(_patron(texto, False).fullmatch(str(celda))),
+    "ilike": lambda celda, texto: celda is not None and bool(_patron(texto, True).fullmatch(str(celda))),
+    "is": _filtro_is,
+    "in": _filtro_in,
+}
+
+
+def _condicion(columna, expresion):
+    """'eq.5', 'not.in.(a,b)', ... sobre una columna -> predicado(fila)."""
+    negar = expresion.startswith("not.")
+    if negar:
+        expresion = expresion[4:]
+    operador, _, valor = expresion.partition(".")
+    if operador not in OPERADORES:
+        raise ErrorPostgrest(f"Operador no soportado: {operador}")
+    funcion = OPERADORES[operador]
+    valor = valor if operador in ("in", "is") else _sin_comillas(valor)
+
+    def predicado(fila):
+        celda = fila.get(columna)
+        if negar:
+            # En SQL, NOT sobre NULL sigue siendo NULL (no pasa el filtro)
+            return (celda is not None or operador == "is") and not funcion(celda, valor)
+        return funcion(celda, valor)
+    return predicado
+
+
+def _arbol(texto, conector="or"):
+    """Contenido de or=(...) / and=(...) -> predicado(fila)."""
+    hijos = []
+    for parte in _dividir(texto):
+        m = re.match(r"^(not\.)?(and|or)\((.*)\)$", parte, re.S)
+        if m:
+            hijo = _arbol(m.group(3), m.group(2))
+            hijos.append((lambda h: lambda fila: not h(fila))(hijo) if m.group(1) else hijo)
+        else:
+            columna, _, expresion = parte.partition(".")
+            hijos.append(_condicion(columna, expresion))
+    combinar = any if conector == "or" else all
+    return lambda fila: combinar(h(fila) for h in hijos)
+
+
+def _clave_orden(valor):
+    if valor is None:
+        return (1, 0, 0)
+    if isinstance(valor, bool):
+        return (0, 0, int(valor))
+    if isinstance(valor, (int, float)):
+        return (0, 0, valor)
+    if isinstance(valor, str) and _RE_FECHA.match(valor):
+        try:
+            return (0, 1, _a_datetime(valor).timestamp())
+        except ValueError:
+            pass
+    return (0, 2, str(valor))
+
+
+def _ahora_iso():
+    return datetime.now(timezone.utc).isoformat()
+
+
+class FakePostgrest(ServidorFake):
+    """PostgREST en memoria: GET/POST/PATCH/DELETE sobre /rest/v1/<tabla> y POST /rest/v1/rpc/<fn>."""
+
+    def __init__(self, latencia_ms=0, puerto=0):
+        super().__init__(latencia_ms, puerto)
+        self.tablas = {}
+        self.rpcs = {}
+        self._secuencias = {}
+        self._lock = threading.Lock()
+        # Las funciones SQL del repo (sql/*.sql) que el bot llama por rpc()
+        self.registrar_rpc("ultimas_interacciones", self._ultimas_interacciones)
+        self.registrar_rpc("sumar_kpi_por_hora", self._sumar_kpi_por_hora)
+
+    # --- API para scripts ---
+    def sembrar(self, tabla, filas):
+        with self._lock:
+            return [dict(self._insertar(tabla, dict(f))) for f in filas]
+
+    def filas(self, tabla):
+        with self._lock:
+            return [dict(f) for f in self.tablas.get(tabla, [])]
+
+    def registrar_rpc(self, nombre, funcion):
+        """funcion(argumentos) -> datos JSON de la respuesta."""
+        self.rpcs[nombre] = funcion
+
+    def _sumar_kpi_por_hora(self, argumentos):
+        with self._lock:
+            tabla = self.tablas.setdefault("kpi_por_hora", [])
+            for nueva in argumentos.get("filas") or []:
+                clave = (nueva["negocio"], nueva["tipo_evento"], nueva["hora"])
+                fila = next((f for f in tabla if (f["negocio"], f["tipo_evento"], f["hora"]) == clave), None)
+                if fila is None:
+                    tabla.append(dict(nueva))
+                else:
+                    fila["eventos"] += nueva["eventos"]
+                    fila["valor"] += nueva["valor"]
+        return None
+
+    def _ultimas_interacciones(self, argumentos):
+        ids = set(argumentos.get("ids") or [])
+        cuantas = argumentos.get("cuantas", 6)
+        with self._lock:
+            filas = [dict(f) for f in self.tablas.get("interaction_history", []) if f.get("conversation_id") in ids]
+        filas.sort(key=lambda f: f.get("start_time") or "", reverse=True)
+        por_conversacion = {}
+        for fila in filas:
+            por_conversacion.setdefault(fila["conversation_id"], []).append(fila)
+        return [f for grupo in por_conversacion.values() for f in grupo[:cuantas]]
+
+    # --- HTTP ---
+    def manejar(self, metodo, ruta, query, encabezados, cuerpo):
+        self.dormir(self.latencia_ms)
+        partes = ruta.strip("/").split("/")
+        if partes[:2] != ["rest", "v1"] or len(partes) < 3:
+            return 404, {"message": f"Ruta desconocida: {ruta}"}, {}
+
+        try:
+            if partes[2] == "rpc" and len(partes) == 4:
+                self.contar(f"rpc {partes[3]}")
+                argumentos = json.loads(cuerpo or b"{}")
+                funcion = self.rpcs.get(partes[3])
+                return 200, funcion(argumentos) if funcion else [], {}
+
+            tabla = partes[2]
+            self.contar(f"{metodo} {tabla}")
+            parametros = parse_qsl(query, keep_blank_values=True)
+            preferencias = {p.strip() for p in (encabezados.get("Prefer") or "").split(",") if p.strip()}
+            datos = json.loads(cuerpo) if cuerpo else None
+
+            with self._lock:
+                if metodo in ("GET", "HEAD"):
+                    filas, total = self._leer(tabla, parametros)
+                    status = 200
+                elif metodo == "POST":
+                    filas = self._escribir(tabla, parametros, preferencias, datos)
+                    total, status = len(filas), 201
+                elif metodo == "PATCH":
+                    filas = self._actualizar(tabla, parametros, datos or {})
+                    total, status = len(filas), 200
+                elif metodo == "DELETE":
+                    filas = self._borrar(tabla, parametros)
+                    total, status = len(filas), 200
+                else:
+                    return 405, {"message": f"Método no soportado: {metodo}"}, {}
+                filas = [self._proyectar(f, parametros) for f in filas]
+        except ErrorPostgrest as e:
+            return e.status, {"code": e.codigo, "message": str(e), "details": None, "hint": None}, {}
+
+        encabezados_salida = {}
+        if "count=exact" in preferencias or "count=planned" in preferencias or "count=estimated" in preferencias:
+            encabezados_salida["Content-Range"] = f"0-{len(filas) - 1}/{total}" if filas else f"*/{total}"
+        if metodo != "GET" and "return=representation" not in preferencias:
+            return (204 if metodo != "POST" else 201), None, encabezados_salida
+        if "vnd.pgrst.object" in (encabezados.get("Accept") or ""):
+            if len(filas) != 1:
+                return 406, {
+                    "code": "PGRST116",
+                    "message": "JSON object requested, multiple (or no) rows returned",
+                    "details": f"The result contains {len(filas)} rows",
+                    "hint": None
+                }, encabezados_salida
+            return status, filas[0], encabezados_salida
+        return status, filas, encabezados_salida
+
+    # --- Lectura ---
+    def _predicado(self, parametros):
+        predicados = []
+        for clave, valor in parametros:
+            if clave in _PARAMETROS_RESERVADOS:
+                continue
+            m = re.match(r"^(not\.)?(or|and)$", clave)
+            if m:
+                if not (valor.startswith("(") and valor.endswith(")")):
+                    raise ErrorPostgrest(f"{clave}={valor}: se esperaba (...)")
+                arbol = _arbol(valor[1:-1], m.group(2))
+                predicados.append((lambda a: lambda fila: not a(fila))(arbol) if m.group(1) else arbol)
+            else:
+                predicados.append(_condicion(clave, valor))
+        return lambda fila: all(p(fila) for p in predicados)
+
+    def _filtrar(self, tabla, parametros):
+        predicado = self._predicado(parametros)
+        return [f for f in self.tablas.get(tabla, []) if predicado(f)]
+
+    def _leer(self, tabla, parametros):
+        filas = self._filtrar(tabla, parametros)
+        total = len(filas)
+
+        criterios = []
+        for clave, valor in parametros:
+            if clave == "order":
+                criterios.extend(_dividir(valor))
+        for criterio in reversed(criterios):
+            columna, *modificadores = criterio.split(".")
+            descendente = "desc" in modificadores
+            # Como Postgres: ASC pone los NULL al final y DESC al principio
+            nulos_primero = "nullsfirst" in modificadores or (descendente and "nullslast" not in modificadores)
+            filas.sort(key=lambda f: _clave_orden(f.get(columna)), reverse=descendente)
+            nulos = [f for f in filas if f.get(columna) is None]
+            if nulos:
+                resto = [f for f in filas if f.get(columna) is not None]
+                filas = nulos + resto if nulos_primero else resto + nulos
+
+        valores = dict(parametros)
+        inicio = int(valores.get("offset") or 0)
+        fin = inicio + int(valores["limit"]) if valores.get("limit") else None
+        return [dict(f) for f in filas[inicio:fin]], total
+
+    def _proyectar(self, fila, parametros):
+        seleccion = dict(parametros).get("select", "*")
+        if seleccion.strip() in ("", "*"):
+            return dict(fila)
+        salida = {}
+        for campo in _dividir(seleccion):
+            if "(" in campo:
+                # Recursos embebidos (joins): este fake no los resuelve
+                continue
+            if campo == "*":
+                salida.update(fila)
+                continue
+            alias, _, columna = campo.rpartition(":") if ":" in campo.replace("::", "") else ("", "", campo)
+            columna = columna.split("::")[0].strip()
+            salida[(alias or columna).strip()] = fila.get(columna)
+        return salida
+
+    # --- Escritura ---
+    def _clave(self, tabla):
+        return CLAVES_PRIMARIAS.get(tabla, "id")
+
+    def _insertar(self, tabla, fila):
+        # Llamar con self._lock tomado
+        clave = self._clave(tabla)
+        nueva = {**VALORES_POR_DEFECTO.get(tabla, {}), **fila}
+        if nueva.get(clave) is None:
+            if clave == "id":
+                self._secuencias[tabla] = self._secuencias.get(tabla, 0) + 1
+                nueva[clave] = self._secuencias[tabla]
+            else:
+                nueva[clave] = str(uuid.uuid4())
+        elif clave == "id" and isinstance(nueva[clave], int):
+            self._secuencias[tabla] = max(self._secuencias.get(tabla, 0), nueva[clave])
+        ahora = _ahora_iso()
+        nueva.setdefault("created_at", ahora)
+        nueva.setdefault("updated_at", ahora)
+
+        existentes = self.tablas.setdefault(tabla, [])
+        if any(f.get(clave) == nueva[clave] for f in existentes):
+            raise ErrorPostgrest(
+                f'duplicate key value violates unique constraint "{tabla}_pkey"', status=409, codigo="23505"
+            )
+        existentes.append(nueva)
+        return nueva
+
+    def _escribir(self, tabla, parametros, preferencias, datos):
+        filas = datos if isinstance(datos, list) else [datos or {}]
+        valores = dict(parametros)
+        conflicto = [c.strip() for c in (valores.get("on_conflict") or self._clave(tabla)).split(",") if c.strip()]
+        fusionar = "resolution=merge-duplicates" in preferencias
+        ignorar = "resolution=ignore-duplicates" in preferencias
+
+        escritas = []
+        for fila in filas:
+            existente = None
+            if fusionar or ignorar:
+                existente = next(
+                    (f for f in self.tablas.get(tabla, [])
+                     if all(c in fila and f.get(c) == fila[c] for c in conflicto)),
+                    None
+                )
+            if existente is None:
+                escritas.append(dict(self._insertar(tabla, fila)))
+            elif fusionar:
+                existente.update(fila)
+                existente.setdefault("updated_at", _ahora_iso())
+                if "updated_at" not in fila:
+                    existente["updated_at"] = _ahora_iso()
+                escritas.append(dict(existente))
+        return escritas
+
+    def _actualizar(self, tabla, parametros, cambios):
+        filas = self._filtrar(tabla, parametros)
+        ahora = _ahora_iso()
+        for fila in filas:
+            fila.update(cambios)
+            # Lo que en Supabase hace el trigger de updated_at
+            if "updated_at" not in cambios:
+                fila["updated_at"] = ahora
+        return [dict(f) for f in filas]
+
+    def _borrar(self, tabla, parametros):
+        borradas = self._filtrar(tabla, parametros)
+        ids = {id(f) for f in borradas}
+        self.tablas[tabla] = [f for f in self.tablas.get(tabla, []) if id(f) not in ids]
+        return [dict(f) for f in borradas]
+
+
+# === OpenAI ===
+# (patrón en el prompt de sistema, respuesta): lo que esperan los parsers del bot
+RESPUESTAS_CHAT = [
+    (r"venta, reserva, ambos o ninguno", "venta"),
+    (r"calificado, medio o no calificado", "medio"),
+    (r"calificacion del 1 al 5", "Calificacion: 5\nComentario: null"),
+    (r"nombre.*correo", '{"nombre": "Cliente de Prueba", "correo": "cliente@example.com"}'),
+    (r'"calificacion"', '{"calificacion": 5, "comentario": "Excelente servicio"}'),
+    (r"tipo de servicio o motivo de la cita", "General"),
+    (r"intencion:.*tono:", "Intención: interés\nTono: positivo\nRelevancia: alta\nObservación: Pide información."),
+]
+RESPUESTAS_GENERICAS = [
+    "¡Claro! Con gusto te ayudo. ¿Me compartes un poco más de detalle?",
+    "Perfecto, te comparto la información: tenemos disponibilidad esta semana. ¿Te gustaría agendar?",
+    "Gracias por escribirnos 😊. El precio depende del paquete; ¿cuál te interesa?",
+    "Entendido. Un asesor puede darte seguimiento; mientras tanto, ¿tienes alguna otra duda?",
+]
+
+
+def _normalizar(texto):
+    import unicodedata
+    return "".join(
+        c for c in unicodedata.normalize("NFD", (texto or "").lower())
+        if unicodedata.category(c) != "Mn"
+    )
+
+
+def _argumento(nombre, esquema):
+    """Valor plausible para un parámetro de function calling."""
+    tipo = esquema.get("type")
+    if "fecha" in nombre:
+        return (date.today() + timedelta(days=1)).isoformat()
+    if "hora" in nombre:
+        return "17:00"
+    if "servicio" in nombre:
+        return "General"
+    if esquema.get("enum"):
+        return esquema["enum"][0]
+    return {"number": 1, "integer": 1, "boolean": True, "array": [], "object": {}}.get(tipo, "")
+
+
+class FakeOpenAI(ServidorFake):
+    """POST /v1/chat/completions y /v1/embeddings con respuestas enlatadas."""
+
+    def __init__(self, latencia_chat_ms=0, latencia_embeddings_ms=0, dimensiones=1536, responder=None, puerto=0):
+        super().__init__(latencia_chat_ms, puerto)
+        self.latencia_embeddings_ms = latencia_embeddings_ms
+        self.dimensiones = dimensiones
+        # responder(mensajes) -> str | None para sustituir las respuestas enlatadas
+        self.responder = responder
+        self.textos_embebidos = 0
+
+    def manejar(self, metodo, ruta, query, encabezados, cuerpo):
+        if metodo != "POST":
+            return 405, {"error": {"message": f"Método no soportado: {metodo}"}}, {}
+        peticion = json.loads(cuerpo or b"{}")
+        if ruta.endswith("/chat/completions"):
+            self.contar(f"chat {peticion.get('model')}")
+            self.dormir(self.latencia_ms)
+            return 200, self._chat(peticion), {}
+        if ruta.endswith("/embeddings"):
+            self.contar(f"embeddings {peticion.get('model')}")
+            self.dormir(self.latencia_embeddings_ms)
+            return 200, self._embeddings(peticion), {}
+        return 404, {"error": {"message": f"Ruta desconocida: {ruta}"}}, {}
+
+    def _texto(self, mensajes):
+        if self.responder:
+            texto = self.responder(mensajes)
+            if texto is not None:
+                return texto
+        sistema = _normalizar(" ".join(str(m.get("content") or "") for m in mensajes if m.get("role") == "system"))
+        for patron, respuesta in RESPUESTAS_CHAT:
+            if re.search(patron, sistema, re.S):
+                return respuesta
+        ultimo = next((str(m.get("content") or "") for m in reversed(mensajes) if m.get("role") == "user"), "")
+        return RESPUESTAS_GENERICAS[zlib.crc32(ultimo.encode("utf-8")) % len(RESPUESTAS_GENERICAS)]
+
+    def _chat(self, peticion):
+        mensajes = peticion.get("messages") or []
+        mensaje = {"role": "assistant", "content": None}
+        razon = "stop"
+
+        funciones = peticion.get("functions") or [
+            t["function"] for t in peticion.get("tools") or [] if t.get("type") == "function"
+        ]
+        if funciones:
+            elegida = peticion.get("function_call") or peticion.get("tool_choice")
+            nombre = elegida.get("name") or (elegida.get("function") or {}).get("name") if isinstance(elegida, dict) else None
+            funcion = next((f for f in funciones if f.get("name") == nombre), funciones[0])
+            propiedades = (funcion.get("parameters") or {}).get("properties") or {}
+            argumentos = json.dumps({k: _argumento(k, v) for k, v in propiedades.items()}, ensure_ascii=False)
+            if peticion.get("tools"):
+                mensaje["tool_calls"] = [{
+                    "id": f"call_{uuid.uuid4().hex[:12]}", "type": "function",
+                    "function": {"name": funcion["name"], "arguments": argumentos}
+                }]
+                razon = "tool_calls"
+            else:
+                mensaje["function_call"] = {"name": funcion["name"], "arguments": argumentos}
+                razon = "function_call"
+        else:
+            mensaje["content"] = self._texto(mensajes)
+
+        entrada = sum(len(str(m.get("content") or "")) for m in mensajes) // 4
+        salida = len(mensaje["content"] or "") // 4
+        return {
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": peticion.get("model"),
+            "choices": [{"index": 0, "message": mensaje, "finish_reason": razon, "logprobs": None}],
+            "usage": {"prompt_tokens": entrada, "completion_tokens": salida, "total_tokens": entrada + salida},
+        }
+
+    def vector(self, texto):
+        """Embedding determinista y normalizado: el mismo texto da el mismo vector."""
+        aleatorio = random.Random(zlib.crc32(texto.encode("utf-8")))
+        vector = [aleatorio.gauss(0, 1) for _ in range(self.dimensiones)]
+        norma = sum(v * v for v in vector) ** 0.5 or 1.0
+        return [v / norma for v in vector]
+
+    def _embeddings(self, peticion):
+        entradas = peticion.get("input")
+        entradas = [entradas] if isinstance(entradas, str) else list(entradas or [])
+        en_base64 = peticion.get("encoding_format") == "base64"
+        self.contar("textos_embebidos", len(entradas))
+        datos = []
+        for i, texto in enumerate(entradas):
+            vector = self.vector(texto if isinstance(texto, str) else json.dumps(texto))
+            if en_base64:
+                # El SDK v1 pide base64 por defecto: float32 little-endian
+                vector = base64.b64encode(struct.pack(f"<{len(vector)}f", *vector)).decode("ascii")
+            datos.append({"object": "embedding", "index": i, "embedding": vector})
+        tokens = sum(len(str(t)) for t in entradas) // 4
+        return {
+            "object": "list",
+            "data": datos,
+            "model": peticion.get("model"),
+            "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+        }
+
+
+# === Twilio / Messenger ===
+class FakeTwilio(ServidorFake):
+    """
+    Messages.json de Twilio y /me/messages de la Graph API. Guarda cada
+    envío (con su instante en time.monotonic) y despierta a quien espera
+    respuestas para ese destino.
+    """
+
+    def __init__(self, latencia_ms=0, tasa_429=0.0, puerto=0):
+        super().__init__(latencia_ms, puerto)
+        self.tasa_429 = tasa_429
+        self.enviados = []
+        self._por_destino = {}
+        self._condicion = threading.Condition()
+
+    def manejar(self, metodo, ruta, query, encabezados, cuerpo):
+        self.dormir(self.latencia_ms)
+        if metodo != "POST":
+            return 405, {"message": f"Método no soportado: {metodo}"}, {}
+        if self.tasa_429 and random.random() < self.tasa_429:
+            self.contar("429")
+            return 429, {"code": 20429, "message": "Too Many Requests"}, {"Retry-After": "1"}
+
+        if ruta.endswith("/Messages.json"):
+            formulario = parse_qsl(cuerpo.decode("utf-8"), keep_blank_values=True)
+            datos = dict(formulario)
+            sid = f"SM{uuid.uuid4().hex}"
+            self._registrar({
+                "canal": "whatsapp", "id": sid, "to": datos.get("To", ""), "from": datos.get("From", ""),
+                "body": datos.get("Body", ""), "media_url": datos.get("MediaUrl"),
+                "persistent_action": [v for k, v in formulario if k == "PersistentAction"],
+            })
+            return 201, {"sid": sid, "status": "queued", "to": datos.get("To"), "from": datos.get("From"),
+                         "body": datos.get("Body")}, {}
+
+        if ruta.endswith("/me/messages"):
+            datos = json.loads(cuerpo or b"{}")
+            destino = (datos.get("recipient") or {}).get("id", "")
+            mid = f"m_{uuid.uuid4().hex}"
+            self._registrar({
+                "canal": "messenger", "id": mid, "to": destino, "from": "messenger",
+                "body": (datos.get("message") or {}).get("text", ""),
+            })
+            return 200, {"recipient_id": destino, "message_id": mid}, {}
+
+        return 404, {"message": f"Ruta desconocida: {ruta}"}, {}
+
+    def _registrar(self, envio):
+        envio["t"] = time.monotonic()
+        destino = envio["to"].split(":")[-1]
+        self.contar(envio["canal"])
+        with self._condicion:
+            self.enviados.append(envio)
+            self._por_destino.setdefault(destino, []).append(envio)
+            self._condicion.notify_all()
+
+    def enviados_a(self, destino):
+        with self._condicion:
+            return list(self._por_destino.get(destino.split(":")[-1], []))
+
+    def esperar(self, destino, ya_vistos=0, timeout=30):
+        """Espera el envío número ya_vistos+1 a `destino`; devuelve el envío o None si se agotó el timeout."""
+        destino = destino.split(":")[-1]
+        with self._condicion:
+            listo = self._condicion.wait_for(
+                lambda: len(self._por_destino.get(destino, [])) > ya_vistos, timeout=timeout
+            )
+            return self._por_destino[destino][ya_vistos] if listo else None
+
+
+# === Todo junto ===
+class Fakes:
+    def __init__(self, postgrest, openai, twilio):
+        self.postgrest = postgrest
+        self.openai = openai
+        self.twilio = twilio
+
+    def entorno(self):
+        """Variables para que los clientes reales apunten a los fakes (aplicar antes de importar el bot)."""
+        return {
+            "SUPABASE_URL": self.postgrest.url,
+            "SUPABASE_SERVICE_ROLE_KEY": CLAVE_SUPABASE_FAKE,
+            "OPENAI_API_KEY": "sk-fake",
+            "OPENAI_BASE_URL": f"{self.openai.url}/v1",
+            "TWILIO_ACCOUNT_SID": TWILIO_SID_FAKE,
+            "TWILIO_AUTH_TOKEN": "fake",
+            "TWILIO_WHATSAPP_NUMBER": TWILIO_NUMERO_FAKE,
+            "TWILIO_API_URL": self.twilio.url,
+            "FB_GRAPH_URL": self.twilio.url,
+            "FB_PAGE_ACCESS_TOKEN": "fake",
+        }
+
+    def contadores(self):
+        return {
+            "postgrest": dict(self.postgrest.contadores),
+            "openai": dict(self.openai.contadores),
+            "twilio": dict(self.twilio.contadores),
+        }
+
+    def reiniciar_contadores(self):
+        for fake in (self.postgrest, self.openai, self.twilio):
+            fake.reiniciar_contadores()
+
+    def detener(self):
+        for fake in (self.postgrest, self.openai, self.twilio):
+            fake.detener()
+
+
+# ✅ Levanta los tres fakes (puertos libres, o puerto_base, +1, +2)
+def levantar_fakes(latencia_chat_ms=0, latencia_embeddings_ms=0, latencia_postgrest_ms=0,
+                   latencia_twilio_ms=0, tasa_429=0.0, puerto_base=0):
+    puerto = (lambda i: puerto_base + i) if puerto_base else (lambda i: 0)
+    return Fakes(
+        FakePostgrest(latencia_postgrest_ms, puerto=puerto(0)).iniciar(),
+        FakeOpenAI(latencia_chat_ms, latencia_embeddings_ms, puerto=puerto(1)).iniciar(),
+        FakeTwilio(latencia_twilio_ms, tasa_429, puerto=puerto(2)).iniciar(),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fakes locales de PostgREST, OpenAI y Twilio")
+    parser.add_argument("--puerto", type=int, default=9100, help="PostgREST en este puerto, OpenAI +1, Twilio +2")
+    parser.add_argument("--latencia-chat-ms", type=float, default=float(os.getenv("FAKE_OPENAI_LATENCIA_MS", 0)))
+    parser.add_argument("--latencia-embeddings-ms", type=float, default=0)
+    parser.add_argument("--latencia-postgrest-ms", type=float, default=0)
+    parser.add_argument("--latencia-twilio-ms", type=float, default=0)
+    parser.add_argument("--tasa-429", type=float, default=0.0)
+    args = parser.parse_args()
+
+    fakes = levantar_fakes(args.latencia_chat_ms, args.latencia_embeddings_ms, args.latencia_postgrest_ms,
+                           args.latencia_twilio_ms, args.tasa_429, args.puerto)
+    for clave, valor in fakes.entorno().items():
+        print(f"export {clave}={valor}")
+    sys.stdout.flush()
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        fakes.detener()
+
+
+if __name__ == "__main__":
+    main()
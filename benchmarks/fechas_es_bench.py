@@ -0,0 +1,102 @@
+"""
+Corpus de mensajes de reserva para el parser local de fechas (fechas_es).
+
+Mide cuántos mensajes resuelve sin LLM, cuántos de esos resuelve mal
+(lo importante: un error confiado agenda una cita equivocada) y cuánto
+tarda cada análisis. Uso: python benchmarks/fechas_es_bench.py
+"""
+import os
+import sys
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fechas_es import extraer_fecha_hora, MEXICO_TZ  # noqa: E402
+
+# Miércoles 9 de julio de 2025, 10:30 en CDMX
+AHORA = datetime(2025, 7, 9, 10, 30, tzinfo=MEXICO_TZ)
+
+# (mensaje, "YYYY-MM-DD HH:MM" esperado, o None si debe ir al LLM;
+# una hora sin am/pm ni "de la tarde"/"temprano" también va al LLM)
+CORPUS = [
+    ("Mañana a las 4pm", "2025-07-10 16:00"),
+    ("el sábado 10am", "2025-07-12 10:00"),
+    ("el sabado a las 10 de la mañana", "2025-07-12 10:00"),
+    ("15 de julio 6 de la tarde", "2025-07-15 18:00"),
+    ("el 15 de julio a las 18:00", "2025-07-15 18:00"),
+    ("pasado mañana a las 5 de la tarde", "2025-07-11 17:00"),
+    ("hoy a las 6:30 pm", "2025-07-09 18:30"),
+    ("quiero una cita el viernes a las 5:30 pm", "2025-07-11 17:30"),
+    ("me gustaría agendar para el lunes a las 12", "2025-07-14 12:00"),
+    ("el domingo al mediodía", "2025-07-13 12:00"),
+    ("mañana en la mañana a las 10", "2025-07-10 10:00"),
+    ("mañana 10 de la mañana", "2025-07-10 10:00"),
+    ("mañana a las 8 de la noche", "2025-07-10 20:00"),
+    ("20/07 a las 16:00", "2025-07-20 16:00"),
+    ("20/07/2025 4pm", "2025-07-20 16:00"),
+    ("1 de agosto a las 9 am", "2025-08-01 09:00"),
+    ("15 de julio de 2026 a las 16 hrs", "2026-07-15 16:00"),
+    ("en 3 días a las 12", "2025-07-12 12:00"),
+    ("para mañana a las 17:00 por favor", "2025-07-10 17:00"),
+    ("RESERVA PARA EL MARTES 8 PM", "2025-07-15 20:00"),
+    ("el miércoles a las 2 de la tarde", "2025-07-16 14:00"),
+    ("mañana temprano a las 7", "2025-07-10 07:00"),
+    ("el sábado tempranito a las 8:30", "2025-07-12 08:30"),
+    ("mañana", None),
+    ("pasado mañana", None),
+    ("el sábado", None),
+    ("a las 4", None),
+    ("mañana o el viernes a las 4", None),
+    ("la otra semana el martes a las 3", None),
+    ("el 15 a las 5", None),
+    ("el fin de semana en la tarde", None),
+    ("en 2 horas", None),
+    ("mañana a las 4 o 5", None),
+    ("el lunes 14 de julio 12 de la noche", None),
+    ("cuando tengan espacio", None),
+    ("mañana a las 4", None),
+    ("pasado mañana a las 11", None),
+    ("hoy a las 9", None),
+    ("¿tienen espacio el jueves a las 7?", None),
+    ("a las cinco y media mañana", None),
+    ("mañana a las once y cuarto", None),
+    ("el viernes a la una", None),
+    ("3 de enero a las 10", None),
+    ("mejor el jueves a las 6", None),
+]
+
+
+def main(repeticiones=200):
+    confiables = correctos = errores_confiados = rechazos_correctos = 0
+    for mensaje, esperado in CORPUS:
+        resultado = extraer_fecha_hora(mensaje, AHORA)
+        obtenido = resultado.fecha_completa.strftime("%Y-%m-%d %H:%M") if resultado.es_confiable() else None
+        if obtenido:
+            confiables += 1
+            if obtenido == esperado:
+                correctos += 1
+            else:
+                errores_confiados += 1
+        elif esperado is None:
+            rechazos_correctos += 1
+        if obtenido != esperado:
+            print(f"✗ {mensaje!r}: esperado {esperado}, obtenido {obtenido} ({resultado!r})")
+
+    inicio = time.perf_counter()
+    for _ in range(repeticiones):
+        for mensaje, _ in CORPUS:
+            extraer_fecha_hora(mensaje, AHORA)
+    microsegundos = (time.perf_counter() - inicio) / (repeticiones * len(CORPUS)) * 1e6
+
+    resolubles = sum(1 for _, esperado in CORPUS if esperado)
+    print(f"Mensajes:               {len(CORPUS)}")
+    print(f"Resueltos sin LLM:      {confiables} ({correctos}/{resolubles} de los resolubles)")
+    print(f"Errores confiados:      {errores_confiados}")
+    print(f"Ambiguos enviados a LLM: {rechazos_correctos}/{len(CORPUS) - resolubles}")
+    print(f"Tiempo por mensaje:     {microsegundos:.1f} µs")
+    return errores_confiados
+
+
+if __name__ == "__main__":
+    sys.exit(1 if main() else 0)
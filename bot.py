@@ -2,92 +2,125 @@ import os
 import re
 import logging
 import unicodedata
-import requests
 import time
 import ast
-import tiktoken
 from datetime import datetime, timedelta, timezone
 from dotenv import load_dotenv
-from flask import Flask, request
-from openai import OpenAI
-from supabase import create_client, Client
-from twilio.rest import Client as TwilioClient
-import numpy as np
+from servicios import supabase, cliente_openai as client, metricas as metricas_servicios, obtener_supabase, obtener_openai
+from arranque import importar_perezoso
+np = importar_perezoso("numpy")  # numpy se carga al primer uso (o en el calentamiento)
 from bot_config import BOT_PLANTILLAS
 from bot_config import obtener_plantilla, validar_plantillas
-from intencion_embeddings import analizar_intencion_con_embeddings
-from kpi import registrar_kpi_evento
+from configuracion_bot import obtener_configuracion_bot, invalidar_configuracion_bot
+from intencion_embeddings import analizar_intencion_con_embeddings, cargar_ejemplos_intencion, generar_embeddings_lote
+from servicio_embeddings import obtener_embedding, obtener_embeddings
+from memoria_usuario import obtener_memoria_usuario, invalidar_memoria_usuario
+from indice_intenciones import obtener_indice
+from indice_fragmentos import obtener_indice_fragmentos, iniciar_sincronizacion_fragmentos
+from contexto_prompt import ensamblar_mensajes, contar_tokens, obtener_encoder
+from almacen_conversaciones import crear_almacen
+from kpi import registrar_kpi_evento, resumen_kpi
 from aprendizaje import guardar_frase_conversion
+from palabras_clave import contiene
 import threading
+import atexit
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 import json
 import difflib
 from dateutil import parser 
 from zoneinfo import ZoneInfo
 from citas_bot import gestionar_reserva, actualizar_estado, manejar_confirmacion_o_zona, iniciar_citas_bot
 from handlers.perfil_comportamiento import actualizar_perfil_comportamiento_usuario
+from cola_mensajes import ColaMensajes
+from coalescedor_mensajes import CoalescedorMensajes
+from trabajos import ColaTrabajos
+from programador_recordatorios import programador_recordatorios
+from plan_ejecucion import PlanEjecucion
+from mensajeria import mensajeria
+from estado_conversacion import cargar_estado_conversacion
+from registro_interacciones import registro_interacciones
+from trazas import trazar, etapa, etiquetar, exportar_prometheus, trazas_lentas
 from flask_cors import CORS
-from flask import Flask, request
+from flask import Flask, Blueprint, request, Response
+from arranque import calentar_en_segundo_plano, esta_listo, estado_arranque
 
 # === Helpers de envío centralizados ===
 
 def send_and_log(user_id, texto, conversation_id=None, tipo="text"):
-    # 1) Envío a WhatsApp
-    twilio_client.messages.create(
-        from_=TWILIO_WHATSAPP_NUMBER,
-        to=f"whatsapp:{user_id}",
-        body=texto
-    )
-    # 2) Log en Supabase
-    supabase.from_("interaction_history").insert({
-        "conversation_id": conversation_id,
-        "sender_role": "bot",
-        "message_type": tipo,
-        "bot_response": texto,
-        "start_time": datetime.now(timezone.utc).isoformat()
-    }).execute()
+    # 1) Envío a WhatsApp (en segundo plano; el Future trae el sid o el error)
+    entrega = mensajeria.enviar(user_id, texto)
+
+    # 2) Log en Supabase (escritura diferida, en lote), solo si el proveedor aceptó el mensaje
+    def registrar(futuro):
+        if futuro.cancelled() or futuro.exception() is not None:
+            return
+        registro_interacciones.insertar({
+            "conversation_id": conversation_id,
+            "sender_role": "bot",
+            "message_type": tipo,
+            "bot_response": texto,
+            "start_time": datetime.now(timezone.utc).isoformat()
+        })
+
+    entrega.add_done_callback(registrar)
+    return entrega
 
 MEXICO_TZ = ZoneInfo("America/Mexico_City")
-ahora_mx = datetime.now(MEXICO_TZ)
-fecha_actual_str = ahora_mx.strftime("%A %d de %B de %Y")
-hora_actual_str = ahora_mx.strftime("%H:%M")
 
 
 # Cargar variables de entorno
 load_dotenv()
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 #TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
-SUPABASE_URL = os.getenv("SUPABASE_URL")
-SUPABASE_KEY = os.getenv("SUPABASE_SERVICE_ROLE_KEY")
-TWILIO_SID = os.getenv("TWILIO_ACCOUNT_SID")
-TWILIO_AUTH = os.getenv("TWILIO_AUTH_TOKEN")
-TWILIO_WHATSAPP_NUMBER = os.getenv("TWILIO_WHATSAPP_NUMBER")
 FB_VERIFY_TOKEN = os.getenv("FB_VERIFY_TOKEN")
-twilio_client = TwilioClient(TWILIO_SID, TWILIO_AUTH)
-
-if os.getenv("ENV") == "development":
-    print("🧪 Validando integridad de plantillas...")
-    validar_plantillas()
 
-
-# Inicializar servicios
-client = OpenAI(api_key=OPENAI_API_KEY)
+# Inicializar servicios (supabase y client son los compartidos de servicios.py: se crean al primer uso)
 #telegram_bot = Bot(token=TELEGRAM_BOT_TOKEN)
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
-app = Flask(__name__)
 logging.basicConfig(level=logging.INFO)
 
-# Estados
-conversations = {}
-estado_usuario = {}
-ultimo_mensaje = {}
 
-# Buffer para juntar mensajes si el usuario escribe en varias partes
-mensaje_buffer = defaultdict(list)
-hora_ultimo_buffer = {}
+# ✅ Reconstruye el historial reciente de una conversación desde interaction_history
+def cargar_historial_interacciones(conversation_id, max_mensajes=40):
+    try:
+        res = supabase.from_("interaction_history")\
+            .select("sender_role, user_message, bot_response")\
+            .eq("conversation_id", conversation_id)\
+            .order("start_time", desc=True)\
+            .limit(max_mensajes)\
+            .execute()
+    except Exception as e:
+        logging.error(f"❌ Error rehidratando historial: {e}")
+        return []
+
+    historial = []
+    for item in reversed(res.data or []):
+        if item.get("sender_role") == "user" and item.get("user_message"):
+            historial.append({"role": "user", "content": item["user_message"]})
+        elif item.get("sender_role") == "bot" and item.get("bot_response"):
+            historial.append({"role": "assistant", "content": item["bot_response"]})
+    return historial
+
+
+# Historial, último mensaje y buffer por usuario (memoria o SQLite compartido, ver ESTADO_BACKEND)
+almacen = crear_almacen(cargar_historial_interacciones)
 
 MINUTOS_PARA_CERRAR = 3
 
+# Recuperación de fragmentos: índice local (memmap) y cuántos candidatos traer
+INDICE_FRAGMENTOS_LOCAL = os.getenv("INDICE_FRAGMENTOS_LOCAL", "true").lower() in ("1", "true", "si", "sí")
+FRAGMENTOS_TOP_K = int(os.getenv("FRAGMENTOS_TOP_K", 50))
+
+# Modo asíncrono del webhook: se responde 200 a Twilio y un pool de workers procesa
+WEBHOOK_ASINCRONO = os.getenv("WEBHOOK_ASINCRONO", "false").lower() in ("1", "true", "si", "sí")
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", 4))
+WEBHOOK_COLA_MAX = int(os.getenv("WEBHOOK_COLA_MAX", 1000))
+
+# Juntar mensajes seguidos de un usuario y responder una sola vez
+COALESCER_MENSAJES = os.getenv("COALESCER_MENSAJES", "false").lower() in ("1", "true", "si", "sí")
+COALESCER_SILENCIO_S = float(os.getenv("COALESCER_SILENCIO_S", 3))
+COALESCER_MAX_FRAGMENTOS = int(os.getenv("COALESCER_MAX_FRAGMENTOS", 5))
+COALESCER_MAX_ESPERA_S = float(os.getenv("COALESCER_MAX_ESPERA_S", 10))
+
 
 
 def guardar_conversacion_si_no_existe(user_id, numero, tipo_negocio="generico"):
@@ -136,26 +169,26 @@ def guardar_mensaje_conversacion(conversation_id, mensaje, sender="user", tipo="
     if file_url:
         insert_data["file_url"] = file_url
 
-    try:
-        nuevo = supabase.from_("interaction_history").insert(insert_data).execute()
-        message_id = nuevo.data[0]["id"] if nuevo.data else None
-        logging.info(f"💬 Mensaje guardado con ID: {message_id}")
-        return message_id
-    except Exception as e:
-        logging.error(f"❌ Error guardando mensaje en interaction_history: {e}")
-        return None
+    # El id llega después en el Future, cuando el lote se escribe
+    return registro_interacciones.insertar(insert_data)
 
 
 def buscar_fragmento_relevante(texto, top_k=3):
     try:
-        # 1. Obtener embedding del texto
-        embedding_res = client.embeddings.create(
-            model="text-embedding-ada-002",
-            input=texto
-        )
-        embedding_vector = embedding_res.data[0].embedding
+        # 1. Obtener embedding del texto (compartido con el resto del mensaje)
+        embedding_vector = obtener_embedding(texto)
+
+        # 2. Índice local: top-k por coseno sin traer filas por la red
+        if INDICE_FRAGMENTOS_LOCAL:
+            indice = obtener_indice_fragmentos()
+            if len(indice):
+                logging.info(f"🔎 Buscando fragmentos en índice local ({len(indice)} fragmentos)...")
+                return [
+                    {"analysis_embedding_text": texto_frag, "similarity": similitud}
+                    for similitud, texto_frag in indice.buscar(embedding_vector, top_k)
+                ]
 
-        # 2. Ejecutar la función RPC simple
+        # 3. Respaldo: función RPC en Supabase
         args_rpc = {
             "query_embedding": embedding_vector,
             "match_count": top_k
@@ -165,7 +198,7 @@ def buscar_fragmento_relevante(texto, top_k=3):
 
         response = supabase.rpc("match_user_files", args_rpc).execute()
 
-        # 3. Validar resultado
+        # 4. Validar resultado
         if not response.data:
             logging.warning("⚠️ No se encontraron fragmentos similares.")
             return []
@@ -182,21 +215,14 @@ def buscar_fragmento_relevante(texto, top_k=3):
         return []
 
 
-def detectar_cierre_conversacion(user_id, msg, ultimo_mensaje, tiempo_inactividad_min=10):
+def detectar_cierre_conversacion(user_id, msg, ultima_actividad, tiempo_inactividad_min=10):
     now = datetime.now()
-    texto = msg.strip().lower()
-    FRASES_CIERRE = [
-        "eso es todo", "sería todo", "me despido", "nos vemos", "adiós",
-        "puedes cerrar la conversación", "no tengo más dudas", "por el momento es todo",
-        "hasta luego", "gracias por tu ayuda", "gracias por la información",
-        "puedes finalizar", "puedes cerrar", "listo", "ya está", "ya quedó", "ok gracias"
-    ]
-    # Si detecta frase de cierre clara, cierra ya
-    if any(f in texto for f in FRASES_CIERRE) and "?" not in texto:
+    # Si detecta frase de cierre clara, cierra ya (frases en palabras_clave.py)
+    if contiene(msg, "cierre") and "?" not in msg:
         return "cerrar_ya"
     # Si hay inactividad
-    if user_id in ultimo_mensaje:
-        inactivo_por = now - ultimo_mensaje[user_id]
+    if ultima_actividad:
+        inactivo_por = now - ultima_actividad
         if inactivo_por > timedelta(minutes=tiempo_inactividad_min):
             return "cerrar_ya"
     return "activa"
@@ -235,6 +261,7 @@ Observación: Muestra interés en cotizar un producto.
         return None
 
 
+@etapa("analisis_incremental")
 def generar_analisis_incremental(conversacion):
     try:
         prompt = """
@@ -297,21 +324,30 @@ Tono: [positivo | negativo | neutro]
         )
         return response.choices[0].message.content.strip()
     except Exception as e:
+        # Solo lo usa el trabajo de cierre: que falle para que ColaTrabajos lo reintente
         logging.error(f"Error generando análisis final: {e}")
-        return None
+        raise
 
     
 def clasificar_lead(conversacion, conversation_id):
     try:
-        # Obtener configuración del bot (incluye el contexto correcto)
-        config = obtener_configuracion_bot(conversation_id)
+        return clasificar_lead_openai(conversacion, conversation_id)
+    except Exception as e:
+        logging.error(f"Error clasificando lead: {e}")
+        return "no calificado"
 
-        texto = "\n".join([f"{m['role'].capitalize()}: {m['content']}" for m in conversacion])
 
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": config["contexto"] + """
+# ✅ Igual que clasificar_lead pero deja pasar el error (el trabajo de cierre lo reintenta)
+def clasificar_lead_openai(conversacion, conversation_id):
+    # Obtener configuración del bot (incluye el contexto correcto)
+    config = obtener_configuracion_bot(conversation_id)
+
+    texto = "\n".join([f"{m['role'].capitalize()}: {m['content']}" for m in conversacion])
+
+    response = client.chat.completions.create(
+        model="gpt-3.5-turbo",
+        messages=[
+            {"role": "system", "content": config["contexto"] + """
 
 Ahora, clasifica este usuario como: calificado, medio o no calificado.
 
@@ -321,17 +357,13 @@ Ahora, clasifica este usuario como: calificado, medio o no calificado.
 
 Responde solo con una palabra: calificado, medio o no calificado.
 """},  # Puedes mejorar esta lógica por bot_type si deseas
-                {"role": "user", "content": texto}
-            ],
-            max_tokens=10,
-            temperature=0
-        )
-
-        return response.choices[0].message.content.strip().lower().replace(" ", "_")
+            {"role": "user", "content": texto}
+        ],
+        max_tokens=10,
+        temperature=0
+    )
 
-    except Exception as e:
-        logging.error(f"Error clasificando lead: {e}")
-        return "no calificado"
+    return response.choices[0].message.content.strip().lower().replace(" ", "_")
 
 
 def actualizar_etapa_conversacion(conversation_id, etapa):
@@ -356,35 +388,52 @@ def actualizar_lead_score(conversation_id, score):
         logging.error(f"❌ Error actualizando lead_score: {e}")
 
 
-def reevaluar_lead_score_dinamico(conversation_id, conversacion, user_id):
+def reevaluar_lead_score_dinamico(conversation_id, conversacion, user_id, estado=None):
     try:
-        resultado = supabase.from_("conversation_history")\
-            .select("lead_score")\
-            .eq("conversation_id", conversation_id)\
-            .limit(1)\
-            .execute()
+        # Si ya tenemos la foto de la conversación, no volvemos a consultarla
+        if estado is not None:
+            score_actual = estado.lead_score
+        else:
+            resultado = supabase.from_("conversation_history")\
+                .select("lead_score")\
+                .eq("conversation_id", conversation_id)\
+                .limit(1)\
+                .execute()
+            score_actual = resultado.data[0]["lead_score"] if resultado.data else None
 
-        score_actual = resultado.data[0]["lead_score"] if resultado.data else None
         nuevo_score = clasificar_lead(conversacion, conversation_id).strip().lower().replace(" ", "_")
 
         if nuevo_score and nuevo_score != (score_actual or "").strip().lower().replace(" ", "_"):
-            actualizar_lead_score(conversation_id, nuevo_score)
+            ahora_iso = datetime.now(timezone.utc).isoformat()
+            if estado is not None:
+                estado.actualizar(lead_score=nuevo_score, updated_at=ahora_iso)
+            else:
+                actualizar_lead_score(conversation_id, nuevo_score)
             logging.info(f"🔄 Lead_score actualizado: {score_actual} → {nuevo_score}")
 
             # Evitar sobrescribir etapas clave como 'cotizacion_enviada' o 'seguimiento'
-            etapa_actual = supabase.from_("conversation_history")\
-                .select("etapa_actual")\
-                .eq("conversation_id", conversation_id)\
-               .limit(1).execute()
-            etapa = etapa_actual.data[0]["etapa_actual"] if etapa_actual.data else None
+            if estado is not None:
+                etapa = estado.etapa_actual
+            else:
+                etapa_actual = supabase.from_("conversation_history")\
+                    .select("etapa_actual")\
+                    .eq("conversation_id", conversation_id)\
+                    .limit(1).execute()
+                etapa = etapa_actual.data[0]["etapa_actual"] if etapa_actual.data else None
 
             # Solo cambiar etapa si está en una etapa genérica o inicial
             etapas_bloqueadas = ["cotizacion_enviada", "seguimiento"]
+            nueva_etapa = None
             if etapa not in etapas_bloqueadas:
                 if nuevo_score in ["calificado", "medio"]:
-                    actualizar_etapa_conversacion(conversation_id, "seguimiento")
+                    nueva_etapa = "seguimiento"
                 elif nuevo_score == "no_calificado":
-                    actualizar_etapa_conversacion(conversation_id, "no_calificado")
+                    nueva_etapa = "no_calificado"
+
+            if nueva_etapa and estado is not None:
+                estado.actualizar(etapa_actual=nueva_etapa, updated_at=ahora_iso)
+            elif nueva_etapa:
+                actualizar_etapa_conversacion(conversation_id, nueva_etapa)
 
             # Guardar historial
             try:
@@ -398,6 +447,10 @@ def reevaluar_lead_score_dinamico(conversation_id, conversacion, user_id):
             except Exception as e:
                 logging.warning(f"⚠️ No se pudo guardar historial de score: {e}")
 
+            # La foto del estado ya confirma que la conversación existe
+            if estado is not None and estado.conversation_id:
+                return
+
             # Verifica que exista en conversation_history (fallback defensivo)
             try:
                 existente = supabase.from_("conversation_history")\
@@ -427,19 +480,9 @@ def reevaluar_lead_score_dinamico(conversation_id, conversacion, user_id):
 
 
 def send_messenger_message(sender_id, message):
-    PAGE_ACCESS_TOKEN = os.getenv("FB_PAGE_ACCESS_TOKEN")
-    url = f"https://graph.facebook.com/v17.0/me/messages?access_token={PAGE_ACCESS_TOKEN}"
-    payload = {
-        "recipient": {"id": sender_id},
-        "message": {"text": message}
-    }
-    headers = {"Content-Type": "application/json"}
-    try:
-        r = requests.post(url, json=payload, headers=headers)
-        r.raise_for_status()
-        logging.info(f"✅ Respuesta enviada a Messenger: {message}")
-    except Exception as e:
-        logging.error(f"❌ Error al enviar mensaje a Messenger: {e}")
+    # Los errores (y reintentos) los registra el servicio de mensajería
+    logging.info(f"✅ Respuesta encolada para Messenger: {message}")
+    return mensajeria.enviar(sender_id, message, canal="messenger")
 
 
 def guardar_conversacion_messenger_si_no_existe(user_id, sender_id):
@@ -471,7 +514,6 @@ def guardar_conversacion_messenger_si_no_existe(user_id, sender_id):
 
 
 def construir_fragmento_resumido_por_tokens(fragmentos, max_tokens=7000, modelo="gpt-4"):
-    encoding = tiktoken.encoding_for_model(modelo)
     bloques = []
     bloque_actual = ""
     tokens_actual = 0
@@ -483,7 +525,7 @@ def construir_fragmento_resumido_por_tokens(fragmentos, max_tokens=7000, modelo=
             continue
 
         fragmento_texto = f"[Fragmento del proyecto]\n{contenido.strip()}\n"
-        tokens_fragmento = len(encoding.encode(fragmento_texto))
+        tokens_fragmento = contar_tokens(fragmento_texto, modelo)
 
         if tokens_actual + tokens_fragmento > limite_seguro:
             if bloque_actual:
@@ -512,144 +554,17 @@ def dividir_mensaje_largo(texto, max_chars=1500):
     return partes
 
 
-def obtener_configuracion_bot(_conversation_id=None):
+def generar_seguimiento_contextual(conversation_id, historial_raw=None):
+    """historial_raw: últimas interacciones (más reciente primero) si ya se consultaron."""
     try:
-        config = supabase.from_("bot_configuracion")\
-            .select("bot_type, tipo_negocio, ubicacion, latitud, longitud, contexto, tipo_reservas, negocio, requiere_zona, nombre_bot, zonas_permitidas")\
-            .order("created_at", desc=False)\
-            .limit(1)\
-            .execute()
-
-        if not config.data:
-            raise Exception("❌ No se encontró ninguna configuración del bot")
-
-        datos = config.data[0]
-
-        # Normalizar bot_type a lista
-        bot_types = datos.get("bot_type", [])
-        if not isinstance(bot_types, list):
-            bot_types = [bot_types] if bot_types else ["ventas"]
-
-        tipo_negocio = datos.get("tipo_negocio", "generico")  # ✅ Extraer tipo de negocio
-
-        # ✅ Combinar funciones de todas las plantillas activas
-        funciones_combinadas = set()
-        usa_embeddings = False
-
-        for tipo in bot_types:
-            plantilla = BOT_PLANTILLAS.get(tipo, {})
-            funciones_combinadas.update(plantilla.get("funciones", []))
-            if plantilla.get("usa_embeddings"):
-                usa_embeddings = True
-
-        plantilla_base = {
-            "descripcion": "Bot combinado",
-            "funciones": list(funciones_combinadas)
-        }
-
-        return {
-            "bot_type": bot_types,
-            "tipo_negocio": tipo_negocio,  # ✅ Incluir en retorno
-            "ubicacion": datos.get("ubicacion", ""),
-            "latitud": datos.get("latitud"),
-            "longitud": datos.get("longitud"),
-            "contexto": datos.get("contexto", ""),
-            "tipo_reservas": datos.get("tipo_reservas", "único_horario"),
-            "negocio": datos.get("negocio", "generico"),
-            "requiere_zona": datos.get("requiere_zona", False),
-            "zonas_permitidas": datos.get("zonas_permitidas", ["Salón", "Terraza", "VIP"]),
-            "nombre_bot": datos.get("nombre_bot", "AIDANA"),
-            "prompt": generar_prompt(
-                plantilla_base,
-                datos.get("contexto", ""),
-                datos.get("nombre_bot", "Asistente"),
-                tipo_negocio  # ✅ Pasar tipo_negocio al prompt
-            ),
-            "usa_embeddings": usa_embeddings
-        }
-
-    except Exception as e:
-        logging.error(f"❌ Fallback a ventas. Error: {e}")
-        plantilla = BOT_PLANTILLAS["ventas"]
-        return {
-            "bot_type": ["ventas"],
-            "tipo_negocio": "generico",
-            "ubicacion": "",
-            "latitud": None,
-            "longitud": None,
-            "contexto": "",
-            "tipo_reservas": "único_horario",
-            "negocio": "generico",
-            "requiere_zona": False,
-            "zonas_permitidas": ["Salón", "Terraza", "VIP"],
-            "nombre_bot": "Asistente",
-            "prompt": generar_prompt(plantilla, "", "Asistente", "generico"),
-            "usa_embeddings": plantilla.get("usa_embeddings", False)
-        }
-
-
-
-
-def generar_prompt(plantilla, contexto_extra="", nombre_bot="Asistente", tipo_negocio="generico"):
-    funciones = set(plantilla.get("funciones", []))
-
-    instrucciones = [
-        f"{plantilla['descripcion']} Hola, soy AIDANA, tu asistente virtual de {nombre_bot}."
-        f"Este asistente está diseñado para un negocio tipo '{tipo_negocio}'.",
-        "Actúa siempre con claridad y amabilidad. Tu propósito es asistir al usuario según sus necesidades."
-    ]
-
-    if "agendar_reserva" in funciones:
-        instrucciones.append("- Si el usuario quiere agendar una cita, demo o reserva, pide fecha, hora y zona (si aplica).")
-    if "enviar_recordatorios" in funciones:
-        instrucciones.append("- Envía recordatorios antes de citas si es parte del flujo.")
-    if "cancelar_reserva" in funciones:
-        instrucciones.append("- Si el usuario desea cancelar, confirma y registra la cancelación.")
-    if "post_servicio" in funciones:
-        instrucciones.append("- Después del servicio, puedes solicitar calificación o hacer seguimiento.")
-    if "calificar_leads" in funciones:
-        instrucciones.append("- Si el usuario muestra interés, califícalo como lead y propón el siguiente paso.")
-        instrucciones.append("- Si el usuario muestra interés pero no decide, sugiere de forma amable un siguiente paso como agendar, cotizar o dejar sus datos.")
-        instrucciones.append("- Si pregunta por precios o productos, ofrece ayudar con una propuesta o preguntar si desea más detalles.")
-        instrucciones.append("- Cierra tus respuestas con una acción sugerida siempre que sea posible: '¿Quieres que te envíe una propuesta?', '¿Deseas agendar tu cita ahora?', etc.")
-    if "responder_por_embeddings" in funciones:
-        instrucciones.append("- Si el usuario hace preguntas específicas, usa los documentos entrenados para responder.")
-    if "analizar_archivos" in funciones:
-        instrucciones.append("- Si el usuario sube archivos, puedes analizarlos y dar retroalimentación clara.")
-    if "generar_faq" in funciones:
-        instrucciones.append("- Si detectas una duda frecuente, puedes sugerir una respuesta tipo FAQ.")
-    if "gestionar_tareas" in funciones:
-        instrucciones.append("- Puedes organizar tareas si el usuario lo solicita.")
-    if "crear_recordatorio" in funciones:
-        instrucciones.append("- Puedes programar recordatorios según lo que el usuario diga.")
-    if "dar_seguimiento" in funciones:
-        instrucciones.append("- Puedes dar seguimiento si el usuario no responde o deja algo pendiente.")
-        instrucciones.append("- Si detectas que el usuario quedó en pensar, preguntar o revisar algo, puedes recordarle amablemente después de unos minutos.")
-        instrucciones.append("- Si el usuario pidió info y no ha respondido en un rato, puedes enviar un mensaje como: '¿Tuviste oportunidad de revisarlo? Estoy aquí para ayudarte.'")
-
-    # Instrucciones generales
-    instrucciones.append("- No digas frases genéricas como 'estoy aquí para ayudarte'. Sé directo pero cordial.")
-    instrucciones.append("- Si no tienes suficiente contexto, puedes pedirlo de forma amable.")
-
-    prompt_final = "\n".join(instrucciones).strip()
-
-    if contexto_extra:
-        prompt_final += f"\n\n{contexto_extra.strip()}"
-
-    return prompt_final
-
-
-
-def generar_seguimiento_contextual(conversation_id):
-    try:
-        historial_res = supabase.from_("interaction_history")\
-            .select("sender_role, user_message, bot_response")\
-            .eq("conversation_id", conversation_id)\
-            .order("start_time", desc=True)\
-            .limit(6)\
-            .execute()
-
-        historial_raw = historial_res.data or []
+        if historial_raw is None:
+            historial_res = supabase.from_("interaction_history")\
+                .select("sender_role, user_message, bot_response")\
+                .eq("conversation_id", conversation_id)\
+                .order("start_time", desc=True)\
+                .limit(6)\
+                .execute()
+            historial_raw = historial_res.data or []
 
         historial = []
         for item in reversed(historial_raw):
@@ -687,140 +602,227 @@ No repitas el historial. Solo responde con el mensaje de seguimiento.
         logging.error(f"❌ Error generando seguimiento contextual: {e}")
         return None
 
-def seguimiento_leads_silenciosos():
-    print("⏳ Loop de seguimiento activo")
+# ⏰ Espera mínima antes de dar seguimiento, por lead_score (el resto usa no_calificado)
+TIEMPOS_POR_LEAD_SCORE = {
+    "calificado": timedelta(hours=72),
+    "medio": timedelta(hours=48),
+    "no_calificado": timedelta(hours=24)
+}
+TIEMPO_SEGUIMIENTO_COTIZACION = timedelta(hours=72)  # 3 días
+
+MAX_INTENTOS_SEGUIMIENTO = {
+    "calificado": 3,
+    "medio": 3,
+    "no_calificado": 3
+}
+
+SEGUIMIENTO_PAGINA = int(os.getenv("SEGUIMIENTO_PAGINA", 200))
+# 🧵 Mensajes de seguimiento generados en paralelo; el ritmo de envío lo pone mensajeria (por remitente)
+SEGUIMIENTO_WORKERS = int(os.getenv("SEGUIMIENTO_WORKERS", 8))
+# Conversaciones por llamada a ultimas_interacciones (x 6 filas, por debajo del max-rows de PostgREST)
+SEGUIMIENTO_HISTORIAL_LOTE = 50
+
+executor_seguimiento = ThreadPoolExecutor(max_workers=SEGUIMIENTO_WORKERS, thread_name_prefix="seguimiento")
+
+MENSAJES_SEGUIMIENTO_POR_NEGOCIO = {
+    "restaurante": "🍽️ ¿Te gustaría confirmar tu reserva o consultar disponibilidad?",
+    "clinica": "👩‍⚕️ ¿Tuviste oportunidad de revisar sobre la consulta? Estoy aquí si quieres agendar.",
+    "agencia": "🚗 ¿Te interesa agendar una cita o cotizar un auto? Estoy para ayudarte.",
+    "software": "💻 ¿Pudiste revisar la propuesta? Estoy aquí si tienes dudas o quieres avanzar.",
+    "marketing": "📢 ¿Te gustaría que revisemos juntos una estrategia? Podemos agendar.",
+    "spa": "💆‍♀️ ¿Quieres confirmar tu cita o saber más de nuestros servicios?",
+    "educacion": "📚 ¿Te interesa apartar lugar o ver próximos cursos?",
+    "eventos": "💍 ¿Te gustaría cotizar o reservar tu evento con nosotros?",
+    "ecommerce": "🛒 ¿Pudiste ver los productos? Si necesitas ayuda con tu pedido, dime.",
+    "hotel": "🏨 ¿Aún estás interesado en reservar alojamiento? Podemos ayudarte.",
+    "legal": "⚖️ ¿Puedo asistirte con tu consulta legal o agendarte con un abogado?",
+    "generico": "👋 Solo quería saber si pudiste revisar lo que te compartí. ¿Te gustaría que te ayude con algo más?"
+}
+
+metricas_seguimiento = {
+    "ciclos": 0, "ultimo_ciclo_s": None, "ultimo_ciclo_at": None,
+    "paginas": 0, "filas_leidas": 0, "enviados": 0, "omitidos": 0, "errores": 0
+}
+
+
+def _ts(momento):
+    # Entre comillas: el timestamp lleva ':' y '.', reservados en los filtros or=()
+    return f'"{momento.isoformat()}"'
+
+
+def filtro_leads_vencidos(ahora):
+    """
+    Árbol or=() de PostgREST con las mismas reglas del seguimiento: intentos
+    por debajo del máximo y la última base (seguimiento_enviado_at, o
+    updated_at si nunca se envió) más vieja que la espera de su lead_score.
+    """
+    def base_vencida(espera):
+        limite = _ts(ahora - espera)
+        return f"or(seguimiento_enviado_at.lte.{limite},and(seguimiento_enviado_at.is.null,updated_at.lte.{limite}))"
+
+    conocidos = ",".join(s for s in TIEMPOS_POR_LEAD_SCORE if s != "no_calificado")
+    filtros_score = {s: f"lead_score.eq.{s}" for s in TIEMPOS_POR_LEAD_SCORE if s != "no_calificado"}
+    filtros_score["no_calificado"] = f"or(lead_score.is.null,lead_score.not.in.({conocidos}))"
+
+    ramas = []
+    for score, filtro_score in filtros_score.items():
+        intentos = f"or(intentos_seguimiento.is.null,intentos_seguimiento.lt.{MAX_INTENTOS_SEGUIMIENTO.get(score, 3)})"
+        ramas.append(
+            f"and({filtro_score},{intentos},or(etapa_actual.is.null,etapa_actual.neq.cotizacion_enviada),"
+            f"{base_vencida(TIEMPOS_POR_LEAD_SCORE[score])})"
+        )
+        # Cotización enviada: solo si el booleano está en True, y siempre 3 días
+        ramas.append(
+            f"and({filtro_score},{intentos},etapa_actual.eq.cotizacion_enviada,cotizacion_enviada.is.true,"
+            f"{base_vencida(TIEMPO_SEGUIMIENTO_COTIZACION)})"
+        )
+    return ",".join(ramas)
 
-    mensajes_por_negocio = {
-        "restaurante": "🍽️ ¿Te gustaría confirmar tu reserva o consultar disponibilidad?",
-        "clinica": "👩‍⚕️ ¿Tuviste oportunidad de revisar sobre la consulta? Estoy aquí si quieres agendar.",
-        "agencia": "🚗 ¿Te interesa agendar una cita o cotizar un auto? Estoy para ayudarte.",
-        "software": "💻 ¿Pudiste revisar la propuesta? Estoy aquí si tienes dudas o quieres avanzar.",
-        "marketing": "📢 ¿Te gustaría que revisemos juntos una estrategia? Podemos agendar.",
-        "spa": "💆‍♀️ ¿Quieres confirmar tu cita o saber más de nuestros servicios?",
-        "educacion": "📚 ¿Te interesa apartar lugar o ver próximos cursos?",
-        "eventos": "💍 ¿Te gustaría cotizar o reservar tu evento con nosotros?",
-        "ecommerce": "🛒 ¿Pudiste ver los productos? Si necesitas ayuda con tu pedido, dime.",
-        "hotel": "🏨 ¿Aún estás interesado en reservar alojamiento? Podemos ayudarte.",
-        "legal": "⚖️ ¿Puedo asistirte con tu consulta legal o agendarte con un abogado?",
-        "generico": "👋 Solo quería saber si pudiste revisar lo que te compartí. ¿Te gustaría que te ayude con algo más?"
-    }
 
-    tiempos_por_lead_score = {
-        "calificado": timedelta(hours=72),
-        "medio": timedelta(hours=48),
-        "no_calificado": timedelta(hours=24)
-    }
+# ✅ Solo los leads que ya toca seguir, en páginas por conversation_id (keyset)
+def leads_para_seguimiento(ahora, pagina=SEGUIMIENTO_PAGINA):
+    filtro = filtro_leads_vencidos(ahora)
+    ultimo = None
+    while True:
+        consulta = supabase.from_("conversation_history")\
+            .select("conversation_id, user_id, updated_at, tipo_negocio, lead_score, intentos_seguimiento, cotizacion_enviada_at")\
+            .eq("status", "bot")\
+            .or_(filtro)
+        if ultimo is not None:
+            consulta = consulta.gt("conversation_id", ultimo)
+        filas = consulta.order("conversation_id").limit(pagina).execute().data or []
+
+        metricas_seguimiento["paginas"] += 1
+        metricas_seguimiento["filas_leidas"] += len(filas)
+        if filas:
+            yield filas
+        if len(filas) < pagina:
+            return
+        ultimo = filas[-1]["conversation_id"]
 
-    max_intentos = {
-        "calificado": 3,
-        "medio": 3,
-        "no_calificado": 3
-    }
+
+# ✅ Últimas `cuantas` interacciones por conversación, una llamada por lote (sql/ultimas_interacciones.sql)
+def historiales_para_seguimiento(conversation_ids, cuantas=6):
+    historiales = {}
+    for i in range(0, len(conversation_ids), SEGUIMIENTO_HISTORIAL_LOTE):
+        lote = conversation_ids[i:i + SEGUIMIENTO_HISTORIAL_LOTE]
+        try:
+            filas = supabase.rpc("ultimas_interacciones", {"ids": lote, "cuantas": cuantas}).execute().data or []
+        except Exception as e:
+            # Sin la función en la base: cada seguimiento consulta sus `cuantas` filas por su cuenta
+            logging.warning(f"⚠️ ultimas_interacciones no disponible, historial por conversación: {e}")
+            continue
+        for cid in lote:
+            historiales[cid] = []
+        for fila in filas:
+            historiales[fila["conversation_id"]].append(fila)
+    for historial in historiales.values():
+        historial.sort(key=lambda f: f.get("start_time") or "", reverse=True)
+    return historiales
+
+
+@trazar("seguimiento")
+def _enviar_seguimiento(conv, historial_raw):
+    conversation_id = conv["conversation_id"]
+    user_id = conv["user_id"]
+    etiquetar(conversation_id=conversation_id, usuario=user_id)
+    tipo = conv.get("tipo_negocio") or "generico"
+
+    # 🧠 Intentar generar seguimiento contextual
+    mensaje = generar_seguimiento_contextual(conversation_id, historial_raw)
+    if not mensaje:
+        mensaje = MENSAJES_SEGUIMIENTO_POR_NEGOCIO.get(tipo, MENSAJES_SEGUIMIENTO_POR_NEGOCIO["generico"])
+        logging.warning(f"⚠️ Usando mensaje genérico para seguimiento a {user_id}")
+
+    # 📤 Enviar mensaje y loguear (mensajeria limita la tasa por remitente)
+    send_and_log(user_id, mensaje, conversation_id, tipo="text").result()
+    logging.info(f"📬 Seguimiento enviado a {user_id} (intento #{(conv.get('intentos_seguimiento') or 0) + 1})")
+
+
+# ✅ Una página de leads: historiales en lote, mensajes en paralelo y estado en lote
+def despachar_seguimientos(pagina, ahora):
+    leads = []
+    for conv in pagina:
+        # 🛑 Usuario ya respondió después de la cotización
+        cotizacion_enviada_at = conv.get("cotizacion_enviada_at")
+        if cotizacion_enviada_at and parser.isoparse(conv["updated_at"]) > parser.isoparse(cotizacion_enviada_at):
+            logging.info(f"🛑 Usuario {conv['user_id']} ya respondió después de la cotización. No se enviará seguimiento.")
+            metricas_seguimiento["omitidos"] += 1
+            continue
+        leads.append(conv)
+    if not leads:
+        return
+
+    historiales = historiales_para_seguimiento([c["conversation_id"] for c in leads])
+    futuros = [
+        (conv, executor_seguimiento.submit(_enviar_seguimiento, conv, historiales.get(conv["conversation_id"])))
+        for conv in leads
+    ]
+
+    # intentos nuevos -> conversaciones; un update por grupo
+    enviados = {}
+    for conv, futuro in futuros:
+        try:
+            futuro.result()
+        except Exception as e:
+            logging.error(f"❌ Error enviando seguimiento a {conv['user_id']}: {e}")
+            metricas_seguimiento["errores"] += 1
+            continue
+        intentos = (conv.get("intentos_seguimiento") or 0) + 1
+        enviados.setdefault(intentos, []).append(conv["conversation_id"])
+        metricas_seguimiento["enviados"] += 1
+
+    # 📝 Registrar seguimiento
+    for intentos, conversation_ids in enviados.items():
+        supabase.from_("conversation_history").update({
+            "seguimiento_enviado_at": ahora.isoformat(),
+            "intentos_seguimiento": intentos
+        }).in_("conversation_id", conversation_ids).execute()
+
+
+def seguimiento_leads_silenciosos():
+    print("⏳ Loop de seguimiento activo")
 
     while True:
+        inicio = time.monotonic()
         try:
             ahora = datetime.now(timezone.utc)
 
-            resultado = supabase.from_("conversation_history")\
-                .select("conversation_id, user_id, updated_at, status, etapa_actual, tipo_negocio, lead_score, seguimiento_enviado_at, intentos_seguimiento, cotizacion_enviada_at, cotizacion_enviada")\
-                .eq("status", "bot")\
-                .execute()
-
-            for conv in resultado.data or []:
-                conversation_id = conv["conversation_id"]
-                user_id = conv["user_id"]
-                tipo = conv.get("tipo_negocio", "generico")
-                etapa = conv.get("etapa_actual", "nuevo")
-                lead_score = conv.get("lead_score", "no_calificado")
-                seguimiento_at = conv.get("seguimiento_enviado_at")
-                intentos = conv.get("intentos_seguimiento", 0) or 0
-                ultima_interaccion = parser.isoparse(conv["updated_at"])
-                cotizacion_enviada = conv.get("cotizacion_enviada", False)  # <-- SUMADO
-
-                # ⛔️ Si ya superó los intentos para su tipo
-                if intentos >= max_intentos.get(lead_score, 3):
-                    continue
-
-                # ⏰ Tiempo mínimo de espera por lead
-                tiempo_minimo = tiempos_por_lead_score.get(lead_score, timedelta(hours=24))
-                if etapa == "cotizacion_enviada":
-                    # SOLO hacer seguimiento si el booleano está en True
-                    if not cotizacion_enviada:
-                        continue  # 🔴 Salta si la cotización NO fue marcada como enviada
-                    tiempo_minimo = timedelta(hours=72)  # 3 días
-
-                # ⏱️ Verificar si ya pasó suficiente tiempo
-                ultima_base = parser.isoparse(seguimiento_at) if seguimiento_at else ultima_interaccion
-                if ahora - ultima_base < tiempo_minimo:
-                    continue
-
-                # 🛑 Usuario ya respondió después de la cotización
-                cotizacion_enviada_at = conv.get("cotizacion_enviada_at")
-                if cotizacion_enviada_at:
-                    cotizacion_time = parser.isoparse(cotizacion_enviada_at)
-                    if ultima_interaccion > cotizacion_time:
-                        logging.info(f"🛑 Usuario {user_id} ya respondió después de la cotización. No se enviará seguimiento.")
-                        continue
-
-                # 🧠 Intentar generar seguimiento contextual
-                mensaje = generar_seguimiento_contextual(conversation_id)
-                if not mensaje:
-                    mensaje = mensajes_por_negocio.get(tipo, mensajes_por_negocio["generico"])
-                    logging.warning(f"⚠️ Usando mensaje genérico para seguimiento a {user_id}")
-
-                 # 📤 Enviar mensaje y loguear
-                send_and_log(user_id, mensaje, conversation_id, tipo="text")
-                logging.info(f"📬 Seguimiento enviado a {user_id} (intento #{intentos + 1})")
-
-                # 📝 Registrar seguimiento
-                supabase.from_("conversation_history").update({
-                    "seguimiento_enviado_at": ahora.isoformat(),
-                    "intentos_seguimiento": intentos + 1
-                }).eq("conversation_id", conversation_id).execute()
+            # El filtro de intentos y tiempos ya lo aplicó la consulta
+            for pagina in leads_para_seguimiento(ahora):
+                despachar_seguimientos(pagina, ahora)
 
         except Exception as e:
             logging.error(f"❌ Error en seguimiento a leads silenciosos: {e}")
 
+        metricas_seguimiento["ciclos"] += 1
+        metricas_seguimiento["ultimo_ciclo_s"] = round(time.monotonic() - inicio, 3)
+        metricas_seguimiento["ultimo_ciclo_at"] = datetime.now(timezone.utc).isoformat()
+        logging.info(f"📊 Ciclo de seguimiento: {metricas_seguimiento['ultimo_ciclo_s']}s")
+
         time.sleep(1800)  # ⏳ Esperar 30 minutos
 
 
 
 def es_intencion_de_reservar(texto):
-    texto = texto.lower()
-    palabras_clave = [
-        "reservar", "reserva", "agendar", "quiero una cita",
-        "quiero hacer una cita", "quiero hacer una reserva",
-        "agenda", "necesito una cita", "quiero agendar",
-        "me puedes apartar", "quiero una mesa", "hacer cita"
-    ]
-    return any(palabra in texto for palabra in palabras_clave)
+    return contiene(texto, "reserva")
+
+EJEMPLOS_INTENCION_RESERVA = [
+    "quiero reservar una cita",
+    "cómo agendo una consulta",
+    "necesito un turno para mañana",
+    "quisiera apartar una hora",
+    "cómo hago una reserva"
+]
 
 def es_intencion_reserva_por_embeddings(texto, threshold=0.80):
     try:
-        embedding_usuario = client.embeddings.create(
-            model="text-embedding-ada-002",
-            input=texto
-        ).data[0].embedding
-
-        ejemplos_intencion = [
-            "quiero reservar una cita",
-            "cómo agendo una consulta",
-            "necesito un turno para mañana",
-            "quisiera apartar una hora",
-            "cómo hago una reserva"
-        ]
+        embedding_usuario = obtener_embedding(texto)
 
-        ejemplos_embeddings = client.embeddings.create(
-            model="text-embedding-ada-002",
-            input=ejemplos_intencion
-        ).data
-
-        for ej in ejemplos_embeddings:
-            emb_ejemplo = ej.embedding
-            similitud = cosine_similarity(embedding_usuario, emb_ejemplo)
-            if similitud >= threshold:
-                return True
-        return False
+        # Los ejemplos se embeben una sola vez y se guardan normalizados en disco
+        indice = obtener_indice("reserva", "base", EJEMPLOS_INTENCION_RESERVA, obtener_embeddings)
+        _, similitud = indice.mejor_coincidencia(embedding_usuario)
+        return similitud >= threshold
 
     except Exception as e:
         logging.error(f"❌ Error usando embeddings para intención de reserva: {e}")
@@ -883,16 +885,10 @@ def obtener_funciones_disponibles(bot_type):
 
 
 def obtener_historial_contexto(user_id, max_mensajes=40):
-    return conversations.get(user_id, [])[-max_mensajes:]
+    return (almacen.obtener_historial(user_id) or [])[-max_mensajes:]
 
 def es_intencion_reagendar(texto):
-    texto = texto.lower()
-    frases = [
-        "cambiar mi cita", "modificar mi cita", "reagendar", "reprogramar", 
-        "mover la cita", "cambiar la hora", "otra hora", "otra fecha", 
-        "cambiar fecha", "nueva fecha", "nueva hora", "ajustar cita", "editar cita"
-    ]
-    return any(frase in texto for frase in frases)
+    return contiene(texto, "reagendar")
 
 
 def obtener_reserva_activa(user_id):
@@ -913,6 +909,8 @@ def actualizar_reserva(reserva_id, nuevos_datos):
     try:
         resultado = supabase.from_("reservaciones").update(nuevos_datos)\
             .eq("id", reserva_id).execute()
+        for fila in resultado.data or []:
+            programador_recordatorios.programar(fila)
         logging.info(f"🔁 Reserva ACTUALIZADA (ID: {reserva_id}) con datos: {nuevos_datos}")
         return True
     except Exception as e:
@@ -924,25 +922,14 @@ def actualizar_reserva(reserva_id, nuevos_datos):
 
 
 def procesar_buffer_usuario(user_id, nuevo_mensaje, ventana=10, max_mensajes=3):
-    ahora = datetime.now()
-    ultimo = hora_ultimo_buffer.get(user_id)
-
-    # Si pasó mucho tiempo desde el último → reiniciamos buffer
-    if not ultimo or (ahora - ultimo).seconds > ventana:
-        mensaje_buffer[user_id] = [nuevo_mensaje]
-    else:
-        mensaje_buffer[user_id].append(nuevo_mensaje)
-
-    hora_ultimo_buffer[user_id] = ahora
+    fragmentos = almacen.agregar_a_buffer(user_id, nuevo_mensaje, datetime.now(), ventana)
 
     # Si ya se juntaron suficientes mensajes, fusionamos y reiniciamos
-    if len(mensaje_buffer[user_id]) >= max_mensajes:
-        mensaje_completo = " ".join(mensaje_buffer[user_id]).strip()
-        mensaje_buffer[user_id] = []
-        return mensaje_completo
+    if len(fragmentos) >= max_mensajes:
+        almacen.vaciar_buffer(user_id)
 
     # Si no hemos llegado al límite, solo mostramos el acumulado (pero no reiniciamos)
-    return " ".join(mensaje_buffer[user_id]).strip()
+    return " ".join(fragmentos).strip()
 
 
 
@@ -1008,11 +995,7 @@ Interés en SUV, menciona presupuesto ajustado, desea agendar prueba. Usa lengua
         logging.info(f"📝 Resumen generado: {resumen}")
 
         # 5. Generar embedding
-        embedding_response = client.embeddings.create(
-            model="text-embedding-ada-002",
-            input=resumen
-        )
-        vector = embedding_response.data[0].embedding
+        vector = obtener_embedding(resumen)
 
         # 6. Guardar en Supabase
         supabase.from_("user_summary_embeddings").insert({
@@ -1020,53 +1003,54 @@ Interés en SUV, menciona presupuesto ajustado, desea agendar prueba. Usa lengua
             "resumen_texto": resumen,
             "embedding_vector": vector
         }).execute()
+        invalidar_memoria_usuario(user_id)
 
         logging.info(f"🧠 Resumen global de usuario guardado para {user_id}")
 
     except Exception as e:
         logging.error(f"❌ Error generando memoria del usuario: {e}")
+        raise
 
 
 
-def obtener_memoria_usuario(user_id, cuantos=3):
-    try:
-        resultado = supabase.from_("user_summary_embeddings")\
-            .select("resumen_texto, created_at")\
-            .eq("user_id", user_id)\
-            .order("created_at", desc=True)\
-            .limit(cuantos)\
-            .execute()
-        # Junta los resúmenes de más nuevo a más viejo
-        if resultado.data:
-            return "\n".join([r["resumen_texto"] for r in reversed(resultado.data)])
-        return None
-    except Exception as e:
-        logging.error(f"❌ Error obteniendo memoria del usuario: {e}")
+# --- 💡 PERFIL DE COMPORTAMIENTO ---
+def construir_perfil_texto(user_id):
+    perfil = obtener_perfil_comportamiento_usuario(user_id)
+    if not perfil:
         return None
+    return f"""
+        Perfil histórico del usuario:
+        Lead score promedio: {perfil.get('lead_score_promedio', 'N/A')}
+        Frases de interés: {perfil.get('frases_interes', 'N/A')}
+        Estilo: {perfil.get('estilo_mensaje', 'N/A')}
+        Días activo: {perfil.get('dias_activo', 'N/A')}
+        """
 
 
+# 🧠 Devuelve la memoria previa del usuario solo si se parece al mensaje actual
+def evaluar_memoria_usuario(user_id, msg):
+    # Resúmenes y sus vectores ya guardados: solo se embebe el mensaje (compartido)
+    memoria_usuario = obtener_memoria_usuario(user_id, cuantos=3)
+    if not memoria_usuario:
+        return None
+    try:
+        # 🧮 Calcular similitud contra el centroide de los resúmenes
+        similitud = memoria_usuario.similitud(obtener_embedding(msg))
 
-def detectar_intencion_directa(texto, tipo):
-    texto_normalizado = ''.join(
-        c for c in unicodedata.normalize('NFD', texto.lower())
-        if unicodedata.category(c) != 'Mn'
-    )
+        logging.info(f"📊 Similitud con memoria previa: {similitud:.2f}")
 
-    patrones = {
-        "ubicacion": [
-            "ubicacion", "direccion", "donde estan", "donde se ubican",
-            "estan ubicados", "me puede mandar la ubicacion", "donde se encuentran"
-        ],
-        "horarios": [
-            "horario", "a que hora", "cuando abren", "cuando cierran",
-            "cual es su horario", "estan abiertos"
-        ],
-        "precios": [
-            "precio", "cuanto cuesta", "tienen precios", "tarifas", "costo", "vale"
-        ]
-    }
+        if similitud > 0.65:
+            logging.info("🧠 Memoria insertada como contexto útil")
+            return f"Contexto previo del usuario:\n{memoria_usuario.texto}"
+        logging.info("🧠 Memoria omitida (similitud baja)")
+    except Exception as e:
+        logging.error(f"❌ Error evaluando similitud con memoria: {e}")
+    return None
 
-    return any(p in texto_normalizado for p in patrones.get(tipo, []))
+
+def detectar_intencion_directa(texto, tipo):
+    # tipo: "ubicacion", "horarios" o "precios" (frases en palabras_clave.py)
+    return contiene(texto, tipo)
 
 def enviar_ubicacion(usuario_id: str, ubicacion: str, lat: float = None, lng: float = None, conversation_id: str = None, config: dict = {}):
     try:
@@ -1077,21 +1061,16 @@ def enviar_ubicacion(usuario_id: str, ubicacion: str, lat: float = None, lng: fl
 
             mensaje_mapa = "🗺️ Da clic aquí para abrir el mapa:"
             # 2) Este queda directo porque necesita la acción geo
-            twilio_client.messages.create(
-                from_=TWILIO_WHATSAPP_NUMBER,
-                to=f"whatsapp:{usuario_id}",
-                persistent_action=[f"geo:{lat},{lng}|{ubicacion}"],
-                body=mensaje_mapa
-            )
+            mensajeria.enviar(usuario_id, mensaje_mapa, persistent_action=[f"geo:{lat},{lng}|{ubicacion}"])
             # y lo logueas manualmente como tipo "location":
-            supabase.from_("interaction_history").insert({
+            registro_interacciones.insertar({
                 "conversation_id": conversation_id,
                 "sender_role": "bot",
                 "message_type": "location",
                 "bot_response": mensaje_mapa,
                 "file_url": f"https://www.google.com/maps?q={lat},{lng}",
                 "start_time": datetime.now(timezone.utc).isoformat()
-            }).execute()
+            })
 
         else:
             mensaje_texto = f"📍 Nuestra dirección es:\n{ubicacion}"
@@ -1157,15 +1136,35 @@ def responder_y_salir(user_id: str, mensaje: str, conversation_id: str = None):
     return "ok", 200
 
 
-def manejar_cierre_conversacion(user_id, msg, conversation_id, conversations, supabase):
-    final = generar_analisis_final_openai(conversations[user_id])
-    lead_score = clasificar_lead(conversations[user_id], conversation_id)
-    actualizar_perfil_comportamiento_usuario(user_id, conversation_id)
-    guardar_resumen_usuario(user_id, conversation_id)
+@etapa("cierre")
+def manejar_cierre_conversacion(user_id, msg, conversation_id, historial, supabase):
+    # La conversación queda cerrada ya; el análisis pesado se hace en segundo plano
+    supabase.from_("conversation_history").update({
+        "status": "finalizado",
+        "updated_at": datetime.now(timezone.utc).isoformat()
+    }).eq("conversation_id", conversation_id).execute()
+
+    # Perfil y resumen releen interaction_history: el último mensaje y la respuesta deben estar escritos
+    registro_interacciones.vaciar()
+
+    cola_trabajos.encolar("cierre_analisis_final", conversation_id=conversation_id, historial=historial)
+    cola_trabajos.encolar("cierre_clasificar_lead", user_id=user_id, msg=msg, conversation_id=conversation_id, historial=historial)
+    cola_trabajos.encolar("cierre_perfil_comportamiento", user_id=user_id, conversation_id=conversation_id)
+    cola_trabajos.encolar("cierre_resumen_usuario", user_id=user_id, conversation_id=conversation_id)
+    logging.info(f"🧰 Cierre de conversación {conversation_id} encolado")
+
 
+def trabajo_analisis_final(conversation_id, historial):
+    final = generar_analisis_final_openai(historial)
     supabase.from_("conversation_history").update({
         "final_analysis": final,
-        "status": "finalizado",
+        "updated_at": datetime.now(timezone.utc).isoformat()
+    }).eq("conversation_id", conversation_id).execute()
+
+
+def trabajo_clasificar_lead(user_id, msg, conversation_id, historial):
+    lead_score = clasificar_lead_openai(historial, conversation_id)
+    supabase.from_("conversation_history").update({
         "lead_score": lead_score,
         "updated_at": datetime.now(timezone.utc).isoformat()
     }).eq("conversation_id", conversation_id).execute()
@@ -1175,21 +1174,26 @@ def manejar_cierre_conversacion(user_id, msg, conversation_id, conversations, su
     elif lead_score == "no_calificado":
         actualizar_etapa_conversacion(conversation_id, "no_calificado")
 
+    # Lo que no se puede repetir va en su propio trabajo y al final: si algo de arriba
+    # falla y este se reintenta, la frase y el KPI aún no se registraron
     if lead_score in ["calificado", "medio"]:
-        guardar_frase_conversion(user_id, msg, tipo="lead_calificado")
-        registrar_kpi_evento(
-            conversation_id=conversation_id,
-            tipo_evento="lead_calificado",
-            user_id=user_id
-        )
+        cola_trabajos.encolar("cierre_conversion_lead", user_id=user_id, msg=msg, conversation_id=conversation_id)
 
     logging.info(f"📊 Lead clasificado como {lead_score} y etapa registrada.")
     return lead_score
 
 
+def trabajo_conversion_lead(user_id, msg, conversation_id):
+    guardar_frase_conversion(user_id, msg, tipo="lead_calificado")
+    registrar_kpi_evento(
+        conversation_id=conversation_id,
+        tipo_evento="lead_calificado",
+        user_id=user_id
+    )
+
+
 def manejar_mensaje_promocional(user_id, mensaje_normalizado, conversation_id=None):
-    palabras_clave = ["promocion", "promo", "descuento", "oferta", "rebaja"]
-    if any(palabra in mensaje_normalizado for palabra in palabras_clave):
+    if contiene(mensaje_normalizado, "promocion"):
         archivos = obtener_ultimos_archivos(user_id)
         for archivo in archivos:
             texto_extraido = archivo.get("embedding_vector", "")
@@ -1201,33 +1205,32 @@ def manejar_mensaje_promocional(user_id, mensaje_normalizado, conversation_id=No
     return False
 
 def analizar_mensaje_individual(msg, message_id):
+    """message_id puede ser el Future de guardar_mensaje_conversacion."""
     try:
         single_analysis = generar_analisis_mensaje_unico(msg)
         if single_analysis:
-            supabase.from_("interaction_history").update({
-                "analysis_result": single_analysis
-            }).eq("id", message_id).execute()
-
-            embedding_response = client.embeddings.create(
-                model="text-embedding-ada-002",
-                input=msg
-            )
-            embedding_vector = embedding_response.data[0].embedding
+            embedding_vector = obtener_embedding(msg)
 
-            supabase.from_("interaction_history").update({
+            # Un solo update (diferido) con análisis y vector
+            registro_interacciones.actualizar(message_id, {
+                "analysis_result": single_analysis,
                 "embedding_vector": embedding_vector
-            }).eq("id", message_id).execute()
+            })
     except Exception as e:
         logging.error(f"❌ Error en análisis incremental: {e}")
 
-def verificar_y_guardar_calificacion(user_id, msg, conversation_id):
+def verificar_y_guardar_calificacion(user_id, msg, conversation_id, estado=None):
     try:
-        etapa_actual = supabase.from_("conversation_history")\
-            .select("etapa_actual")\
-            .eq("conversation_id", conversation_id)\
-            .limit(1).execute()
+        if estado is not None:
+            etapa = estado.etapa_actual
+        else:
+            etapa_actual = supabase.from_("conversation_history")\
+                .select("etapa_actual")\
+                .eq("conversation_id", conversation_id)\
+                .limit(1).execute()
+            etapa = etapa_actual.data[0]["etapa_actual"] if etapa_actual.data else None
 
-        if etapa_actual.data and etapa_actual.data[0]["etapa_actual"] == "esperando_calificacion":
+        if etapa == "esperando_calificacion":
             logging.info("📝 Usuario está en etapa de calificación, intentando procesar...")
 
             # Usa GPT para extraer calificación + comentario
@@ -1270,9 +1273,12 @@ def verificar_y_guardar_calificacion(user_id, msg, conversation_id):
                     )
 
                     # Actualizar etapa
-                    supabase.from_("conversation_history").update({
-                        "etapa_actual": "calificacion_recibida"
-                    }).eq("conversation_id", conversation_id).execute()
+                    if estado is not None:
+                        estado.actualizar(etapa_actual="calificacion_recibida")
+                    else:
+                        supabase.from_("conversation_history").update({
+                            "etapa_actual": "calificacion_recibida"
+                        }).eq("conversation_id", conversation_id).execute()
                     return True
             else:
                 send_and_log(
@@ -1319,6 +1325,7 @@ def get_config_fabrica():
     }
 
 
+@etapa("respuesta")
 def generar_respuesta_openai(mensaje, prompt_base, temperature=0.7, model="gpt-3.5-turbo"):
     """
     Genera una respuesta usando OpenAI GPT con un prompt base.
@@ -1353,19 +1360,64 @@ def generar_respuesta_openai(mensaje, prompt_base, temperature=0.7, model="gpt-3
         logging.error(f"❌ Error generando respuesta OpenAI: {e}")
         return "Perdón, en este momento no puedo responder a tu pregunta. ¿Puedes intentar de nuevo más tarde?"
 
-app = Flask(__name__)
-CORS(app)
-@app.route("/whatsapp", methods=['POST'])
+# 🧭 Rutas del bot; crear_app() las monta en una app Flask
+rutas = Blueprint("bot", __name__)
+
+
+@rutas.route("/whatsapp", methods=['POST'])
 def webhook():
     if not request.form:
         logging.warning("⚠️ Payload vacío o no enviado como form-data")
         return "Se esperaba form-data (Twilio)", 400
 
+    datos = request.form.to_dict()
+    if not WEBHOOK_ASINCRONO and not COALESCER_MENSAJES:
+        return procesar_mensaje_whatsapp(datos)
+
+    # ⚡ Modo asíncrono: validar, encolar y responder a Twilio de inmediato
+    sender = datos.get("From", "").replace("whatsapp:", "")
+    if not sender or not datos.get("Body", "").strip():
+        logging.warning("⚠️ Faltan datos esenciales en el mensaje recibido.")
+        return "Mensaje incompleto", 200
+
+    # 🧩 El mensaje espera unos segundos por si el usuario sigue escribiendo
+    if COALESCER_MENSAJES:
+        coalescedor.agregar(sender, datos)
+        return "ok", 200
+
+    if not cola_mensajes.encolar(sender, datos):
+        return "Servicio saturado, intenta más tarde", 503
+    return "ok", 200
+
+
+@rutas.route("/configuracion/invalidar", methods=["POST"])
+def invalidar_cache_configuracion():
+    invalidar_configuracion_bot()
+    return {"ok": True}, 200
+
+
+@rutas.route("/whatsapp/metricas", methods=["GET"])
+def metricas_cola_mensajes():
+    return {
+        "asincrono": WEBHOOK_ASINCRONO,
+        **cola_mensajes.metricas(),
+        "estado": almacen.metricas(),
+        "registro_interacciones": registro_interacciones.metricas(),
+        "mensajeria": mensajeria.metricas(),
+        "servicios": metricas_servicios(),
+        "coalescedor": coalescedor.metricas() if COALESCER_MENSAJES else None
+    }, 200
+
+
+@trazar("whatsapp")
+def procesar_mensaje_whatsapp(form):
+    estado = None
+    plan = PlanEjecucion()
     try:
         ya_respondio = False
 
-        msg = request.form.get("Body", "").strip()
-        sender = request.form.get("From", "").replace("whatsapp:", "")
+        msg = form.get("Body", "").strip()
+        sender = form.get("From", "").replace("whatsapp:", "")
         user_id = sender
         now = datetime.now()
 
@@ -1381,8 +1433,11 @@ def webhook():
         
         config = obtener_configuracion_bot()
         tipo_negocio = config.get("tipo_negocio", "generico")
-          #Obtener o crear conversation_id primero
-        conversation_id = guardar_conversacion_si_no_existe(user_id, sender, tipo_negocio)
+        # Obtener o crear la conversación completa en una sola consulta
+        with etapa("estado"):
+            estado = cargar_estado_conversacion(user_id, sender, tipo_negocio)
+        conversation_id = estado.conversation_id
+        etiquetar(conversation_id=conversation_id, usuario=user_id)
 
         # 1️⃣ Intención directa: ubicación
         if detectar_intencion_directa(msg, "ubicacion"):
@@ -1398,15 +1453,17 @@ def webhook():
             return "ok", 200
 
         
-        # 🔁 Aplicar buffer inteligente
-        msg = procesar_buffer_usuario(user_id, msg)
+        # 🔁 Aplicar buffer inteligente (con el coalescedor el mensaje ya llega combinado)
+        if not COALESCER_MENSAJES:
+            msg = procesar_buffer_usuario(user_id, msg)
         
         logging.info(f"📩 Mensaje recibido de {sender}: {msg}")
         logging.info(f"📁 Registrando conversación con tipo_negocio: {tipo_negocio}")
         
         # Inicializar historial si no existe
-        if user_id not in conversations:
-            conversations[user_id] = []
+        historial = almacen.obtener_historial(user_id, conversation_id)
+        nuevos_mensajes = []
+        if historial is None:
 
             # Saludo inicial personalizado
             nombre_empresa = config.get("nombre_bot", "tu empresa")
@@ -1421,69 +1478,50 @@ def webhook():
                 f"• Agendar una prueba de manejo\n"
             )
             # Validar si ya se envió el saludo anteriormente
-            saludo_check = supabase.from_("conversation_history")\
-                .select("primer_saludo_enviado")\
-                .eq("conversation_id", conversation_id)\
-                .limit(1)\
-                .execute()
-            
-            if not saludo_check.data or not saludo_check.data[0]["primer_saludo_enviado"]:
-                conversations[user_id].append({"role": "assistant", "content": saludo_inicial})
-                supabase.from_("conversation_history").update({
-                    "primer_saludo_enviado": True
-                }).eq("conversation_id", conversation_id).execute()
-        ultimo_mensaje[user_id] = now
-        conversations[user_id].append({"role": "user", "content": msg})
-        # Limitar historial a 7 mensajes como máximo
-        if len(conversations[user_id]) > 40:
-            conversations[user_id] = conversations[user_id][-40:]
+            if not estado.primer_saludo_enviado:
+                nuevos_mensajes.append({"role": "assistant", "content": saludo_inicial})
+                estado.actualizar(primer_saludo_enviado=True)
+        almacen.registrar_ultimo_mensaje(user_id, now)
+        nuevos_mensajes.append({"role": "user", "content": msg})
+        # Limitar historial a 40 mensajes como máximo
+        historial = almacen.agregar_al_historial(user_id, nuevos_mensajes, max_mensajes=40)
 
 
         # Intervención humana
-        intervencion = supabase.from_("conversation_history")\
-            .select("is_human")\
-            .eq("conversation_id", conversation_id)\
-            .limit(1)\
-            .execute()
-        if intervencion.data and intervencion.data[0]["is_human"]:
+        if estado.is_human:
             guardar_mensaje_conversacion(conversation_id, msg, sender="user", tipo="text")
             return "ok", 200
 
         message_id = guardar_mensaje_conversacion(conversation_id, msg, sender="user", tipo="text")
-    
-
-        etapa_actual = supabase.from_("conversation_history")\
-            .select("etapa_actual")\
-            .eq("conversation_id", conversation_id)\
-            .limit(1).execute()
 
-        if verificar_y_guardar_calificacion(user_id, msg, conversation_id):
+        if verificar_y_guardar_calificacion(user_id, msg, conversation_id, estado):
             return "ok", 200
         # 3️⃣ Aquí va tu bloque de cierre de conversación
-        resultado_cierre = detectar_cierre_conversacion(user_id, msg, ultimo_mensaje)
+        resultado_cierre = detectar_cierre_conversacion(user_id, msg, almacen.obtener_ultimo_mensaje(user_id))
         if resultado_cierre == "cerrar_ya":
-            manejar_cierre_conversacion(user_id, msg, conversation_id, conversations, supabase)
+            estado.guardar()
+            manejar_cierre_conversacion(user_id, msg, conversation_id, historial, supabase)
             return responder_y_salir(sender, "✅ ¡Gracias por contactarnos! Conversación finalizada. Si necesitas algo más, escribe de nuevo.")
 
         # Media (imágenes, archivos, etc.)
-        num_media = int(request.form.get("NumMedia", 0))
+        num_media = int(form.get("NumMedia", 0))
         if num_media > 0:
             for i in range(num_media):
-                media_url = request.form.get(f"MediaUrl{i}")
-                media_type = request.form.get(f"MediaContentType{i}")
+                media_url = form.get(f"MediaUrl{i}")
+                media_type = form.get(f"MediaContentType{i}")
                 tipo_archivo = "image" if media_type.startswith("image/") else "video" if media_type.startswith("video/") else "file"
-                supabase.from_("interaction_history").insert({
+                registro_interacciones.insertar({
                     "conversation_id": conversation_id,
                     "sender_role": "user",
                     "message_type": tipo_archivo,
                     "file_url": media_url,
                     "file_type": media_type,
                     "start_time": datetime.now(timezone.utc).isoformat()
-                }).execute()
+                })
                 logging.info(f"📎 Archivo recibido ({media_type}): {media_url}")
 
-        # Lead score
-        reevaluar_lead_score_dinamico(conversation_id, conversations[user_id], user_id)
+        # Lead score (corre en paralelo; solo escribe en el estado)
+        plan.lanzar("lead_score", reevaluar_lead_score_dinamico, conversation_id, historial, user_id, estado)
 
         # 🔤 Normalizar mensaje si aún no existe
         mensaje_normalizado = ''.join(
@@ -1497,22 +1535,25 @@ def webhook():
             return "ok", 200
 
         if message_id:
-            analizar_mensaje_individual(msg, message_id)
+            plan.lanzar("analisis_mensaje", analizar_mensaje_individual, msg, message_id)
 
 
 
         # 🧠 Cargar config de plantilla
         config = obtener_configuracion_bot(conversation_id)
         # 🧠 Detectar intención del mensaje
-        intencion_detectada = detectar_intencion_comercial_o_reserva(msg, config.get("contexto", ""))
+        # Se necesita de inmediato: lanzarla al pool solo sumaría el salto de hilo
+        with etapa("intencion"):
+            intencion_detectada = detectar_intencion_comercial_o_reserva(msg, config.get("contexto", ""))
         logging.info(f"🧠 Intención detectada: {intencion_detectada}")
 
         nombre_bot = config.get("nombre_bot", "Asistente")
-        if user_id in ultimo_mensaje and now - ultimo_mensaje[user_id] > timedelta(minutes=15):
-           conversations[user_id].append({"role": "assistant", "content": f"Hola de nuevo, soy {nombre_bot}. Retomemos tu conversación anterior..."})
-        ultimo_mensaje[user_id] = now  # actualiza siempre después del saludo
+        ultima_actividad = almacen.obtener_ultimo_mensaje(user_id)
+        if ultima_actividad and now - ultima_actividad > timedelta(minutes=15):
+           historial = almacen.agregar_al_historial(user_id, [{"role": "assistant", "content": f"Hola de nuevo, soy {nombre_bot}. Retomemos tu conversación anterior..."}])
+        almacen.registrar_ultimo_mensaje(user_id, now)  # actualiza siempre después del saludo
 
-        funciones = obtener_funciones_disponibles(config["bot_type"])
+        funciones = config["funciones"]
 
 
         # Reintento con embeddings si GPT no detectó nada
@@ -1575,68 +1616,39 @@ def webhook():
         prompt_sistema = config["prompt"]
 
         # Si no hay archivo, elimina la parte de archivos del prompt
-        num_media = int(request.form.get("NumMedia", 0))
+        num_media = int(form.get("NumMedia", 0))
         if num_media == 0:
             prompt_sistema = re.sub(r"- .*archivos.*\n?", "", prompt_sistema, flags=re.IGNORECASE)
 
-        messages = [{"role": "system", "content": prompt_sistema}] + historial
+        # ⚡ Perfil, memoria y fragmentos no dependen entre sí: se piden a la vez
+        plan.lanzar("perfil", construir_perfil_texto, user_id)
+        plan.lanzar("memoria", evaluar_memoria_usuario, user_id, msg)
+        usar_fragmentos = config["usa_embeddings"] and intencion_detectada in ["reserva", "venta", "ambos"]
+        if usar_fragmentos:
+            # Se materializa aquí para que la búsqueda corra dentro del plan
+            plan.lanzar("fragmentos", lambda: buscar_fragmento_relevante(msg, top_k=FRAGMENTOS_TOP_K))
 
-        # --- 💡 PERFIL DE COMPORTAMIENTO ---
-        perfil = obtener_perfil_comportamiento_usuario(user_id)  # Debes crear esta función tipo SELECT * ...
-        if perfil:
-            perfil_texto = f"""
-        Perfil histórico del usuario:
-        Lead score promedio: {perfil.get('lead_score_promedio', 'N/A')}
-        Frases de interés: {perfil.get('frases_interes', 'N/A')}
-        Estilo: {perfil.get('estilo_mensaje', 'N/A')}
-        Días activo: {perfil.get('dias_activo', 'N/A')}
-        """
-            # Lo puedes insertar en segundo lugar o como system context
-            messages.insert(1, {"role": "system", "content": perfil_texto})
-        # 🧠 Recuperar memoria si existe
-        memoria_usuario = obtener_memoria_usuario(user_id, cuantos=3)
-        if memoria_usuario:
-            try:
-                # 🧠 Embedding del resumen
-                embedding_resumen = client.embeddings.create(
-                    model="text-embedding-ada-002",
-                    input=memoria_usuario
-                ).data[0].embedding
-
-                # 🧠 Embedding del nuevo mensaje
-                embedding_usuario = client.embeddings.create(
-                    model="text-embedding-ada-002",
-                    input=msg
-                ).data[0].embedding
-
-                # 🧮 Calcular similitud
-                similitud = cosine_similarity(embedding_resumen, embedding_usuario)
-
-                logging.info(f"📊 Similitud con memoria previa: {similitud:.2f}")
-
-                if similitud > 0.65:
-                    messages.insert(1, {"role": "system", "content": f"Contexto previo del usuario:\n{memoria_usuario}"})
-                    logging.info("🧠 Memoria insertada como contexto útil")
-                else:
-                    logging.info("🧠 Memoria omitida (similitud baja)")
-
-            except Exception as e:
-                logging.error(f"❌ Error evaluando similitud con memoria: {e}")
-        
+        perfil_texto = plan.esperar("perfil")
+        memoria_contexto = plan.esperar("memoria")
         # Agregar fragmentos si usa embeddings
-        if config["usa_embeddings"] and intencion_detectada in ["reserva", "venta", "ambos"]:
-            fragmentos = buscar_fragmento_relevante(msg, top_k=10000) 
-            bloques = construir_fragmento_resumido_por_tokens(fragmentos, max_tokens=7000, modelo="gpt-4")
-            for i, bloque in enumerate(bloques):
-                logging.info(f"🧠 Bloque {i+1} insertado ({len(bloque)} chars)")
-                messages.insert(2 + i, {"role": "system", "content": bloque})
-
-        gpt_response = client.chat.completions.create(
-            model="gpt-4",
-            messages=messages,
-            temperature=0.6,
-            max_tokens=500
-        )
+        fragmentos = plan.esperar("fragmentos") if usar_fragmentos else []
+
+        # 📏 Un solo presupuesto de tokens para prompt, perfil, memoria, historial y fragmentos
+        with etapa("respuesta"):
+            messages = ensamblar_mensajes(
+                prompt_sistema,
+                historial,
+                perfil=perfil_texto,
+                memoria=memoria_contexto,
+                fragmentos=(f.get("analysis_embedding_text", "") for f in fragmentos),
+                modelo="gpt-4"
+            )
+            gpt_response = client.chat.completions.create(
+                model="gpt-4",
+                messages=messages,
+                temperature=0.6,
+                max_tokens=500
+            )
         bot_reply = gpt_response.choices[0].message.content.strip()
         # ⚠️ Elimina líneas internas antes de enviar la respuesta
         bot_reply = re.sub(r"(?i)^calificacion:.*$", "", bot_reply, flags=re.MULTILINE).strip()
@@ -1649,30 +1661,27 @@ def webhook():
         if ya_respondio:
             return "ok", 200
 
-        if len(conversations[user_id]) > 7:
-            conversations[user_id] = conversations[user_id][-7:]
+        if len(historial) > 7:
+            historial = almacen.recortar_historial(user_id, 7)
         
         if bot_reply:
             guardar_mensaje_conversacion(conversation_id, bot_reply, sender="bot", tipo="text")
             # ✅ Enviar respuesta al usuario
-            twilio_client.messages.create(
-                from_=TWILIO_WHATSAPP_NUMBER,
-                to=f"whatsapp:{user_id}",
-                body=bot_reply
-            )
+            mensajeria.enviar(user_id, bot_reply)
             logging.info(f"📤 Mensaje enviado a {user_id}: {bot_reply}")
 
         # Análisis cada 4 mensajes
-        if len(conversations[user_id]) % 4 == 0:
-            insight = generar_analisis_incremental(conversations[user_id][-6:])
+        if len(historial) % 4 == 0:
+            insight = generar_analisis_incremental(historial[-6:])
             if insight:
-                supabase.from_("conversation_history").update({
-                    "analysis_incremental": insight
-                }).eq("conversation_id", conversation_id).execute()
+                estado.actualizar(analysis_incremental=insight)
 
-        resultado_cierre = detectar_cierre_conversacion(user_id, msg, ultimo_mensaje)
+        resultado_cierre = detectar_cierre_conversacion(user_id, msg, almacen.obtener_ultimo_mensaje(user_id))
         if resultado_cierre == "cerrar_ya":
-            manejar_cierre_conversacion(user_id, msg, conversation_id, conversations, supabase)
+            # El lead score en paralelo aún puede estar cambiando el estado: que termine antes de guardar y cerrar
+            plan.esperar_todo()
+            estado.guardar()
+            manejar_cierre_conversacion(user_id, msg, conversation_id, historial, supabase)
             return responder_y_salir(sender, "✅ ¡Gracias por contactarnos! Conversación finalizada. Si necesitas algo más, escribe de nuevo.")
 
 
@@ -1680,13 +1689,146 @@ def webhook():
         logging.error(f"❌ Error procesando mensaje: {e}")
         logging.exception("❌ Error general procesando mensaje:")
         return "Ocurrió un error, intenta nuevamente.", 200
+    finally:
+        # Las etapas en paralelo (lead score, análisis) terminan antes de guardar
+        plan.esperar_todo()
+        # 💾 Todos los cambios de conversation_history salen en un solo update
+        if estado is not None:
+            estado.guardar()
     # ✅ Agrega esto fuera del try-except como fallback:
     return "ok", 200
 
-app.add_url_rule("/actualizar_estado", view_func=actualizar_estado, methods=["POST", "OPTIONS"])
-threading.Thread(target=seguimiento_leads_silenciosos, daemon=True).start()
+cola_mensajes = ColaMensajes(
+    procesar_mensaje_whatsapp,
+    num_workers=WEBHOOK_WORKERS,
+    capacidad=WEBHOOK_COLA_MAX
+)
+
+
+# ✅ Siempre por la cola, también sin WEBHOOK_ASINCRONO: el webhook no procesa nada y
+# el worker de cada usuario mantiene el orden. False (cola llena) lo reintenta el coalescedor.
+def entregar_mensaje_combinado(user_id, datos):
+    return cola_mensajes.encolar(user_id, datos)
+
+
+# 🧰 Trabajos de cierre de conversación (persistentes, con reintentos)
+cola_trabajos = ColaTrabajos()
+cola_trabajos.registrar("cierre_analisis_final", trabajo_analisis_final)
+cola_trabajos.registrar("cierre_clasificar_lead", trabajo_clasificar_lead)
+cola_trabajos.registrar("cierre_conversion_lead", trabajo_conversion_lead)
+cola_trabajos.registrar("cierre_perfil_comportamiento", actualizar_perfil_comportamiento_usuario)
+cola_trabajos.registrar("cierre_resumen_usuario", guardar_resumen_usuario)
+
+
+@rutas.route("/seguimiento/metricas", methods=["GET"])
+def metricas_seguimiento_leads():
+    return metricas_seguimiento, 200
+
+
+@rutas.route("/recordatorios/metricas", methods=["GET"])
+def metricas_recordatorios():
+    return programador_recordatorios.metricas(), 200
+
+
+@rutas.route("/trabajos/metricas", methods=["GET"])
+def metricas_trabajos():
+    return cola_trabajos.metricas(), 200
+
+
+# 📈 Histogramas por etapa y por dependencia, en formato Prometheus
+@rutas.route("/metrics", methods=["GET"])
+def metricas_prometheus():
+    return Response(exportar_prometheus(), mimetype="text/plain; version=0.0.4")
+
+
+# 🐢 Las solicitudes más lentas con todos sus spans (?n=5 para ver solo las primeras)
+@rutas.route("/trazas/lentas", methods=["GET"])
+def metricas_trazas_lentas():
+    n = request.args.get("n", type=int)
+    return {"trazas": trazas_lentas(n)}, 200
+
+
+coalescedor = CoalescedorMensajes(
+    entregar_mensaje_combinado,
+    silencio_s=COALESCER_SILENCIO_S,
+    max_fragmentos=COALESCER_MAX_FRAGMENTOS,
+    max_espera_s=COALESCER_MAX_ESPERA_S
+)
+atexit.register(coalescedor.vaciar)
+
+
+
+# 🩺 503 mientras el calentamiento no termina, para que el balanceador no mande tráfico en frío
+@rutas.route("/health", methods=["GET"])
+def health():
+    estado = {**estado_arranque(), "servicios_en_segundo_plano": _servicios_iniciados.is_set()}
+    return estado, 200 if esta_listo() else 503
+
+
+_servicios_iniciados = threading.Event()
+_servicios_lock = threading.Lock()
+
+
+# ✅ Hilos de fondo del bot; importar bot.py no arranca ninguno
+def iniciar_servicios_en_segundo_plano():
+    with _servicios_lock:
+        if _servicios_iniciados.is_set():
+            return
+        _servicios_iniciados.set()
+
+    if WEBHOOK_ASINCRONO:
+        cola_mensajes.iniciar()
+    cola_trabajos.iniciar()
+    if INDICE_FRAGMENTOS_LOCAL:
+        iniciar_sincronizacion_fragmentos()
+    threading.Thread(target=seguimiento_leads_silenciosos, name="seguimiento-leads", daemon=True).start()
+    iniciar_citas_bot()
+
+
+def calentar_indices_intencion():
+    obtener_indice("reserva", "base", EJEMPLOS_INTENCION_RESERVA, obtener_embeddings)
+    negocio = obtener_configuracion_bot().get("negocio", "generico")
+    ejemplos = cargar_ejemplos_intencion("ventas", negocio)
+    if ejemplos:
+        obtener_indice("ventas", negocio, ejemplos, generar_embeddings_lote)
+
+
+# 🔥 Lo que el primer mensaje pagaría en frío: imports pesados, clientes, encoder, configuración e índices
+def pasos_calentamiento():
+    pasos = [
+        ("numpy", lambda: np.zeros(1)),
+        ("clientes", lambda: (obtener_supabase(), obtener_openai())),
+        ("encoder", obtener_encoder),
+        ("configuracion", obtener_configuracion_bot),
+        ("intenciones", calentar_indices_intencion),
+    ]
+    if INDICE_FRAGMENTOS_LOCAL:
+        # Primera carga del índice; después lo mantiene al día su hilo
+        pasos.append(("fragmentos", lambda: obtener_indice_fragmentos().sincronizar()))
+    return pasos
+
+
+def crear_app():
+    """
+    App Flask con todas las rutas. No abre conexiones ni arranca hilos: para
+    servir de verdad usar wsgi.py (gunicorn) o `python bot.py`, que además
+    llaman a iniciar_servicios_en_segundo_plano() y al calentamiento.
+    """
+    if os.getenv("ENV") == "development":
+        print("🧪 Validando integridad de plantillas...")
+        validar_plantillas()
+
+    nueva = Flask(__name__)
+    CORS(nueva)
+    nueva.register_blueprint(rutas)
+    nueva.add_url_rule("/actualizar_estado", view_func=actualizar_estado, methods=["POST", "OPTIONS"])
+    nueva.add_url_rule("/kpi/resumen", view_func=resumen_kpi, methods=["GET"])
+    return nueva
+
+
 if __name__ == '__main__':
-    import citas_bot
-    citas_bot.iniciar_citas_bot()
+    # La app se crea solo aquí: gunicorn usa la suya (wsgi.py)
+    app = crear_app()
+    iniciar_servicios_en_segundo_plano()
+    calentar_en_segundo_plano(pasos_calentamiento())
     app.run(host="0.0.0.0", port=int(os.environ.get("PORT", 8080)), debug=True)
-
@@ -6,33 +6,24 @@ import time
 from datetime import datetime, timedelta, timezone
 from flask import Flask, request
 from dotenv import load_dotenv
-from twilio.rest import Client as TwilioClient
-from supabase import create_client, Client
-from openai import OpenAI
 from dateutil import parser
 from zoneinfo import ZoneInfo
 import calendar
 from flask_cors import CORS
 import re
 import hashlib
+from configuracion_bot import obtener_configuracion_bot
+from registro_interacciones import registro_interacciones
+from programador_recordatorios import programador_recordatorios
+from mensajeria import mensajeria
+from fechas_es import extraer_fecha_hora, describir_ahora
+from trazas import etapa, traza
+from servicios import supabase, cliente_openai as client
 
 # === Configuración ===
 load_dotenv()
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-SUPABASE_URL = os.getenv("SUPABASE_URL")
-SUPABASE_KEY = os.getenv("SUPABASE_SERVICE_ROLE_KEY")
-TWILIO_SID = os.getenv("TWILIO_ACCOUNT_SID")
-TWILIO_AUTH = os.getenv("TWILIO_AUTH_TOKEN")
-TWILIO_WHATSAPP_NUMBER = os.getenv("TWILIO_WHATSAPP_NUMBER")
 
 MEXICO_TZ = ZoneInfo("America/Mexico_City")
-ahora_mx = datetime.now(MEXICO_TZ)
-fecha_actual_str = ahora_mx.strftime("%A %d de %B de %Y")
-hora_actual_str = ahora_mx.strftime("%H:%M")
-
-client = OpenAI(api_key=OPENAI_API_KEY)
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
-twilio_client = TwilioClient(TWILIO_SID, TWILIO_AUTH)
 
 app = Flask(__name__)
 CORS(app)
@@ -40,11 +31,7 @@ logging.basicConfig(level=logging.INFO)
 
 # === Funciones auxiliares ===
 def enviar_respuesta(destino, texto):
-    twilio_client.messages.create(
-        from_=TWILIO_WHATSAPP_NUMBER,
-        to=f"whatsapp:{destino}",
-        body=texto
-    )
+    return mensajeria.enviar(destino, texto)
 
 def convertir_dia_a_fecha(dia):
     dias_semana = {
@@ -94,6 +81,8 @@ def guardar_reserva(user_id, servicio, fecha_completa, sender, config=None, conv
     try:
         resultado = supabase.from_("reservaciones").insert(datos).execute()
         logging.info(f"📝 Reserva guardada correctamente: {resultado}")
+        for fila in resultado.data or []:
+            programador_recordatorios.programar(fila)
 
         mensaje_confirmacion = generar_mensaje_confirmacion(config or {}, fecha_completa, servicio)
         responder_y_registrar(sender, mensaje_confirmacion, conversation_id)
@@ -118,94 +107,114 @@ def eliminar_estado_pendiente(user_id):
 
 
 
-# === Core ===
-def gestionar_reserva(user_id, msg, sender, config=None, conversation_id=None):
+def servicio_por_defecto(config):
+    return config.get("negocio", "General") if config else "General"
+
+
+# ✅ Servicio de la cita con una llamada corta (la fecha ya la resolvió el parser local)
+def detectar_servicio(msg, config=None):
     try:
-        # 1️⃣ Inferir servicio si no se menciona
-        try:
-            inferencia = client.chat.completions.create(
-                model="gpt-3.5-turbo",
-                messages=[
-                    {
-                        "role": "system",
-                        "content": "Dado el siguiente mensaje, extrae el tipo de servicio o motivo de la cita. "
-                "Ejemplos: masaje, demo, consulta, comida, presentación, etc. "
-                "Si no se menciona explícitamente, devuelve 'General' o el servicio principal de este negocio."
-                    },
-                    {"role": "user", "content": msg}
-                ],
-                max_tokens=10
-            )
-            servicio_detectado = inferencia.choices[0].message.content.strip() or (config.get("negocio", "General") if config else "General")
-            # 👇 Agrega este log para ver qué detectó
-            logging.info(f"🟦 Servicio detectado por OpenAI: {servicio_detectado} | Mensaje original: {msg}")
-        except:
-            servicio_detectado = "General"
-            logging.warning(f"⚠️ Error detectando servicio: {e}. Se usó 'General'.")
-
-        # 2️⃣ Extraer fecha y hora
-        respuesta = client.chat.completions.create(
-            model="gpt-4",
+        inferencia = client.chat.completions.create(
+            model="gpt-3.5-turbo",
             messages=[
                 {
                     "role": "system",
-                    "content": f"""
+                    "content": "Dado el siguiente mensaje, extrae el tipo de servicio o motivo de la cita. "
+            "Ejemplos: masaje, demo, consulta, comida, presentación, etc. "
+            "Si no se menciona explícitamente, devuelve 'General' o el servicio principal de este negocio."
+                },
+                {"role": "user", "content": msg}
+            ],
+            max_tokens=10
+        )
+        servicio_detectado = inferencia.choices[0].message.content.strip() or servicio_por_defecto(config)
+        logging.info(f"🟦 Servicio detectado por OpenAI: {servicio_detectado} | Mensaje original: {msg}")
+        return servicio_detectado
+    except Exception as e:
+        logging.warning(f"⚠️ Error detectando servicio: {e}. Se usó 'General'.")
+        return "General"
+
+
+# ✅ Respaldo para mensajes ambiguos: servicio, fecha y hora en una sola llamada
+def extraer_reserva_llm(msg):
+    fecha_actual_str, hora_actual_str = describir_ahora()
+    respuesta = client.chat.completions.create(
+        model="gpt-4",
+        messages=[
+            {
+                "role": "system",
+                "content": f"""
 Eres un asistente que agenda citas. Hoy es {fecha_actual_str} y la hora actual es {hora_actual_str} hora de Ciudad de México.
 
 Tu tarea es extraer 3 elementos de un mensaje de usuario:
-1. El servicio (si se menciona, o usa 'General' como valor por defecto).
+1. El servicio o motivo de la cita (masaje, demo, consulta, comida, presentación, etc.; si no se menciona, usa 'General').
 2. La fecha (acepta cosas como 'mañana', 'sábado', o fechas explícitas).
 3. La hora (en cualquier formato: '11', '11 am', '6 de la tarde', etc).
 
 Devuelve los datos en formato JSON con fecha ISO (YYYY-MM-DD) y hora (HH:MM). Si no entiendes alguno, responde con null.
 """
+            },
+            {"role": "user", "content": msg}
+        ],
+        functions=[{
+            "name": "crear_reserva",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "servicio": {"type": "string"},
+                    "fecha": {"type": "string"},
+                    "hora": {"type": "string"}
                 },
-                {"role": "user", "content": msg}
-            ],
-            functions=[{
-                "name": "crear_reserva",
-                "parameters": {
-                    "type": "object",
-                    "properties": {
-                        "servicio": {"type": "string"},
-                        "fecha": {"type": "string"},
-                        "hora": {"type": "string"}
-                    },
-                    "required": ["fecha", "hora"]
-                }
-            }],
-            function_call={"name": "crear_reserva"}
-        )
-
-        args = json.loads(respuesta.choices[0].message.function_call.arguments)
-        if not args.get("fecha") or not args.get("hora"):
-            responder_y_registrar(sender, "❌ No entendí bien tu solicitud. ¿Puedes decirme el día y la hora exactos?", conversation_id)
-            return False
+                "required": ["fecha", "hora"]
+            }
+        }],
+        function_call={"name": "crear_reserva"}
+    )
+    return json.loads(respuesta.choices[0].message.function_call.arguments)
 
-        fecha_raw = args["fecha"].strip().lower()
-        hora_raw = args["hora"].strip()
-        servicio = args.get("servicio") or servicio_detectado or "General"
 
-        if fecha_raw == "mañana":
-            fecha = (datetime.now(MEXICO_TZ) + timedelta(days=1)).strftime("%Y-%m-%d")
-        elif fecha_raw == "hoy":
-            fecha = datetime.now(MEXICO_TZ).strftime("%Y-%m-%d")
-        elif fecha_raw in ["lunes", "martes", "miércoles", "miercoles", "jueves", "viernes", "sábado", "sabado", "domingo"]:
-            fecha = convertir_dia_a_fecha(fecha_raw)
+# === Core ===
+@etapa("reserva")
+def gestionar_reserva(user_id, msg, sender, config=None, conversation_id=None):
+    try:
+        # 1️⃣ Fecha y hora con el parser local (el servicio, con la llamada corta de gpt-3.5);
+        # si el parser no está seguro, una sola llamada a gpt-4 extrae servicio, fecha y hora
+        resultado = extraer_fecha_hora(msg)
+        if resultado.es_confiable():
+            fecha_completa = resultado.fecha_completa
+            servicio = detectar_servicio(msg, config)
+            logging.info(f"🗓️ Fecha local ({resultado.confianza:.2f}): {fecha_completa.isoformat()} | Servicio: {servicio}")
         else:
+            # Una sola llamada extrae servicio, fecha y hora
+            args = extraer_reserva_llm(msg)
+            if not args.get("fecha") or not args.get("hora"):
+                responder_y_registrar(sender, "❌ No entendí bien tu solicitud. ¿Puedes decirme el día y la hora exactos?", conversation_id)
+                return False
+
+            fecha_raw = args["fecha"].strip().lower()
+            hora_raw = args["hora"].strip()
+            servicio = args.get("servicio") or servicio_por_defecto(config)
+
+            if fecha_raw == "mañana":
+                fecha = (datetime.now(MEXICO_TZ) + timedelta(days=1)).strftime("%Y-%m-%d")
+            elif fecha_raw == "hoy":
+                fecha = datetime.now(MEXICO_TZ).strftime("%Y-%m-%d")
+            elif fecha_raw in ["lunes", "martes", "miércoles", "miercoles", "jueves", "viernes", "sábado", "sabado", "domingo"]:
+                fecha = convertir_dia_a_fecha(fecha_raw)
+            else:
+                try:
+                    fecha = parser.parse(fecha_raw, fuzzy=True).date().isoformat()
+                except Exception:
+                    responder_y_registrar(sender, "❌ No entendí bien la fecha. ¿Puedes decir algo como 'sábado a las 10am'?", conversation_id)
+                    return False
+
             try:
-                fecha = parser.parse(fecha_raw, fuzzy=True).date().isoformat()
+                fecha_completa = parser.parse(f"{fecha} {hora_raw}")
+                fecha_completa = fecha_completa.replace(tzinfo=MEXICO_TZ) if fecha_completa.tzinfo is None else fecha_completa.astimezone(MEXICO_TZ)
             except Exception:
-                responder_y_registrar(sender, "❌ No entendí bien la fecha. ¿Puedes decir algo como 'sábado a las 10am'?", conversation_id)
+                responder_y_registrar(sender, "❌ No entendí bien la hora. ¿Puedes decirla como '4pm' o '16:00'?", conversation_id)
                 return False
 
-        try:
-            fecha_completa = parser.parse(f"{fecha} {hora_raw}")
-            fecha_completa = fecha_completa.replace(tzinfo=MEXICO_TZ) if fecha_completa.tzinfo is None else fecha_completa.astimezone(MEXICO_TZ)
-        except Exception:
-            responder_y_registrar(sender, "❌ No entendí bien la hora. ¿Puedes decirla como '4pm' o '16:00'?", conversation_id)
-            return False
-
         if fecha_completa <= datetime.now(MEXICO_TZ):
             responder_y_registrar(sender, "⚠️ La fecha y hora que mencionaste ya pasó. ¿Puedes darme una hora futura?", conversation_id)
             return False
@@ -279,6 +288,7 @@ def extraer_datos_contacto(msg):
         return {"nombre": None, "correo": None}
 
 
+@etapa("confirmacion")
 def manejar_confirmacion_o_zona(user_id, msg):
     estado = obtener_estado_pendiente(user_id)
     if not estado:
@@ -418,16 +428,8 @@ def extraer_datos_contacto(msg):
 def confirmar_asistencia(user_id, msg):
     msg_normalizado = msg.lower()
 
-    # Obtener nombre del negocio desde configuración
-    nombre_negocio = "nuestro negocio"
-    try:
-        config = supabase.from_("bot_configuracion")\
-            .select("negocio")\
-            .order("created_at", desc=True).limit(1).execute()
-        if config.data:
-            nombre_negocio = config.data[0]["negocio"]
-    except:
-        pass
+    # Obtener nombre del negocio desde configuración (caché compartida)
+    nombre_negocio = obtener_configuracion_bot().get("negocio") or "nuestro negocio"
 
     # Obtener reserva más reciente en estado "esperando_confirmacion"
     reserva = supabase.from_("reservaciones")\
@@ -466,84 +468,30 @@ def confirmar_asistencia(user_id, msg):
 
 
 # === Recordatorios ===
-def enviar_recordatorios():
-    while True:
-        try:
-            now = datetime.now(timezone.utc)
-            margen = timedelta(minutes=5)
-
-            # === Recordatorio 24h antes ===
-            resultado_24h = supabase.from_("reservaciones")\
-                .select("id, user_id, fecha_reserva, cliente_nombre, recordatorio_24h_enviado, conversation_id")\
-                .eq("estado", "pendiente")\
-                .eq("recordatorio_24h_enviado", False)\
-                .execute()
-
-            for r in resultado_24h.data or []:
-                fecha_reserva = parse_fecha_supabase(r["fecha_reserva"])
-                if not fecha_reserva:
-                    continue
-
-                diferencia = fecha_reserva - now
-                if timedelta(hours=24) - margen <= diferencia <= timedelta(hours=24) + margen:
-                    local = fecha_reserva.astimezone(MEXICO_TZ)
-                    mensaje = f"⏰ Hola {r['cliente_nombre']}, te recuerdo que tienes una reserva mañana a las {local.strftime('%H:%M')} (hora CDMX). ¡Te esperamos!"
+def enviar_recordatorio_24h(r):
+    local = parse_fecha_supabase(r["fecha_reserva"]).astimezone(MEXICO_TZ)
+    mensaje = f"⏰ Hola {r['cliente_nombre']}, te recuerdo que tienes una reserva mañana a las {local.strftime('%H:%M')} (hora CDMX). ¡Te esperamos!"
+    # Se espera la entrega: si falla, el programador no lo marca como enviado
+    responder_y_registrar(r["user_id"], mensaje, conversation_id=r["conversation_id"]).result()
+    logging.info(f"🔔 Recordatorio 24h enviado a {r['user_id']}")
 
-                    responder_y_registrar(r["user_id"], mensaje, conversation_id=r["conversation_id"])
-                    supabase.from_("reservaciones").update({
-                        "recordatorio_24h_enviado": True
-                    }).eq("id", r["id"]).execute()
-                    logging.info(f"🔔 Recordatorio 24h enviado a {r['user_id']}")
-
-            # === Recordatorio 1h antes ===
-            resultado_1h = supabase.from_("reservaciones")\
-                .select("id, user_id, fecha_reserva, cliente_nombre, recordatorio_1h_enviado, conversation_id")\
-                .eq("estado", "pendiente")\
-                .eq("recordatorio_1h_enviado", False)\
-                .execute()
-
-            for r in resultado_1h.data or []:
-                fecha_reserva = parse_fecha_supabase(r["fecha_reserva"])
-                if not fecha_reserva:
-                    continue
-
-                diferencia = fecha_reserva - now
-                if timedelta(hours=1) - margen <= diferencia <= timedelta(hours=1) + margen:
-                    local = fecha_reserva.astimezone(MEXICO_TZ)
-                    mensaje = f"🕒 ¡Hola {r['cliente_nombre']}! Tu cita es en 1 hora, a las {local.strftime('%H:%M')} (hora CDMX). ¡Nos vemos pronto!"
-
-                    responder_y_registrar(r["user_id"], mensaje, conversation_id=r["conversation_id"])
-                    supabase.from_("reservaciones").update({
-                        "recordatorio_1h_enviado": True
-                    }).eq("id", r["id"]).execute()
-                    logging.info(f"🔔 Recordatorio 1h enviado a {r['user_id']}")
-
-            # === Seguimiento 10-12 min después de la cita ===
-            resultado_confirmadas = supabase.from_("reservaciones")\
-                .select("id, user_id, cliente_nombre, fecha_reserva, estado, conversation_id")\
-                .in_("estado", ["pendiente"])\
-                .execute()
 
-            config_negocio = supabase.from_("bot_configuracion")\
-                .select("negocio, contexto, tipo_negocio")\
-                .order("created_at", desc=True)\
-                .limit(1).execute()
+def enviar_recordatorio_1h(r):
+    local = parse_fecha_supabase(r["fecha_reserva"]).astimezone(MEXICO_TZ)
+    mensaje = f"🕒 ¡Hola {r['cliente_nombre']}! Tu cita es en 1 hora, a las {local.strftime('%H:%M')} (hora CDMX). ¡Nos vemos pronto!"
+    # Se espera la entrega: si falla, el programador no lo marca como enviado
+    responder_y_registrar(r["user_id"], mensaje, conversation_id=r["conversation_id"]).result()
+    logging.info(f"🔔 Recordatorio 1h enviado a {r['user_id']}")
 
-            tipo_negocio = config_negocio.data[0]["tipo_negocio"] if config_negocio.data else "generico"
-            contexto_negocio = config_negocio.data[0].get("contexto", "") if config_negocio.data else ""
 
-            for r in resultado_confirmadas.data or []:
-                fecha_reserva = parse_fecha_supabase(r["fecha_reserva"])
-                if not fecha_reserva:
-                    continue
+# === Seguimiento 10 min después de la cita ===
+def enviar_seguimiento_post_cita(r):
+    local = parse_fecha_supabase(r["fecha_reserva"]).astimezone(MEXICO_TZ)
+    tipo_negocio = obtener_configuracion_bot().get("tipo_negocio") or "generico"
 
-                diferencia = now - fecha_reserva
-                if timedelta(minutes=10) <= diferencia <= timedelta(minutes=12):
-                    local = fecha_reserva.astimezone(MEXICO_TZ)
-
-                    # Mensaje con OpenAI según tipo_negocio
-                    try:
-                        prompt = f"""
+    # Mensaje con OpenAI según tipo_negocio
+    try:
+        prompt = f"""
 Eres un asistente virtual que envía un *seguimiento suave* a un usuario 10 minutos después de su cita.
 
 Contexto:
@@ -557,29 +505,27 @@ No vendas nada. No digas "te esperamos".
 Solo busca confirmar la asistencia.
 """
 
-                        completion = client.chat.completions.create(
-                            model="gpt-3.5-turbo",
-                            messages=[{"role": "system", "content": prompt.strip()}],
-                            temperature=0.4,
-                            max_tokens=80
-                        )
-                        mensaje = completion.choices[0].message.content.strip()
-
-                    except Exception as e:
-                        logging.warning(f"⚠️ OpenAI fallback: {e}")
-                        mensaje = f"👋 Hola {r['cliente_nombre']}, ¿lograste asistir a tu cita de las {local.strftime('%H:%M')}?"
+        completion = client.chat.completions.create(
+            model="gpt-3.5-turbo",
+            messages=[{"role": "system", "content": prompt.strip()}],
+            temperature=0.4,
+            max_tokens=80
+        )
+        mensaje = completion.choices[0].message.content.strip()
 
-                    responder_y_registrar(r["user_id"], mensaje, conversation_id=r["conversation_id"])
-                    supabase.from_("reservaciones").update({
-                        "estado": "esperando_confirmacion"
-                    }).eq("id", r["id"]).execute()
+    except Exception as e:
+        logging.warning(f"⚠️ OpenAI fallback: {e}")
+        mensaje = f"👋 Hola {r['cliente_nombre']}, ¿lograste asistir a tu cita de las {local.strftime('%H:%M')}?"
 
-                    logging.info(f"✅ Seguimiento post-cita enviado a {r['user_id']}")
+    # Se espera la entrega: si falla, el programador no lo marca como enviado
+    responder_y_registrar(r["user_id"], mensaje, conversation_id=r["conversation_id"]).result()
+    logging.info(f"✅ Seguimiento post-cita enviado a {r['user_id']}")
 
-        except Exception as e:
-            logging.error(f"❌ Error en recordatorios automáticos: {e}")
 
-        time.sleep(900)  # 15 minutos
+# El programador reclama cada evento (recordatorio_*_enviado / estado) antes de enviarlo
+programador_recordatorios.registrar("recordatorio_24h", enviar_recordatorio_24h)
+programador_recordatorios.registrar("recordatorio_1h", enviar_recordatorio_1h)
+programador_recordatorios.registrar("seguimiento", enviar_seguimiento_post_cita)
 
 
 
@@ -593,11 +539,7 @@ def enviar_encuesta_satisfaccion(user_id, reserva_id, nombre_bot="nuestro servic
             f"Calificación: 5\nComentario: Excelente atención y servicio."
         )
 
-        twilio_client.messages.create(
-            from_=TWILIO_WHATSAPP_NUMBER,
-            to=f"whatsapp:{user_id}",
-            body=mensaje
-        )
+        mensajeria.enviar(user_id, mensaje).result()
 
         logging.info(f"📨 Encuesta de satisfacción enviada a {user_id} (reserva {reserva_id})")
 
@@ -615,31 +557,28 @@ def enviar_encuesta_satisfaccion(user_id, reserva_id, nombre_bot="nuestro servic
 
 def cron_encuesta_satisfaccion():
     while True:
-        try:
-            # Buscar reservas completadas sin encuesta enviada
-            resultado = supabase.from_("reservaciones")\
-                .select("id, user_id, cliente_nombre, conversation_id, encuesta_enviada")\
-                .eq("estado", "completada")\
-                .eq("encuesta_enviada", False)\
-                .execute()
-
-            for r in resultado.data or []:
-                user_id = r["user_id"]
-                reserva_id = r["id"]
-                cliente = r["cliente_nombre"]
-                conversation_id = r["conversation_id"]
-
-                # Obtener nombre del negocio
-                config = supabase.from_("bot_configuracion")\
-                    .select("nombre_bot")\
-                    .order("created_at", desc=True)\
-                    .limit(1).execute()
-
-                nombre_bot = config.data[0]["nombre_bot"] if config.data and config.data[0].get("nombre_bot") else "nuestro servicio"
-
-                # Mensaje con OpenAI
-                try:
-                    prompt = f"""
+        # Una traza por vuelta: el ciclo no termina nunca
+        with traza("encuesta_satisfaccion"):
+            try:
+                # Buscar reservas completadas sin encuesta enviada
+                resultado = supabase.from_("reservaciones")\
+                    .select("id, user_id, cliente_nombre, conversation_id, encuesta_enviada")\
+                    .eq("estado", "completada")\
+                    .eq("encuesta_enviada", False)\
+                    .execute()
+
+                for r in resultado.data or []:
+                    user_id = r["user_id"]
+                    reserva_id = r["id"]
+                    cliente = r["cliente_nombre"]
+                    conversation_id = r["conversation_id"]
+
+                    # Obtener nombre del negocio
+                    nombre_bot = obtener_configuracion_bot().get("nombre_bot") or "nuestro servicio"
+
+                    # Mensaje con OpenAI
+                    try:
+                        prompt = f"""
 Eres un asistente virtual que agradece al cliente por su visita al negocio "{nombre_bot}".
 
 Escribe un mensaje corto, amable y natural con emojis, pidiendo que califique su experiencia del 1 al 5 y deje un comentario opcional. No suenes robótico.
@@ -648,46 +587,39 @@ Incluye ejemplo como:
 Calificación: 5
 Comentario: Excelente atención.
 """
-                    completion = client.chat.completions.create(
-                        model="gpt-3.5-turbo",
-                        messages=[{"role": "system", "content": prompt.strip()}],
-                        temperature=0.4,
-                        max_tokens=100
-                    )
-                    mensaje = completion.choices[0].message.content.strip()
-                except Exception as e:
-                    logging.warning(f"⚠️ OpenAI fallback: {e}")
-                    mensaje = (
-                        f"🙏 ¡Gracias por visitarnos en {nombre_bot}!\n\n"
-                        f"¿Podrías calificarnos del 1 al 5 según tu experiencia?\n"
-                        f"También puedes añadir un comentario. Ejemplo:\n\n"
-                        f"Calificación: 5\nComentario: Excelente atención y servicio."
-                    )
-
-                # Enviar por WhatsApp
-                twilio_client.messages.create(
-                    from_=TWILIO_WHATSAPP_NUMBER,
-                    to=f"whatsapp:{user_id}",
-                    body=mensaje
-                )
-
-                # Registrar interacción
-                responder_y_registrar(user_id, mensaje, conversation_id)
-
-                supabase.from_("conversation_history").update({
-                    "etapa_actual": "esperando_calificacion"
-                }).eq("conversation_id", conversation_id).execute()
-
-                # Marcar como enviada
-                supabase.from_("reservaciones").update({
-                    "encuesta_enviada": True
-                }).eq("id", reserva_id).execute()
+                        completion = client.chat.completions.create(
+                            model="gpt-3.5-turbo",
+                            messages=[{"role": "system", "content": prompt.strip()}],
+                            temperature=0.4,
+                            max_tokens=100
+                        )
+                        mensaje = completion.choices[0].message.content.strip()
+                    except Exception as e:
+                        logging.warning(f"⚠️ OpenAI fallback: {e}")
+                        mensaje = (
+                            f"🙏 ¡Gracias por visitarnos en {nombre_bot}!\n\n"
+                            f"¿Podrías calificarnos del 1 al 5 según tu experiencia?\n"
+                            f"También puedes añadir un comentario. Ejemplo:\n\n"
+                            f"Calificación: 5\nComentario: Excelente atención y servicio."
+                        )
+
+                    # Enviar por WhatsApp y registrar interacción (antes se enviaba dos veces)
+                    responder_y_registrar(user_id, mensaje, conversation_id)
+
+                    supabase.from_("conversation_history").update({
+                        "etapa_actual": "esperando_calificacion"
+                    }).eq("conversation_id", conversation_id).execute()
+
+                    # Marcar como enviada
+                    supabase.from_("reservaciones").update({
+                        "encuesta_enviada": True
+                    }).eq("id", reserva_id).execute()
                 
 
-                logging.info(f"📨 Encuesta de satisfacción enviada a {user_id} (reserva {reserva_id})")
+                    logging.info(f"📨 Encuesta de satisfacción enviada a {user_id} (reserva {reserva_id})")
 
-        except Exception as e:
-            logging.error(f"❌ Error en cron de encuestas: {e}")
+            except Exception as e:
+                logging.error(f"❌ Error en cron de encuestas: {e}")
 
         time.sleep(900)  # Cada 15 minutos
 
@@ -778,23 +710,30 @@ def parse_fecha_supabase(fecha_str):
 
 
 def responder_y_registrar(user_id, mensaje, conversation_id=None, tipo="text"):
-    enviar_respuesta(user_id, mensaje)
+    entrega = enviar_respuesta(user_id, mensaje)
 
-    try:
-        created_at = datetime.now(timezone.utc).replace(second=0, microsecond=0).isoformat()
-        message_hash = hashlib.sha256(f"{conversation_id}-{mensaje}-{created_at}".encode()).hexdigest()
-
-        supabase.from_("interaction_history").upsert({
-            "message_hash": message_hash,
-            "bot_response": mensaje,
-            "sender_role": "bot",
-            "message_type": tipo,
-            "conversation_id": conversation_id,
-            "created_at": created_at
-        }, on_conflict=["message_hash"]).execute()
+    # Se registra solo lo que el proveedor aceptó
+    def registrar(futuro):
+        if futuro.cancelled() or futuro.exception() is not None:
+            return
+        try:
+            created_at = datetime.now(timezone.utc).replace(second=0, microsecond=0).isoformat()
+            message_hash = hashlib.sha256(f"{conversation_id}-{mensaje}-{created_at}".encode()).hexdigest()
+
+            registro_interacciones.insertar({
+                "message_hash": message_hash,
+                "bot_response": mensaje,
+                "sender_role": "bot",
+                "message_type": tipo,
+                "conversation_id": conversation_id,
+                "created_at": created_at
+            }, on_conflict=["message_hash"])
 
-    except Exception as e:
-        logging.error(f"❌ Error registrando interacción: {e}")
+        except Exception as e:
+            logging.error(f"❌ Error registrando interacción: {e}")
+
+    entrega.add_done_callback(registrar)
+    return entrega
 
 
 def guardar_mensaje_usuario(conversation_id, mensaje, created_at=None):
@@ -813,12 +752,8 @@ def guardar_mensaje_usuario(conversation_id, mensaje, created_at=None):
         "message_hash": message_hash
     }
 
-    try:
-        resultado = supabase.from_("interaction_history").upsert(data, on_conflict=["message_hash"]).execute()
-        return resultado.data[0]["id"] if resultado.data else None
-    except Exception as e:
-        logging.error(f"❌ Error guardando mensaje del usuario: {e}")
-        return None
+    # Devuelve un Future con el id de la fila
+    return registro_interacciones.insertar(data, on_conflict=["message_hash"])
 
 
 
@@ -849,17 +784,15 @@ def actualizar_estado():
         ya_enviada = resultado.data[0].get("encuesta_enviada", False)
 
         # 2️⃣ Actualizar el estado de la reserva
-        supabase.from_("reservaciones").update({
+        actualizada = supabase.from_("reservaciones").update({
             "estado": nuevo_estado
         }).eq("id", reserva_id).execute()
+        for fila in actualizada.data or []:
+            programador_recordatorios.programar(fila)
 
         # 3️⃣ Si es completada y no se ha enviado encuesta → enviar
         if nuevo_estado == "completada" and not ya_enviada:
-            config = supabase.from_("bot_configuracion")\
-                .select("negocio")\
-                .order("created_at", desc=True)\
-                .limit(1).execute()
-            nombre_negocio = config.data[0]["negocio"] if config.data else "nuestro servicio"
+            nombre_negocio = obtener_configuracion_bot().get("negocio") or "nuestro servicio"
 
             enviar_encuesta_satisfaccion(user_id, reserva_id, nombre_negocio)
 
@@ -889,7 +822,7 @@ def iniciar_citas_bot():
     logging.info("🚀 Iniciando hilos de citas_bot...")
 
     try:
-        threading.Thread(target=enviar_recordatorios, daemon=True).start()
+        programador_recordatorios.iniciar()
         threading.Thread(target=limpiar_estados_antiguos, daemon=True).start()
         threading.Thread(target=cron_encuesta_satisfaccion, daemon=True).start()
         logging.info("✅ Hilos de citas_bot iniciados correctamente.")
@@ -0,0 +1,125 @@
+import logging
+import threading
+import time
+
+
+class _Pendiente:
+    __slots__ = ("fragmentos", "inicio", "timer", "intentos")
+
+    def __init__(self):
+        self.fragmentos = []
+        self.inicio = time.monotonic()
+        self.timer = None
+        self.intentos = 0
+
+
+class CoalescedorMensajes:
+    """
+    Junta los mensajes que un usuario manda seguidos y entrega uno solo.
+
+    Cada fragmento reinicia un temporizador de `silencio_s`; al vencer se
+    entrega el texto combinado. También se entrega de inmediato al juntar
+    `max_fragmentos`, al pasar `max_espera_s` desde el primero o si el
+    fragmento trae archivos adjuntos.
+
+    `entregar(user_id, datos)` debe ser rápido (encolar, no procesar): se
+    llama con el lock tomado para que los mensajes de un usuario salgan en
+    orden. Si devuelve False (cola llena) los fragmentos vuelven a quedar
+    pendientes y se reintenta hasta `max_reintentos` veces.
+    """
+
+    def __init__(self, entregar, silencio_s=3.0, max_fragmentos=5, max_espera_s=10.0,
+                 reintento_s=2.0, max_reintentos=3):
+        self.entregar = entregar
+        self.silencio_s = silencio_s
+        self.max_fragmentos = max(1, max_fragmentos)
+        self.max_espera_s = max_espera_s
+        self.reintento_s = reintento_s
+        self.max_reintentos = max_reintentos
+        self._pendientes = {}
+        self._lock = threading.Lock()
+        self._contadores = {"fragmentos": 0, "entregas": 0, "duplicados": 0, "rechazados": 0, "perdidos": 0}
+
+    def agregar(self, user_id, datos):
+        with self._lock:
+            self._contadores["fragmentos"] += 1
+            pendiente = self._pendientes.get(user_id)
+            if pendiente is None:
+                pendiente = self._pendientes[user_id] = _Pendiente()
+
+            sid = datos.get("MessageSid")
+            if sid and any(f.get("MessageSid") == sid for f in pendiente.fragmentos):
+                self._contadores["duplicados"] += 1
+                return
+
+            pendiente.fragmentos.append(datos)
+            if pendiente.timer is not None:
+                pendiente.timer.cancel()
+
+            tiene_media = int(datos.get("NumMedia", 0) or 0) > 0
+            espera = time.monotonic() - pendiente.inicio
+            if tiene_media or len(pendiente.fragmentos) >= self.max_fragmentos or espera >= self.max_espera_s:
+                del self._pendientes[user_id]
+                self._entregar(user_id, pendiente)
+            else:
+                # El temporizador nunca deja pasar max_espera_s desde el primer fragmento
+                self._armar(user_id, pendiente, min(self.silencio_s, self.max_espera_s - espera))
+
+    def _armar(self, user_id, pendiente, retraso):
+        pendiente.timer = threading.Timer(retraso, self._vencer, args=(user_id, pendiente))
+        pendiente.timer.daemon = True
+        pendiente.timer.start()
+
+    def _vencer(self, user_id, pendiente):
+        with self._lock:
+            # Si ya se entregó por otro motivo, este temporizador llegó tarde
+            if self._pendientes.get(user_id) is not pendiente:
+                return
+            del self._pendientes[user_id]
+            self._entregar(user_id, pendiente)
+
+    def _entregar(self, user_id, pendiente):
+        # Llamar con self._lock tomado
+        fragmentos = pendiente.fragmentos
+        # Los campos (MessageSid, media, etc.) son los del último fragmento
+        datos = dict(fragmentos[-1])
+        datos["Body"] = " ".join(f.get("Body", "").strip() for f in fragmentos if f.get("Body", "").strip())
+        try:
+            aceptado = self.entregar(user_id, datos) is not False
+        except Exception as e:
+            logging.error(f"❌ Error entregando mensaje combinado de {user_id}: {e}")
+            return
+
+        if aceptado:
+            self._contadores["entregas"] += 1
+            if len(fragmentos) > 1:
+                logging.info(f"🧩 {len(fragmentos)} mensajes de {user_id} combinados en uno")
+            return
+
+        self._contadores["rechazados"] += 1
+        if pendiente.intentos >= self.max_reintentos:
+            self._contadores["perdidos"] += 1
+            logging.error(f"❌ Mensaje de {user_id} descartado: cola llena tras {pendiente.intentos + 1} intentos")
+            return
+
+        # Vuelve al frente de lo pendiente del usuario para no adelantarse a lo que llegue después
+        logging.warning(f"⚠️ Cola llena, el mensaje de {user_id} se reintenta en {self.reintento_s}s")
+        siguiente = self._pendientes.get(user_id)
+        if siguiente is None:
+            siguiente = self._pendientes[user_id] = _Pendiente()
+            self._armar(user_id, siguiente, self.reintento_s)
+        siguiente.fragmentos[:0] = fragmentos
+        siguiente.intentos = pendiente.intentos + 1
+
+    def vaciar(self):
+        """Entrega de inmediato todo lo pendiente (p. ej. al apagar)."""
+        with self._lock:
+            pendientes, self._pendientes = self._pendientes, {}
+            for user_id, pendiente in pendientes.items():
+                if pendiente.timer is not None:
+                    pendiente.timer.cancel()
+                self._entregar(user_id, pendiente)
+
+    def metricas(self):
+        with self._lock:
+            return {**self._contadores, "usuarios_en_espera": len(self._pendientes)}
@@ -0,0 +1,117 @@
+import logging
+import queue
+import threading
+import time
+import zlib
+from collections import OrderedDict, deque
+from estadisticas import resumir
+
+
+class ColaMensajes:
+    """
+    Pool acotado de workers para procesar mensajes entrantes fuera del webhook.
+    Cada usuario se asigna siempre al mismo worker, así sus mensajes se
+    procesan en el mismo orden en que llegaron.
+    """
+
+    def __init__(self, procesar, num_workers=4, capacidad=1000, max_sids_recordados=10000):
+        self.procesar = procesar
+        self.num_workers = max(1, num_workers)
+        self.colas = [queue.Queue(maxsize=capacidad) for _ in range(self.num_workers)]
+        self._hilos = []
+        self._lock = threading.Lock()
+        self._sids = OrderedDict()
+        self._max_sids = max_sids_recordados
+        self._espera = deque(maxlen=1000)
+        self._proceso = deque(maxlen=1000)
+        self._contadores = {
+            "encolados": 0,
+            "procesados": 0,
+            "errores": 0,
+            "rechazados": 0,
+            "duplicados": 0
+        }
+
+    def iniciar(self):
+        with self._lock:
+            if self._hilos:
+                return
+            for i, cola in enumerate(self.colas):
+                hilo = threading.Thread(target=self._trabajar, args=(cola,), name=f"cola-mensajes-{i}", daemon=True)
+                hilo.start()
+                self._hilos.append(hilo)
+        logging.info(f"🚚 Cola de mensajes iniciada con {self.num_workers} workers")
+
+    def _cola_para(self, user_id):
+        return self.colas[zlib.crc32(user_id.encode()) % self.num_workers]
+
+    def _es_duplicado(self, message_sid):
+        # Twilio reintenta con el mismo MessageSid si no recibió respuesta a tiempo
+        if not message_sid:
+            return False
+        with self._lock:
+            if message_sid in self._sids:
+                return True
+            self._sids[message_sid] = True
+            if len(self._sids) > self._max_sids:
+                self._sids.popitem(last=False)
+        return False
+
+    def _olvidar_sid(self, message_sid):
+        if message_sid:
+            with self._lock:
+                self._sids.pop(message_sid, None)
+
+    def _contar(self, nombre):
+        with self._lock:
+            self._contadores[nombre] += 1
+
+    def encolar(self, user_id, datos):
+        # Sin workers el mensaje quedaría en una cola que nadie lee
+        if not self._hilos:
+            self.iniciar()
+        if self._es_duplicado(datos.get("MessageSid")):
+            self._contar("duplicados")
+            logging.info(f"♻️ Mensaje duplicado ignorado ({datos.get('MessageSid')})")
+            return True
+
+        try:
+            self._cola_para(user_id).put_nowait((time.monotonic(), datos))
+        except queue.Full:
+            # Se olvida el SID: el reintento de Twilio tras el 503 debe entrar, no contarse como duplicado
+            self._olvidar_sid(datos.get("MessageSid"))
+            self._contar("rechazados")
+            logging.warning(f"⚠️ Cola llena, se rechaza mensaje de {user_id}")
+            return False
+
+        self._contar("encolados")
+        return True
+
+    def _trabajar(self, cola):
+        while True:
+            encolado_en, datos = cola.get()
+            inicio = time.monotonic()
+            self._espera.append(inicio - encolado_en)
+            try:
+                self.procesar(datos)
+                self._contar("procesados")
+            except Exception as e:
+                self._contar("errores")
+                logging.error(f"❌ Error procesando mensaje encolado: {e}")
+            finally:
+                self._proceso.append(time.monotonic() - inicio)
+                cola.task_done()
+
+    def metricas(self):
+        with self._lock:
+            contadores = dict(self._contadores)
+        profundidades = [c.qsize() for c in self.colas]
+        return {
+            **contadores,
+            "workers": self.num_workers,
+            "profundidad_total": sum(profundidades),
+            "profundidad_por_worker": profundidades,
+            "espera_en_cola_s": resumir(self._espera),
+            "procesamiento_s": resumir(self._proceso)
+        }
+
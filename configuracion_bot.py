@@ -0,0 +1,172 @@
+import os
+import time
+import logging
+import threading
+from dotenv import load_dotenv
+from servicios import supabase
+from bot_config import BOT_PLANTILLAS
+
+# ✅ Cargar variables de entorno
+load_dotenv()
+
+# ⏳ Vigencia de la configuración en memoria (segundos)
+CONFIG_CACHE_TTL = int(os.getenv("CONFIG_CACHE_TTL", 300))
+# Si Supabase falla, el fallback se reintenta antes
+CONFIG_FALLBACK_TTL = min(CONFIG_CACHE_TTL, 30)
+
+_cache = {"config": None, "expira": 0.0}
+_lock = threading.Lock()
+
+
+# ✅ Configuración del bot con caché TTL compartida por todos los módulos
+def obtener_configuracion_bot(_conversation_id=None):
+    ahora = time.monotonic()
+    config = _cache["config"]
+    if config is not None and ahora < _cache["expira"]:
+        return dict(config)
+
+    with _lock:
+        # Otro hilo pudo recargarla mientras esperábamos el lock
+        if _cache["config"] is not None and time.monotonic() < _cache["expira"]:
+            return dict(_cache["config"])
+
+        config, ttl = _cargar_configuracion_bot()
+        _cache["config"] = config
+        _cache["expira"] = time.monotonic() + ttl
+        return dict(config)
+
+
+# ✅ Invalida la caché (p. ej. después de editar bot_configuracion)
+def invalidar_configuracion_bot():
+    with _lock:
+        _cache["config"] = None
+        _cache["expira"] = 0.0
+    logging.info("♻️ Caché de configuración del bot invalidada")
+
+
+def _cargar_configuracion_bot():
+    try:
+        config = supabase.from_("bot_configuracion")\
+            .select("bot_type, tipo_negocio, ubicacion, latitud, longitud, contexto, tipo_reservas, negocio, requiere_zona, nombre_bot, zonas_permitidas")\
+            .order("created_at", desc=False)\
+            .limit(1)\
+            .execute()
+
+        if not config.data:
+            raise Exception("❌ No se encontró ninguna configuración del bot")
+
+        datos = config.data[0]
+
+        # Normalizar bot_type a lista
+        bot_types = datos.get("bot_type", [])
+        if not isinstance(bot_types, list):
+            bot_types = [bot_types] if bot_types else ["ventas"]
+
+        tipo_negocio = datos.get("tipo_negocio", "generico")  # ✅ Extraer tipo de negocio
+
+        # ✅ Combinar funciones de todas las plantillas activas
+        funciones_combinadas = set()
+        usa_embeddings = False
+
+        for tipo in bot_types:
+            plantilla = BOT_PLANTILLAS.get(tipo, {})
+            funciones_combinadas.update(plantilla.get("funciones", []))
+            if plantilla.get("usa_embeddings"):
+                usa_embeddings = True
+
+        plantilla_base = {
+            "descripcion": "Bot combinado",
+            "funciones": list(funciones_combinadas)
+        }
+
+        logging.info("⚙️ Configuración del bot cargada desde Supabase")
+        return {
+            "bot_type": bot_types,
+            "tipo_negocio": tipo_negocio,  # ✅ Incluir en retorno
+            "ubicacion": datos.get("ubicacion", ""),
+            "latitud": datos.get("latitud"),
+            "longitud": datos.get("longitud"),
+            "contexto": datos.get("contexto", ""),
+            "tipo_reservas": datos.get("tipo_reservas", "único_horario"),
+            "negocio": datos.get("negocio", "generico"),
+            "requiere_zona": datos.get("requiere_zona", False),
+            "zonas_permitidas": datos.get("zonas_permitidas", ["Salón", "Terraza", "VIP"]),
+            "nombre_bot": datos.get("nombre_bot", "AIDANA"),
+            "funciones": frozenset(funciones_combinadas),
+            "prompt": generar_prompt(
+                plantilla_base,
+                datos.get("contexto", ""),
+                datos.get("nombre_bot", "Asistente"),
+                tipo_negocio  # ✅ Pasar tipo_negocio al prompt
+            ),
+            "usa_embeddings": usa_embeddings
+        }, CONFIG_CACHE_TTL
+
+    except Exception as e:
+        logging.error(f"❌ Fallback a ventas. Error: {e}")
+        plantilla = BOT_PLANTILLAS["ventas"]
+        return {
+            "bot_type": ["ventas"],
+            "tipo_negocio": "generico",
+            "ubicacion": "",
+            "latitud": None,
+            "longitud": None,
+            "contexto": "",
+            "tipo_reservas": "único_horario",
+            "negocio": "generico",
+            "requiere_zona": False,
+            "zonas_permitidas": ["Salón", "Terraza", "VIP"],
+            "nombre_bot": "Asistente",
+            "funciones": frozenset(plantilla.get("funciones", [])),
+            "prompt": generar_prompt(plantilla, "", "Asistente", "generico"),
+            "usa_embeddings": plantilla.get("usa_embeddings", False)
+        }, CONFIG_FALLBACK_TTL
+
+
+def generar_prompt(plantilla, contexto_extra="", nombre_bot="Asistente", tipo_negocio="generico"):
+    funciones = set(plantilla.get("funciones", []))
+
+    instrucciones = [
+        f"{plantilla['descripcion']} Hola, soy AIDANA, tu asistente virtual de {nombre_bot}."
+        f"Este asistente está diseñado para un negocio tipo '{tipo_negocio}'.",
+        "Actúa siempre con claridad y amabilidad. Tu propósito es asistir al usuario según sus necesidades."
+    ]
+
+    if "agendar_reserva" in funciones:
+        instrucciones.append("- Si el usuario quiere agendar una cita, demo o reserva, pide fecha, hora y zona (si aplica).")
+    if "enviar_recordatorios" in funciones:
+        instrucciones.append("- Envía recordatorios antes de citas si es parte del flujo.")
+    if "cancelar_reserva" in funciones:
+        instrucciones.append("- Si el usuario desea cancelar, confirma y registra la cancelación.")
+    if "post_servicio" in funciones:
+        instrucciones.append("- Después del servicio, puedes solicitar calificación o hacer seguimiento.")
+    if "calificar_leads" in funciones:
+        instrucciones.append("- Si el usuario muestra interés, califícalo como lead y propón el siguiente paso.")
+        instrucciones.append("- Si el usuario muestra interés pero no decide, sugiere de forma amable un siguiente paso como agendar, cotizar o dejar sus datos.")
+        instrucciones.append("- Si pregunta por precios o productos, ofrece ayudar con una propuesta o preguntar si desea más detalles.")
+        instrucciones.append("- Cierra tus respuestas con una acción sugerida siempre que sea posible: '¿Quieres que te envíe una propuesta?', '¿Deseas agendar tu cita ahora?', etc.")
+    if "responder_por_embeddings" in funciones:
+        instrucciones.append("- Si el usuario hace preguntas específicas, usa los documentos entrenados para responder.")
+    if "analizar_archivos" in funciones:
+        instrucciones.append("- Si el usuario sube archivos, puedes analizarlos y dar retroalimentación clara.")
+    if "generar_faq" in funciones:
+        instrucciones.append("- Si detectas una duda frecuente, puedes sugerir una respuesta tipo FAQ.")
+    if "gestionar_tareas" in funciones:
+        instrucciones.append("- Puedes organizar tareas si el usuario lo solicita.")
+    if "crear_recordatorio" in funciones:
+        instrucciones.append("- Puedes programar recordatorios según lo que el usuario diga.")
+    if "dar_seguimiento" in funciones:
+        instrucciones.append("- Puedes dar seguimiento si el usuario no responde o deja algo pendiente.")
+        instrucciones.append("- Si detectas que el usuario quedó en pensar, preguntar o revisar algo, puedes recordarle amablemente después de unos minutos.")
+        instrucciones.append("- Si el usuario pidió info y no ha respondido en un rato, puedes enviar un mensaje como: '¿Tuviste oportunidad de revisarlo? Estoy aquí para ayudarte.'")
+
+    # Instrucciones generales
+    instrucciones.append("- No digas frases genéricas como 'estoy aquí para ayudarte'. Sé directo pero cordial.")
+    instrucciones.append("- Si no tienes suficiente contexto, puedes pedirlo de forma amable.")
+
+    prompt_final = "\n".join(instrucciones).strip()
+
+    if contexto_extra:
+        prompt_final += f"\n\n{contexto_extra.strip()}"
+
+    return prompt_final
@@ -0,0 +1,134 @@
+import os
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+# 📏 Presupuesto total del prompt (gpt-4: 8k de contexto menos la respuesta)
+PROMPT_MAX_TOKENS = int(os.getenv("PROMPT_MAX_TOKENS", 7000))
+# Parte del presupuesto reservada al historial reciente
+HISTORIAL_MAX_TOKENS = int(os.getenv("HISTORIAL_MAX_TOKENS", 1500))
+# Tokens extra que la API cobra por cada mensaje del chat
+TOKENS_POR_MENSAJE = 4
+MAX_CONTEOS_EN_CACHE = 20000
+# Sin encoder (tiktoken descarga su vocabulario la primera vez) se estima por caracteres, a la alta
+CARACTERES_POR_TOKEN = 3
+# 🔁 Si el encoder no cargó (p. ej. sin red), se vuelve a intentar después de estos segundos
+ENCODER_REINTENTO_S = int(os.getenv("ENCODER_REINTENTO_S", 300))
+
+_encoders = {}
+_reintentar_en = {}
+_conteos = OrderedDict()
+_lock = threading.Lock()
+# Aparte de _lock: una descarga lenta del vocabulario no frena los conteos ya cacheados
+_lock_encoders = threading.Lock()
+
+
+# ✅ Un solo encoder por modelo para todo el proceso (None mientras no se pueda cargar)
+def obtener_encoder(modelo="gpt-4"):
+    encoder = _encoders.get(modelo)
+    if encoder is not None or time.monotonic() < _reintentar_en.get(modelo, 0.0):
+        return encoder
+    with _lock_encoders:
+        if modelo in _encoders or time.monotonic() < _reintentar_en.get(modelo, 0.0):
+            return _encoders.get(modelo)
+        try:
+            import tiktoken
+            _encoders[modelo] = tiktoken.encoding_for_model(modelo)
+            _reintentar_en.pop(modelo, None)
+        except Exception as e:
+            logging.warning(f"⚠️ No se pudo cargar el encoder de {modelo}, se estiman los tokens y se reintenta en {ENCODER_REINTENTO_S}s: {e}")
+            _reintentar_en[modelo] = time.monotonic() + ENCODER_REINTENTO_S
+        return _encoders.get(modelo)
+
+
+# ✅ Conteo de tokens cacheado por hash del contenido
+def contar_tokens(texto, modelo="gpt-4"):
+    clave = (modelo, hashlib.sha1(texto.encode("utf-8")).digest())
+    with _lock:
+        if clave in _conteos:
+            _conteos.move_to_end(clave)
+            return _conteos[clave]
+
+    encoder = obtener_encoder(modelo)
+    if encoder is None:
+        # La estimación no se cachea: cuando cargue el encoder se cuenta de verdad
+        return len(texto) // CARACTERES_POR_TOKEN + 1
+    tokens = len(encoder.encode(texto))
+
+    with _lock:
+        _conteos[clave] = tokens
+        if len(_conteos) > MAX_CONTEOS_EN_CACHE:
+            _conteos.popitem(last=False)
+    return tokens
+
+
+def _costo(texto, modelo):
+    return contar_tokens(texto, modelo) + TOKENS_POR_MENSAJE
+
+
+def ensamblar_mensajes(prompt_sistema, historial, perfil=None, memoria=None, fragmentos=(),
+                       max_tokens=PROMPT_MAX_TOKENS, modelo="gpt-4"):
+    """
+    Arma los mensajes para el chat sin pasar de max_tokens.
+
+    Prioridad: prompt del sistema y último mensaje del usuario (siempre),
+    memoria, perfil, historial reciente (hasta HISTORIAL_MAX_TOKENS) y al
+    final los fragmentos, en orden de relevancia, mientras quepan.
+    """
+    restante = max_tokens - _costo(prompt_sistema, modelo)
+
+    historial = list(historial)
+    ultimo = historial[-1:] if historial else []
+    previos = historial[:-1]
+    for m in ultimo:
+        restante -= _costo(m["content"], modelo)
+
+    extras = []
+    for texto in (memoria, perfil):
+        if texto and _costo(texto, modelo) <= restante:
+            restante -= _costo(texto, modelo)
+            extras.append({"role": "system", "content": texto})
+
+    # Historial de más reciente a más antiguo, sin romper el orden al final
+    incluidos = []
+    presupuesto_historial = min(HISTORIAL_MAX_TOKENS, restante)
+    for m in reversed(previos):
+        costo = _costo(m["content"], modelo)
+        if costo > presupuesto_historial:
+            break
+        presupuesto_historial -= costo
+        restante -= costo
+        incluidos.append(m)
+    incluidos.reverse()
+
+    # Fragmentos: empaquetado greedy por relevancia hasta llenar el presupuesto
+    bloque, usados, descartes_seguidos = [], 0, 0
+    for contenido in fragmentos:
+        # Sin espacio útil o tras varios que no caben, no se revisan los demás
+        if restante < 50 or descartes_seguidos >= 5:
+            break
+        contenido = (contenido or "").strip()
+        if not contenido:
+            continue
+        fragmento_texto = f"[Fragmento del proyecto]\n{contenido}\n"
+        costo = contar_tokens(fragmento_texto, modelo) + (0 if bloque else TOKENS_POR_MENSAJE)
+        if costo <= restante:
+            bloque.append(fragmento_texto)
+            restante -= costo
+            usados += 1
+            descartes_seguidos = 0
+        else:
+            descartes_seguidos += 1
+
+    mensajes = [{"role": "system", "content": prompt_sistema}] + extras
+    if bloque:
+        mensajes.append({"role": "system", "content": "".join(bloque).strip()})
+    mensajes += incluidos + ultimo
+
+    logging.info(
+        f"🧾 Prompt ensamblado: {max_tokens - restante} tokens aprox. "
+        f"({len(incluidos) + len(ultimo)} mensajes de historial, {usados} fragmentos)"
+    )
+    return mensajes
@@ -0,0 +1,20 @@
+# 📊 Percentiles para las métricas de colas y workers (muestras en memoria)
+
+
+def percentil(ordenadas, p):
+    """Valor en el percentil p (0 a 1) de una lista ya ordenada; None si está vacía."""
+    if not ordenadas:
+        return None
+    return ordenadas[min(len(ordenadas) - 1, int(p * len(ordenadas)))]
+
+
+def resumir(muestras, decimales=4):
+    if not muestras:
+        return {"muestras": 0}
+    ordenadas = sorted(muestras)
+    return {
+        "muestras": len(ordenadas),
+        "p50": round(percentil(ordenadas, 0.50), decimales),
+        "p95": round(percentil(ordenadas, 0.95), decimales),
+        "max": round(ordenadas[-1], decimales)
+    }
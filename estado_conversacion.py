@@ -0,0 +1,94 @@
+import logging
+from dataclasses import dataclass, field
+from typing import Optional
+from servicios import supabase
+
+# Campos de conversation_history que se exponen como atributos
+CAMPOS_ESTADO = ("etapa_actual", "lead_score", "is_human", "primer_saludo_enviado", "status", "tipo_negocio")
+
+
+@dataclass
+class EstadoConversacion:
+    """
+    Foto en memoria de una fila de conversation_history.
+    Se carga una vez por mensaje; los cambios se acumulan y se escriben
+    juntos en un solo update con guardar().
+    """
+    conversation_id: Optional[str]
+    etapa_actual: Optional[str] = None
+    lead_score: Optional[str] = None
+    is_human: bool = False
+    primer_saludo_enviado: bool = False
+    status: Optional[str] = None
+    tipo_negocio: Optional[str] = None
+    fila: dict = field(default_factory=dict)
+    cambios: dict = field(default_factory=dict)
+
+    @classmethod
+    def desde_fila(cls, fila):
+        fila = fila or {}
+        return cls(
+            conversation_id=fila.get("conversation_id"),
+            etapa_actual=fila.get("etapa_actual"),
+            lead_score=fila.get("lead_score"),
+            is_human=bool(fila.get("is_human")),
+            primer_saludo_enviado=bool(fila.get("primer_saludo_enviado")),
+            status=fila.get("status"),
+            tipo_negocio=fila.get("tipo_negocio"),
+            fila=dict(fila)
+        )
+
+    def get(self, campo, default=None):
+        return self.fila.get(campo, default)
+
+    def actualizar(self, **campos):
+        for campo, valor in campos.items():
+            if campo in CAMPOS_ESTADO:
+                setattr(self, campo, valor)
+            self.fila[campo] = valor
+            self.cambios[campo] = valor
+
+    def guardar(self):
+        if not self.cambios or not self.conversation_id:
+            return False
+
+        cambios, self.cambios = self.cambios, {}
+        try:
+            supabase.from_("conversation_history")\
+                .update(cambios)\
+                .eq("conversation_id", self.conversation_id)\
+                .execute()
+            logging.info(f"💾 Estado de conversación guardado ({', '.join(cambios)})")
+            return True
+        except Exception as e:
+            logging.error(f"❌ Error guardando estado de conversación: {e}")
+            return False
+
+
+# ✅ Carga (o crea) la conversación completa en una sola consulta
+def cargar_estado_conversacion(user_id, numero, tipo_negocio="generico"):
+    numero_limpio = numero.replace("+", "")
+    try:
+        existing = supabase.from_("conversation_history")\
+            .select("*")\
+            .eq("whatsapp_number", numero_limpio)\
+            .limit(1)\
+            .execute()
+
+        if existing.data:
+            return EstadoConversacion.desde_fila(existing.data[0])
+
+        nueva = supabase.from_("conversation_history").insert({
+            "whatsapp_number": numero_limpio,
+            "channel": "whatsapp",
+            "user_identifier": user_id,
+            "user_id": user_id,
+            "status": "bot",
+            "is_human": False,
+            "tipo_negocio": tipo_negocio
+        }).execute()
+        logging.info(f"🆕 Conversación creada: {nueva}")
+        return EstadoConversacion.desde_fila(nueva.data[0] if nueva.data else None)
+    except Exception as e:
+        logging.error(f"❌ Error accediendo a Supabase: {e}")
+        return EstadoConversacion(conversation_id=None)
@@ -0,0 +1,267 @@
+import os
+import re
+from datetime import datetime, date, time, timedelta
+from zoneinfo import ZoneInfo
+from palabras_clave import normalizar_texto
+
+MEXICO_TZ = ZoneInfo("America/Mexico_City")
+
+# 🎯 Por debajo de esta confianza la fecha se le pregunta al LLM
+FECHAS_CONFIANZA_MIN = float(os.getenv("FECHAS_CONFIANZA_MIN", 0.8))
+
+DIAS = ["lunes", "martes", "miercoles", "jueves", "viernes", "sabado", "domingo"]
+MESES = [
+    "enero", "febrero", "marzo", "abril", "mayo", "junio", "julio",
+    "agosto", "septiembre", "octubre", "noviembre", "diciembre"
+]
+_NOMBRES_MES = {nombre: i + 1 for i, nombre in enumerate(MESES)}
+_NOMBRES_MES["setiembre"] = 9
+_NUMEROS = {
+    "una": 1, "uno": 1, "dos": 2, "tres": 3, "cuatro": 4, "cinco": 5, "seis": 6,
+    "siete": 7, "ocho": 8, "nueve": 9, "diez": 10, "once": 11, "doce": 12
+}
+
+_PALABRA_NUMERO = "|".join(_NUMEROS)
+_PALABRA_MES = "|".join(_NOMBRES_MES)
+_PALABRA_DIA = "|".join(DIAS)
+
+# Hora: "a las 4", "4pm", "16:00", "10 a.m.", "6 de la tarde", "a las cinco y media"
+_RE_HORA = re.compile(rf"""
+    (?P<prefijo>\ba\s+las?\s+|\blas?\s+)?
+    \b(?P<h>\d{{1,2}}(?!\d)|{_PALABRA_NUMERO})
+    (?::(?P<m>\d{{2}})|\s+y\s+(?P<fraccion>media|cuarto|\d{{1,2}})\b)?
+    \s*(?P<sufijo>a\.?\s?m\b\.?|p\.?\s?m\b\.?|hrs?\b\.?|horas\b)?
+    (?:\s*\b(?:de|en|por)\s+la\s+(?P<periodo>manana|tarde|noche|madrugada)\b)?
+""", re.X)
+_RE_PERIODO = re.compile(r"\b(?:de|en|por)\s+la\s+(manana|tarde|noche|madrugada)\b")
+_RE_MEDIODIA = re.compile(r"\bmedio\s?dia\b")
+# "mañana temprano a las 7": sin "de la mañana" pero igual es de mañana
+_RE_TEMPRANO = re.compile(r"\b(?:temprano|tempranito|madrugada)\b")
+
+# Fecha: "15 de julio", "15 julio 2026", "15/07", "el sabado", "pasado manana", "en 3 dias"
+_RE_DIA_MES = re.compile(rf"\b(\d{{1,2}})\s+(?:de\s+)?({_PALABRA_MES})\b(?:\s+(?:de\s+|del\s+)?(\d{{4}}))?")
+_RE_NUMERICA = re.compile(r"\b(\d{1,2})/(\d{1,2})(?:/(\d{2}|\d{4}))?\b")
+_RE_DIA_SEMANA = re.compile(rf"\b({_PALABRA_DIA})\b")
+_RE_DIA_SUELTO = re.compile(r"\b(?:el|dia)\s+(\d{1,2})\b")
+_RE_EN_DIAS = re.compile(r"\b(?:en|dentro\s+de)\s+(\d{1,2})\s+dias\b")
+_RE_RELATIVA = re.compile(r"\b(pasado\s+manana|manana|hoy)\b")
+
+# Expresiones que el parser no resuelve bien: mejor que decida el LLM
+_RE_AMBIGUO = re.compile(
+    r"\b(semana|mes|despues|antes|entre|o|tal\s+vez|quiza|quizas|no\s+se|cualquier|mejor)\b"
+)
+
+
+class ResultadoFecha:
+    """Fecha y hora encontradas en un mensaje y qué tanta confianza merecen (0 a 1)."""
+    __slots__ = ("fecha", "hora", "confianza")
+
+    def __init__(self, fecha=None, hora=None, confianza=0.0):
+        self.fecha = fecha
+        self.hora = hora
+        self.confianza = confianza
+
+    @property
+    def fecha_completa(self):
+        if self.fecha is None or self.hora is None:
+            return None
+        return datetime.combine(self.fecha, self.hora, tzinfo=MEXICO_TZ)
+
+    def es_confiable(self, minimo=None):
+        return self.fecha_completa is not None and self.confianza >= (minimo or FECHAS_CONFIANZA_MIN)
+
+    def __repr__(self):
+        return f"ResultadoFecha({self.fecha}, {self.hora}, {self.confianza:.2f})"
+
+
+def _numero(valor):
+    return int(valor) if valor.isdigit() else _NUMEROS[valor]
+
+
+def _a_24h(h, sufijo, periodo):
+    """Devuelve (hora 0-23, inferida) o None si no es una hora válida."""
+    sufijo = (sufijo or "").replace(".", "").replace(" ", "")
+    if sufijo in ("am", "pm"):
+        if not 1 <= h <= 12:
+            return None
+        return (h % 12) + (12 if sufijo == "pm" else 0), False
+    if periodo:
+        if not 1 <= h <= 12:
+            return None
+        if periodo in ("manana", "madrugada"):
+            return h % 12, False
+        if periodo == "noche" and h == 12:
+            # ¿Medianoche al empezar o al terminar el día? Que lo decida el LLM
+            return None
+        return (h % 12) + 12 if h != 12 else 12, False
+    if not 0 <= h <= 23:
+        return None
+    if h >= 12 or h == 0 or sufijo:
+        return h, False
+    # Sin am/pm: en horario de negocio "a las 4" serían las 16:00, pero es una suposición
+    return (h + 12 if 1 <= h <= 7 else h), True
+
+
+def _extraer_horas(texto):
+    """Horas encontradas y el texto sin ellas (para no confundir '10 de la manana' con una fecha)."""
+    periodo_suelto = None
+    encontrado = _RE_PERIODO.search(texto)
+    if encontrado:
+        periodo_suelto = encontrado.group(1)
+    elif _RE_TEMPRANO.search(texto):
+        periodo_suelto = "manana"
+
+    horas, tramos = [], []
+    for m in _RE_HORA.finditer(texto):
+        # Un número solo no es hora: necesita "a las", ":mm", am/pm/hrs o "de la tarde"
+        if not (m.group("prefijo") or m.group("m") or m.group("sufijo") or m.group("periodo")):
+            continue
+        # "en 2 horas" es un plazo, no una hora del día
+        if not m.group("prefijo") and re.search(r"\b(en|dentro\s+de|unas|como)\s*$", texto[:m.start()]):
+            continue
+        h = _numero(m.group("h"))
+        minutos = 0
+        if m.group("m"):
+            minutos = int(m.group("m"))
+        elif m.group("fraccion"):
+            fraccion = m.group("fraccion")
+            minutos = {"media": 30, "cuarto": 15}.get(fraccion) or int(fraccion)
+        if minutos > 59:
+            continue
+        # "a las 10 ... en la mañana": el periodo puede venir separado de la hora
+        periodo = m.group("periodo") or (None if m.group("m") and h >= 13 else periodo_suelto)
+        convertida = _a_24h(h, m.group("sufijo"), periodo)
+        if convertida is None:
+            continue
+        hora, inferida = convertida
+        horas.append((time(hora, minutos), inferida, h, minutos))
+        tramos.append(m.span())
+
+    if not horas:
+        for m in _RE_MEDIODIA.finditer(texto):
+            horas.append((time(12, 0), False, 12, 0))
+            tramos.append(m.span())
+
+    for inicio, fin in reversed(tramos):
+        texto = texto[:inicio] + " " * (fin - inicio) + texto[fin:]
+    texto = _RE_PERIODO.sub(lambda m: " " * len(m.group(0)), texto)
+    return horas, texto
+
+
+def _proximo_dia_semana(hoy, dia):
+    # Igual que convertir_dia_a_fecha: si hoy es ese día, se refiere al de la otra semana
+    return hoy + timedelta(days=((dia - hoy.weekday() + 7) % 7) or 7)
+
+
+def _fecha_sin_anio(hoy, mes, dia):
+    try:
+        candidata = date(hoy.year, mes, dia)
+    except ValueError:
+        return None
+    if candidata < hoy:
+        try:
+            candidata = date(hoy.year + 1, mes, dia)
+        except ValueError:
+            return None
+    return candidata
+
+
+def _extraer_fechas(texto, hoy):
+    """Fechas encontradas con su confianza base."""
+    fechas = []
+
+    for m in _RE_DIA_MES.finditer(texto):
+        dia, mes, anio = int(m.group(1)), _NOMBRES_MES[m.group(2)], m.group(3)
+        try:
+            fecha = date(int(anio), mes, dia) if anio else _fecha_sin_anio(hoy, mes, dia)
+        except ValueError:
+            fecha = None
+        fechas.append((fecha, 1.0))
+    texto = _RE_DIA_MES.sub(" ", texto)
+
+    for m in _RE_NUMERICA.finditer(texto):
+        dia, mes, anio = int(m.group(1)), int(m.group(2)), m.group(3)
+        try:
+            if anio:
+                fecha = date(int(anio) + (2000 if len(anio) == 2 else 0), mes, dia)
+            else:
+                fecha = _fecha_sin_anio(hoy, mes, dia)
+        except ValueError:
+            fecha = None
+        # dd/mm es lo normal en México, pero 07/15 escrito al revés no se adivina
+        fechas.append((fecha, 0.9))
+    texto = _RE_NUMERICA.sub(" ", texto)
+
+    for m in _RE_RELATIVA.finditer(texto):
+        palabra = m.group(1)
+        dias = 0 if palabra == "hoy" else 1 if palabra == "manana" else 2
+        fechas.append((hoy + timedelta(days=dias), 1.0))
+
+    for m in _RE_EN_DIAS.finditer(texto):
+        fechas.append((hoy + timedelta(days=int(m.group(1))), 0.9))
+
+    dias_semana = [DIAS.index(d) for d in _RE_DIA_SEMANA.findall(texto)]
+    for dia in dias_semana:
+        candidata = _proximo_dia_semana(hoy, dia)
+        # "el sábado 12": el día de la semana solo confirma la otra fecha
+        if not any(f == candidata or (f and f.weekday() == dia) for f, _ in fechas):
+            fechas.append((candidata, 1.0))
+
+    for m in _RE_DIA_SUELTO.finditer(texto):
+        dia = int(m.group(1))
+        mes, anio = (hoy.month, hoy.year) if dia >= hoy.day else (
+            (1, hoy.year + 1) if hoy.month == 12 else (hoy.month + 1, hoy.year)
+        )
+        try:
+            fecha = date(anio, mes, dia)
+        except ValueError:
+            fecha = None
+        if dias_semana and fecha and fecha.weekday() not in dias_semana:
+            fecha = None
+        # "el 15" sin mes: se asume el próximo día 15
+        fechas.append((fecha, 0.75))
+
+    return fechas
+
+
+# ✅ Fecha y hora de un mensaje en español de México, relativo a `ahora` (por defecto, la hora actual en CDMX)
+def extraer_fecha_hora(texto, ahora=None):
+    ahora = (ahora or datetime.now(MEXICO_TZ)).astimezone(MEXICO_TZ)
+    hoy = ahora.date()
+    texto = normalizar_texto(texto)
+    texto = re.sub(r"[¿?¡!,;]", " ", texto)
+
+    horas, sin_horas = _extraer_horas(texto)
+    fechas = _extraer_fechas(sin_horas, hoy)
+
+    distintas_horas = {h for h, *_ in horas}
+    distintas_fechas = {f for f, _ in fechas}
+    if len(distintas_horas) > 1 or len(distintas_fechas) > 1 or None in distintas_fechas:
+        return ResultadoFecha(confianza=0.2)
+
+    fecha = fechas[0][0] if fechas else None
+    hora = horas[0][0] if horas else None
+    if fecha is None or hora is None:
+        return ResultadoFecha(fecha, hora, 0.3 if fecha or hora else 0.0)
+
+    confianza = fechas[0][1]
+    _, inferida, h, minutos = horas[0]
+    if inferida:
+        # Sin am/pm ni "de la tarde" la hora es adivinada: que la confirme el LLM
+        confianza *= 0.6
+        # "hoy a las 9" dicho a las 10 de la mañana: son las 9 de la noche
+        if datetime.combine(fecha, hora, tzinfo=MEXICO_TZ) <= ahora and h < 12:
+            tarde = time(h + 12, minutos)
+            if datetime.combine(fecha, tarde, tzinfo=MEXICO_TZ) > ahora:
+                hora = tarde
+    if _RE_AMBIGUO.search(sin_horas):
+        confianza *= 0.5
+
+    return ResultadoFecha(fecha, hora, round(confianza, 2))
+
+
+# ✅ "miércoles 9 de julio de 2025" y "10:30", en español sin depender del locale
+def describir_ahora(ahora=None):
+    ahora = (ahora or datetime.now(MEXICO_TZ)).astimezone(MEXICO_TZ)
+    fecha = f"{DIAS[ahora.weekday()]} {ahora.day:02d} de {MESES[ahora.month - 1]} de {ahora.year}"
+    return fecha.replace("miercoles", "miércoles").replace("sabado", "sábado"), ahora.strftime("%H:%M")
@@ -1,13 +1,13 @@
 import logging
 from datetime import datetime, timezone
 from dateutil import parser
-from supabase import create_client
+from servicios import supabase as db
 import unicodedata
+from palabras_clave import categorias_en
 
 
 
 def actualizar_perfil_comportamiento_usuario(user_id: str, conversation_id: str):
-    from bot import supabase as db
     try:
         # 1. Obtener interacciones
         interacciones = db.from_("interaction_history")\
@@ -30,9 +30,11 @@ def actualizar_perfil_comportamiento_usuario(user_id: str, conversation_id: str)
         promedio = round(sum(tiempos) / len(tiempos), 2) if tiempos else None
 
         # 2. Frases clave
-        frases_rechazo = [m for m in mensajes if any(x in m for x in ["luego", "revisar", "pensarlo", "pienso"])]
-        frases_interes = [m for m in mensajes if any(x in m for x in ["me interesa", "cuánto cuesta", "quiero"])]
-        frases_urgencia = [m for m in mensajes if any(x in m for x in ["urge", "lo necesito", "ya"])]
+        # Una sola pasada por mensaje para todas las categorías
+        categorias = [categorias_en(m) for m in mensajes]
+        frases_rechazo = [m for m, c in zip(mensajes, categorias) if "rechazo" in c]
+        frases_interes = [m for m, c in zip(mensajes, categorias) if "interes" in c]
+        frases_urgencia = [m for m, c in zip(mensajes, categorias) if "urgencia" in c]
 
         frases_rechazo = list(set(frases_rechazo))[:5]
         frases_interes = list(set(frases_interes))[:5]
@@ -88,7 +90,7 @@ def actualizar_perfil_comportamiento_usuario(user_id: str, conversation_id: str)
         ) if seguimiento else False
 
         # 8. Dominancia de intención (simple por ahora)
-        intencion_dominante = "venta" if any("cotiza" in m for m in mensajes) else "informacion"
+        intencion_dominante = "venta" if any("cotizacion" in c for c in categorias) else "informacion"
 
         # 9. Upsert del perfil
         db.from_("user_behavior_profile").upsert({
@@ -111,3 +113,4 @@ def actualizar_perfil_comportamiento_usuario(user_id: str, conversation_id: str)
 
     except Exception as e:
         logging.error(f"❌ Error generando perfil de comportamiento: {e}")
+        raise
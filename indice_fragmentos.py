@@ -0,0 +1,330 @@
+import os
+import json
+import time
+import logging
+import threading
+from arranque import importar_perezoso
+np = importar_perezoso("numpy")
+from dotenv import load_dotenv
+from servicios import supabase
+
+# ✅ Cargar variables de entorno
+load_dotenv()
+
+INDICE_FRAGMENTOS_DIR = os.getenv("INDICE_FRAGMENTOS_DIR", os.path.join(".cache", "fragmentos"))
+# Columna de user_files con el vector que usa match_user_files
+COLUMNA_EMBEDDING = os.getenv("USER_FILES_EMBEDDING_COLUMN", "analysis_embedding")
+# Cada cuánto el hilo de sincronización busca archivos nuevos en Supabase (segundos)
+SINCRONIZAR_CADA = int(os.getenv("INDICE_FRAGMENTOS_SYNC_S", 60))
+TAM_PAGINA = 500
+# Reconstrucción completa periódica: así se ven los archivos editados
+RECONSTRUIR_CADA = int(os.getenv("INDICE_FRAGMENTOS_RECONSTRUIR_S", 6 * 3600))
+
+
+def _meta_vacia():
+    return {"version": 2, "n": 0, "dim": 0, "cursor": None, "filas_leidas": 0, "construido_en": 0}
+
+
+class IndiceFragmentos:
+    """
+    Índice plano de los fragmentos de user_files guardado en disco:
+
+    - vectores.f32: matriz float32 (n x dim) normalizada, se abre con memmap.
+    - textos.bin + offsets.i64: textos UTF-8 concatenados y sus posiciones.
+    - meta.json: n, dim, el cursor (created_at, id) de la última fila leída
+      y cuántas filas de user_files se han leído.
+
+    Entre reconstrucciones se actualiza añadiendo al final de los archivos.
+    Se reconstruye completo cuando user_files tiene menos filas que las
+    leídas (se borró algo) y cada INDICE_FRAGMENTOS_RECONSTRUIR_S (ediciones).
+    La carpeta se comparte entre procesos: escribir, truncar y reabrir se
+    hace con un lock de archivo, y solo un proceso sincroniza a la vez.
+    sincronizar() corre en su propio hilo (iniciar_sincronizacion_fragmentos);
+    los requests solo recargan lo que haya en disco.
+    """
+
+    def __init__(self, carpeta):
+        from filelock import FileLock
+
+        self.carpeta = carpeta
+        os.makedirs(carpeta, exist_ok=True)
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._lock_datos = FileLock(self._ruta(".datos.lock"))
+        self._lock_sync = FileLock(self._ruta(".sync.lock"))
+        self._ultima_sync = 0.0
+        self._mtime_meta = None
+        self.meta = _meta_vacia()
+        # (vectores, offsets, textos) se cambian juntos para que una búsqueda no mezcle versiones
+        self._datos = (None, None, None)
+        with self._lock_datos:
+            self._abrir()
+
+    def _ruta(self, nombre):
+        return os.path.join(self.carpeta, nombre)
+
+    def _abrir(self):
+        # Llamar con self._lock_datos tomado
+        try:
+            self._mtime_meta = os.stat(self._ruta("meta.json")).st_mtime_ns
+            with open(self._ruta("meta.json"), encoding="utf-8") as f:
+                self.meta = json.load(f)
+            if self.meta.get("version") != 2:
+                logging.info("♻️ Índice de fragmentos con formato anterior, se reconstruye")
+                self.meta = _meta_vacia()
+        except FileNotFoundError:
+            self.meta = _meta_vacia()
+        except Exception as e:
+            logging.warning(f"⚠️ meta.json del índice de fragmentos inválido, se reconstruye: {e}")
+            self.meta = _meta_vacia()
+
+        n, dim = self.meta["n"], self.meta["dim"]
+        if n:
+            try:
+                # Descartar bytes de una escritura que no llegó a confirmarse en meta.json
+                offsets = np.fromfile(self._ruta("offsets.i64"), dtype=np.int64, count=n + 1)
+                os.truncate(self._ruta("vectores.f32"), n * dim * 4)
+                os.truncate(self._ruta("offsets.i64"), (n + 1) * 8)
+                os.truncate(self._ruta("textos.bin"), int(offsets[-1]))
+
+                vectores = np.memmap(self._ruta("vectores.f32"), dtype=np.float32, mode="r", shape=(n, dim))
+                textos = np.memmap(self._ruta("textos.bin"), dtype=np.uint8, mode="r")
+                self._datos = (vectores, offsets, textos)
+                return
+            except Exception as e:
+                logging.warning(f"⚠️ Índice de fragmentos dañado, se reconstruye: {e}")
+                self.meta = _meta_vacia()
+
+        for nombre in ("vectores.f32", "textos.bin", "offsets.i64"):
+            open(self._ruta(nombre), "wb").close()
+        self._datos = (None, None, None)
+
+    def _recargar_si_cambio(self):
+        # Otro proceso pudo añadir filas o reconstruir el índice
+        try:
+            mtime = os.stat(self._ruta("meta.json")).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if mtime != self._mtime_meta:
+            with self._lock, self._lock_datos:
+                self._abrir()
+
+    def __len__(self):
+        return self.meta["n"]
+
+    def _anexar(self, sufijo, filas, n, dim, fin_textos):
+        """Escribe las filas válidas al final de los archivos; devuelve (añadidas, dim, fin_textos)."""
+        dim = dim or next((len(v) for _, v in filas if v), 0)
+        validas = [(t, v) for t, v in filas if t and v is not None and len(v) == dim]
+        if not validas:
+            return 0, dim, fin_textos
+
+        matriz = np.asarray([v for _, v in validas], dtype=np.float32)
+        normas = np.linalg.norm(matriz, axis=1, keepdims=True)
+        normas[normas == 0] = 1.0
+        matriz /= normas
+
+        codificados = [t.encode("utf-8") for t, _ in validas]
+        nuevos_offsets = fin_textos + np.cumsum([len(c) for c in codificados], dtype=np.int64)
+        if n == 0:
+            nuevos_offsets = np.concatenate([np.zeros(1, dtype=np.int64), nuevos_offsets])
+
+        with open(self._ruta("vectores.f32" + sufijo), "ab") as f:
+            f.write(matriz.tobytes())
+        with open(self._ruta("textos.bin" + sufijo), "ab") as f:
+            f.write(b"".join(codificados))
+        with open(self._ruta("offsets.i64" + sufijo), "ab") as f:
+            f.write(nuevos_offsets.tobytes())
+        return len(validas), dim, int(nuevos_offsets[-1])
+
+    def agregar(self, filas, meta=None):
+        """
+        filas: lista de (texto, vector). Los cambios de meta (cursor, filas
+        leídas) se confirman junto con los datos. Devuelve cuántas se añadieron.
+        """
+        with self._lock, self._lock_datos:
+            n = self.meta["n"]
+            _, offsets, _ = self._datos
+            fin_textos = int(offsets[-1]) if n else 0
+            agregadas, dim, _ = self._anexar("", filas, n, self.meta["dim"], fin_textos)
+            if not agregadas and not meta:
+                return 0
+
+            self.meta.update(meta or {})
+            self.meta["n"] = n + agregadas
+            self.meta["dim"] = dim
+            self._guardar_meta()
+            self._abrir()
+            return agregadas
+
+    def reconstruir(self):
+        """Vuelve a leer todo user_files en archivos nuevos y los cambia de golpe."""
+        sufijo = ".nuevo"
+        for nombre in ("vectores.f32", "textos.bin", "offsets.i64"):
+            open(self._ruta(nombre + sufijo), "wb").close()
+
+        n, dim, fin_textos, leidas, cursor = 0, 0, 0, 0, None
+        for filas, cursor in self._paginas(None):
+            leidas += len(filas)
+            agregadas, dim, fin_textos = self._anexar(sufijo, _a_pares(filas), n, dim, fin_textos)
+            n += agregadas
+
+        with self._lock, self._lock_datos:
+            for nombre in ("vectores.f32", "textos.bin", "offsets.i64"):
+                os.replace(self._ruta(nombre + sufijo), self._ruta(nombre))
+            self.meta = {**_meta_vacia(), "n": n, "dim": dim, "cursor": list(cursor) if cursor else None,
+                         "filas_leidas": leidas, "construido_en": time.time()}
+            self._guardar_meta()
+            self._abrir()
+        logging.info(f"🏗️ Índice de fragmentos reconstruido: {n} fragmentos de {leidas} archivos")
+        return n
+
+    def _guardar_meta(self):
+        temporal = self._ruta("meta.json.tmp")
+        with open(temporal, "w", encoding="utf-8") as f:
+            json.dump(self.meta, f)
+        os.replace(temporal, self._ruta("meta.json"))
+
+    @staticmethod
+    def _texto(datos, i):
+        _, offsets, textos = datos
+        inicio, fin = int(offsets[i]), int(offsets[i + 1])
+        return bytes(textos[inicio:fin]).decode("utf-8")
+
+    def texto(self, i):
+        return self._texto(self._datos, i)
+
+    def buscar(self, vector, top_k=50):
+        """Generador de (similitud, texto) en orden de relevancia."""
+        datos = self._datos
+        vectores = datos[0]
+        n = len(vectores) if vectores is not None else 0
+        if not n:
+            return
+
+        consulta = np.asarray(vector, dtype=np.float32)
+        if consulta.shape[0] != vectores.shape[1]:
+            logging.warning("⚠️ Dimensión de embedding distinta a la del índice de fragmentos")
+            return
+        consulta = consulta / (np.linalg.norm(consulta) or 1.0)
+
+        similitudes = vectores @ consulta
+        k = min(top_k, n)
+        mejores = np.argpartition(-similitudes, k - 1)[:k]
+        mejores = mejores[np.argsort(-similitudes[mejores])]
+        # Los textos se leen del memmap solo a medida que se consumen
+        for i in mejores:
+            yield float(similitudes[i]), self._texto(datos, int(i))
+
+    def _paginas(self, cursor):
+        """Keyset por (created_at, id): varias filas con el mismo created_at no atascan la paginación."""
+        while True:
+            consulta = supabase.from_("user_files")\
+                .select(f"id, created_at, analysis_embedding_text, {COLUMNA_EMBEDDING}")
+            if cursor:
+                valor, ultimo_id = cursor
+                consulta = consulta.or_(f'created_at.gt."{valor}",and(created_at.eq."{valor}",id.gt.{ultimo_id})')
+            filas = consulta.order("created_at").order("id").limit(TAM_PAGINA).execute().data or []
+            if filas:
+                cursor = (filas[-1]["created_at"], filas[-1]["id"])
+                yield filas, cursor
+            if len(filas) < TAM_PAGINA:
+                return
+
+    def _hay_que_reconstruir(self):
+        if time.time() - self.meta.get("construido_en", 0) > RECONSTRUIR_CADA:
+            return True
+        # Menos filas que las ya leídas: se borraron archivos que el índice aún sirve
+        res = supabase.from_("user_files").select("id", count="exact").limit(1).execute()
+        if res.count is not None and res.count < self.meta.get("filas_leidas", 0):
+            logging.info(f"🧹 user_files tiene {res.count} filas y el índice leyó {self.meta['filas_leidas']}, se reconstruye")
+            return True
+        return False
+
+    def sincronizar(self, forzar=False):
+        self._recargar_si_cambio()
+        if not forzar and time.monotonic() - self._ultima_sync < SINCRONIZAR_CADA:
+            return 0
+        # Si otro hilo ya está sincronizando, se busca con lo que haya
+        if not self._sync_lock.acquire(blocking=False):
+            return 0
+        self._ultima_sync = time.monotonic()
+
+        from filelock import Timeout
+
+        total = 0
+        try:
+            # Y si otro proceso sobre la misma carpeta está sincronizando, también
+            self._lock_sync.acquire(timeout=0)
+            try:
+                self._recargar_si_cambio()
+                if self._hay_que_reconstruir():
+                    return self.reconstruir()
+                leidas = self.meta.get("filas_leidas", 0)
+                for filas, cursor in self._paginas(self.meta.get("cursor")):
+                    leidas += len(filas)
+                    # El cursor avanza aunque alguna fila no tuviera vector
+                    total += self.agregar(_a_pares(filas), {"cursor": list(cursor), "filas_leidas": leidas})
+            finally:
+                self._lock_sync.release()
+        except Timeout:
+            return 0
+        except Exception as e:
+            logging.error(f"❌ Error sincronizando índice de fragmentos: {e}")
+        finally:
+            self._sync_lock.release()
+
+        if total:
+            logging.info(f"📚 Índice de fragmentos: {total} nuevos (total {len(self)})")
+        return total
+
+
+def _a_pares(filas):
+    return [(f.get("analysis_embedding_text") or "", parsear_vector(f.get(COLUMNA_EMBEDDING))) for f in filas]
+
+
+def parsear_vector(valor):
+    # pgvector llega por PostgREST como texto "[0.1,0.2,...]"
+    if valor is None:
+        return None
+    if isinstance(valor, str):
+        try:
+            valor = json.loads(valor)
+        except ValueError:
+            return None
+    return valor if isinstance(valor, list) and valor else None
+
+
+_indice = None
+_indice_lock = threading.Lock()
+_hilo_sincronizacion = None
+
+
+# ✅ El índice tal como está en disco; no consulta Supabase
+def obtener_indice_fragmentos():
+    global _indice
+    if _indice is None:
+        with _indice_lock:
+            if _indice is None:
+                _indice = IndiceFragmentos(INDICE_FRAGMENTOS_DIR)
+    _indice._recargar_si_cambio()
+    return _indice
+
+
+# ✅ Archivos nuevos y reconstrucciones en un hilo aparte, nunca dentro de un request
+def iniciar_sincronizacion_fragmentos():
+    global _hilo_sincronizacion
+    with _indice_lock:
+        if _hilo_sincronizacion is not None:
+            return
+        _hilo_sincronizacion = threading.Thread(target=_sincronizar_siempre, name="indice-fragmentos", daemon=True)
+        _hilo_sincronizacion.start()
+
+
+def _sincronizar_siempre():
+    while True:
+        try:
+            obtener_indice_fragmentos().sincronizar(forzar=True)
+        except Exception as e:
+            logging.error(f"❌ Error en el hilo del índice de fragmentos: {e}")
+        time.sleep(SINCRONIZAR_CADA)
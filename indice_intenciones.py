@@ -0,0 +1,103 @@
+import os
+import logging
+import hashlib
+import threading
+from arranque import importar_perezoso
+np = importar_perezoso("numpy")
+
+# 📁 Carpeta donde se guardan las matrices de ejemplos ya normalizadas
+INDICE_INTENCIONES_DIR = os.getenv("INDICE_INTENCIONES_DIR", os.path.join(".cache", "intenciones"))
+
+_indices = {}
+_lock = threading.Lock()
+
+
+class IndiceIntencion:
+    """
+    Matriz contigua (n_ejemplos x dim) de embeddings L2-normalizados.
+    Comparar un mensaje contra todos los ejemplos es un solo producto matriz-vector.
+    """
+
+    def __init__(self, ejemplos, matriz, huella):
+        self.ejemplos = list(ejemplos)
+        self.matriz = np.ascontiguousarray(matriz, dtype=np.float32)
+        self.huella = huella
+
+    def __len__(self):
+        return len(self.ejemplos)
+
+    def mejor_coincidencia(self, vector):
+        if not len(self):
+            return None, 0.0
+        consulta = normalizar(vector)
+        similitudes = self.matriz @ consulta
+        mejor = int(np.argmax(similitudes))
+        return self.ejemplos[mejor], float(similitudes[mejor])
+
+
+def normalizar(vectores):
+    arr = np.asarray(vectores, dtype=np.float32)
+    normas = np.linalg.norm(arr, axis=-1, keepdims=True)
+    normas[normas == 0] = 1.0
+    return arr / normas
+
+
+def huella_ejemplos(ejemplos):
+    contenido = "\n".join(ejemplos)
+    return hashlib.sha256(contenido.encode("utf-8")).hexdigest()[:16]
+
+
+def _ruta_indice(tipo, negocio, huella):
+    nombre = f"{tipo}__{negocio}__{huella}.npy".replace(os.sep, "_")
+    return os.path.join(INDICE_INTENCIONES_DIR, nombre)
+
+
+def _guardar_matriz(ruta, matriz):
+    try:
+        os.makedirs(os.path.dirname(ruta), exist_ok=True)
+        temporal = f"{ruta}.{os.getpid()}.tmp"
+        with open(temporal, "wb") as f:
+            np.save(f, matriz)
+        os.replace(temporal, ruta)
+    except Exception as e:
+        logging.warning(f"⚠️ No se pudo guardar el índice de intención en disco: {e}")
+
+
+def _cargar_matriz(ruta, n_ejemplos):
+    if not os.path.exists(ruta):
+        return None
+    try:
+        matriz = np.load(ruta)
+        if matriz.ndim == 2 and matriz.shape[0] == n_ejemplos:
+            return matriz
+    except Exception as e:
+        logging.warning(f"⚠️ Índice de intención corrupto, se reconstruye: {e}")
+    return None
+
+
+# ✅ Devuelve el índice de (tipo, negocio); se reconstruye solo si cambian los ejemplos
+def obtener_indice(tipo, negocio, ejemplos, generar_embeddings):
+    # Orden estable: la misma lista en otro orden reutiliza la misma matriz
+    ejemplos = sorted({e.strip() for e in ejemplos if e and e.strip()})
+    huella = huella_ejemplos(ejemplos)
+    clave = (tipo, negocio)
+
+    indice = _indices.get(clave)
+    if indice is not None and indice.huella == huella:
+        return indice
+
+    with _lock:
+        indice = _indices.get(clave)
+        if indice is not None and indice.huella == huella:
+            return indice
+
+        ruta = _ruta_indice(tipo, negocio, huella)
+        matriz = _cargar_matriz(ruta, len(ejemplos))
+        if matriz is None:
+            logging.info(f"🧮 Construyendo índice de intención '{tipo}' ({negocio}) con {len(ejemplos)} ejemplos")
+            matriz = normalizar(generar_embeddings(list(ejemplos))) if ejemplos else np.zeros((0, 0), dtype=np.float32)
+            _guardar_matriz(ruta, matriz)
+
+        indice = IndiceIntencion(ejemplos, matriz, huella)
+        _indices[clave] = indice
+        return indice
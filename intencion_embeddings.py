@@ -1,22 +1,19 @@
 import os
+import time
 import logging
-import numpy as np
+from arranque import importar_perezoso
+np = importar_perezoso("numpy")
 from dotenv import load_dotenv
-from supabase import create_client
-from openai import OpenAI
+from servicios import supabase
+from indice_intenciones import obtener_indice
+from servicio_embeddings import obtener_embedding, obtener_embeddings
 
 # ✅ Cargar variables de entorno
 load_dotenv()
 
-embedding_cache = {}
-ejemplos_embeddings_cache = {}
-
-# ✅ Inicializar Supabase y OpenAI
-supabase = create_client(
-    os.getenv("SUPABASE_URL"),
-    os.getenv("SUPABASE_SERVICE_ROLE_KEY")
-)
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# ⏳ Cada cuánto se vuelve a leer ejemplos_intencion (para detectar cambios)
+EJEMPLOS_INTENCION_TTL = int(os.getenv("EJEMPLOS_INTENCION_TTL", 600))
+ejemplos_cache = {}
 
 # ✅ Función de similitud coseno
 def cosine_similarity(v1, v2):
@@ -24,36 +21,37 @@ def cosine_similarity(v1, v2):
     v2 = np.array(v2)
     return np.dot(v1, v2) / (np.linalg.norm(v1) * np.linalg.norm(v2))
 
-# ✅ Embedding con caché
+# ✅ Embedding con caché (servicio compartido de embeddings)
 def obtener_embedding_cached(texto, cache_key=None):
-    clave = cache_key or texto.strip().lower()
-    if clave in embedding_cache:
-        return embedding_cache[clave]
-
     try:
-        res = client.embeddings.create(
-            model="text-embedding-ada-002",
-            input=texto
-        )
-        vector = res.data[0].embedding
-        embedding_cache[clave] = vector
-        return vector
+        return obtener_embedding(texto)
     except Exception as e:
         logging.error(f"❌ Error generando embedding: {e}")
         return None
 
-# ✅ Cargar ejemplos desde Supabase
+# ✅ Embeddings de varios textos en una sola llamada
+def generar_embeddings_lote(textos):
+    return obtener_embeddings(textos)
+
+# ✅ Cargar ejemplos desde Supabase (con caché TTL)
 def cargar_ejemplos_intencion(tipo, negocio="generico"):
+    clave = (tipo, negocio)
+    guardado = ejemplos_cache.get(clave)
+    if guardado and time.monotonic() - guardado[0] < EJEMPLOS_INTENCION_TTL:
+        return guardado[1]
+
     try:
         res = supabase.from_("ejemplos_intencion")\
             .select("ejemplo")\
             .eq("tipo", tipo)\
             .or_(f"negocio.eq.{negocio},negocio.eq.generico")\
             .execute()
-        return [e["ejemplo"] for e in res.data or []]
+        ejemplos = [e["ejemplo"] for e in res.data or []]
+        ejemplos_cache[clave] = (time.monotonic(), ejemplos)
+        return ejemplos
     except Exception as e:
         logging.error(f"❌ Error cargando ejemplos: {e}")
-        return []
+        return guardado[1] if guardado else []
 
 # ✅ Analizar intención por embeddings
 def analizar_intencion_con_embeddings(texto, tipo, negocio="generico", threshold=0.80, embedding_usuario=None):
@@ -67,17 +65,11 @@ def analizar_intencion_con_embeddings(texto, tipo, negocio="generico", threshold
         if not ejemplos:
             return False
 
-        if tipo in ejemplos_embeddings_cache:
-            embeddings_ejemplos = ejemplos_embeddings_cache[tipo]
-        else:
-            res = client.embeddings.create(model="text-embedding-ada-002", input=ejemplos)
-            embeddings_ejemplos = [r.embedding for r in res.data]
-            ejemplos_embeddings_cache[tipo] = embeddings_ejemplos
-
-        for emb in embeddings_ejemplos:
-            if cosine_similarity(embedding_usuario, emb) >= threshold:
-                return True
-        return False
+        # 🧮 Índice precalculado por (tipo, negocio): un solo producto matriz-vector
+        indice = obtener_indice(tipo, negocio, ejemplos, generar_embeddings_lote)
+        ejemplo, similitud = indice.mejor_coincidencia(embedding_usuario)
+        logging.info(f"🧭 Intención '{tipo}': similitud {similitud:.2f} con '{ejemplo}'")
+        return similitud >= threshold
 
     except Exception as e:
         logging.error(f"❌ Error analizando intención por embeddings: {e}")
@@ -1,25 +1,47 @@
 import os
+import time
+import atexit
 import logging
+import threading
+from collections import defaultdict
+from datetime import datetime, timezone, timedelta
+from dateutil import parser
 from dotenv import load_dotenv
-from supabase import create_client
-from datetime import datetime, timezone
+from flask import request
+from servicios import supabase
+from configuracion_bot import obtener_configuracion_bot
+from registro_interacciones import RegistroInteracciones
 
 # ✅ Cargar variables de entorno
 load_dotenv()
 
-# ✅ Inicializar Supabase
-supabase = create_client(
-    os.getenv("SUPABASE_URL"),
-    os.getenv("SUPABASE_SERVICE_ROLE_KEY")
-)
+# 🕐 Máximo de horas que se pueden pedir a /kpi/resumen
+KPI_HORAS_RETENIDAS = int(os.getenv("KPI_HORAS_RETENIDAS", 48))
+# ⏱️ Cada cuánto se suman los contadores de este proceso a kpi_por_hora
+KPI_VACIADO_S = float(os.getenv("KPI_VACIADO_S", 30))
+
+# Los eventos crudos se escriben en lote, fuera del request
+registro_kpi = RegistroInteracciones(tabla="kpi_conversaciones")
+atexit.register(registro_kpi.vaciar)
+
+# (negocio, tipo_evento, hora) -> {"eventos": n, "valor": suma} que aún no se suman a kpi_por_hora
+_pendientes = defaultdict(lambda: {"eventos": 0, "valor": 0.0})
+_lock = threading.Lock()
+_hilo = None
+
+
+def _hora(momento):
+    return momento.replace(minute=0, second=0, microsecond=0)
+
 
 # ✅ Función para registrar eventos KPI
-def registrar_kpi_evento(conversation_id, tipo_evento, user_id=None, valor=None):
+def registrar_kpi_evento(conversation_id, tipo_evento, user_id=None, valor=None, negocio=None):
     try:
+        ahora = datetime.now(timezone.utc)
         evento = {
             "conversation_id": conversation_id,
             "tipo_evento": tipo_evento,
-            "timestamp": datetime.now(timezone.utc).isoformat()
+            "timestamp": ahora.isoformat()
         }
 
         if user_id:
@@ -27,7 +49,117 @@ def registrar_kpi_evento(conversation_id, tipo_evento, user_id=None, valor=None)
         if valor:
             evento["valor"] = valor
 
-        supabase.from_("kpi_conversaciones").insert(evento).execute()
+        registro_kpi.insertar(evento)
+
+        negocio = negocio or obtener_configuracion_bot().get("negocio", "generico")
+        with _lock:
+            _asegurar_hilo()
+            agregado = _pendientes[(negocio, tipo_evento, _hora(ahora))]
+            agregado["eventos"] += 1
+            if isinstance(valor, (int, float)):
+                agregado["valor"] += valor
         logging.info(f"📊 KPI registrado: {tipo_evento}")
     except Exception as e:
         logging.error(f"❌ Error registrando KPI: {e}")
+
+
+def _asegurar_hilo():
+    # Llamar con _lock tomado
+    global _hilo
+    if _hilo is None:
+        _hilo = threading.Thread(target=_trabajar, name="kpi-agregados", daemon=True)
+        _hilo.start()
+
+
+def _trabajar():
+    while True:
+        time.sleep(KPI_VACIADO_S)
+        vaciar_agregados()
+
+
+# ✅ Suma los contadores de este proceso a kpi_por_hora (sql/kpi_por_hora.sql)
+def vaciar_agregados():
+    with _lock:
+        pendientes = {clave: dict(valores) for clave, valores in _pendientes.items()}
+        _pendientes.clear()
+    if not pendientes:
+        return
+
+    filas = [
+        {"negocio": n, "tipo_evento": t, "hora": h.isoformat(), **valores}
+        for (n, t, h), valores in pendientes.items()
+    ]
+    try:
+        supabase.rpc("sumar_kpi_por_hora", {"filas": filas}).execute()
+    except Exception as e:
+        logging.warning(f"⚠️ No se pudieron sumar {len(filas)} contadores KPI, se reintenta después: {e}")
+        with _lock:
+            for clave, valores in pendientes.items():
+                agregado = _pendientes[clave]
+                agregado["eventos"] += valores["eventos"]
+                agregado["valor"] += valores["valor"]
+            _podar(datetime.now(timezone.utc))
+
+
+def _podar(ahora):
+    # Llamar con _lock tomado: si la base no responde, no se acumulan horas sin límite
+    limite = _hora(ahora) - timedelta(hours=KPI_HORAS_RETENIDAS)
+    for clave in [c for c in _pendientes if c[2] < limite]:
+        del _pendientes[clave]
+
+
+# ✅ Contadores por (negocio, evento, hora) de las últimas `horas`, de todos los procesos
+def obtener_resumen_kpi(horas=24, negocio=None, tipo_evento=None):
+    desde = _hora(datetime.now(timezone.utc)) - timedelta(hours=max(0, horas - 1))
+
+    consulta = supabase.from_("kpi_por_hora")\
+        .select("negocio, tipo_evento, hora, eventos, valor")\
+        .gte("hora", desde.isoformat())
+    if negocio:
+        consulta = consulta.eq("negocio", negocio)
+    if tipo_evento:
+        consulta = consulta.eq("tipo_evento", tipo_evento)
+
+    agregados = defaultdict(lambda: {"eventos": 0, "valor": 0.0})
+    for fila in consulta.execute().data or []:
+        agregado = agregados[(fila["negocio"], fila["tipo_evento"], parser.isoparse(fila["hora"]))]
+        agregado["eventos"] += fila["eventos"]
+        agregado["valor"] += fila["valor"] or 0.0
+
+    # Lo de este proceso que todavía no se suma a la tabla
+    with _lock:
+        for (n, t, h), valores in _pendientes.items():
+            if h >= desde and (not negocio or n == negocio) and (not tipo_evento or t == tipo_evento):
+                agregado = agregados[(n, t, h)]
+                agregado["eventos"] += valores["eventos"]
+                agregado["valor"] += valores["valor"]
+
+    filas = [
+        {"negocio": n, "tipo_evento": t, "hora": h.isoformat(), **valores}
+        for (n, t, h), valores in agregados.items()
+    ]
+    filas.sort(key=lambda f: (f["hora"], f["negocio"], f["tipo_evento"]))
+
+    totales = defaultdict(int)
+    for fila in filas:
+        totales[fila["tipo_evento"]] += fila["eventos"]
+    return {"desde": desde.isoformat(), "totales": dict(totales), "por_hora": filas}
+
+
+# === Endpoint (se registra en bot.py con add_url_rule) ===
+def resumen_kpi():
+    horas = min(request.args.get("horas", 24, type=int), KPI_HORAS_RETENIDAS)
+    try:
+        resumen = obtener_resumen_kpi(
+            horas=horas,
+            negocio=request.args.get("negocio"),
+            tipo_evento=request.args.get("tipo_evento")
+        )
+    except Exception as e:
+        logging.error(f"❌ Error leyendo kpi_por_hora: {e}")
+        return {"error": "No se pudo leer kpi_por_hora"}, 503
+    return resumen, 200
+
+
+# 🧯 Los contadores que queden en memoria se suman al apagar el proceso
+atexit.register(vaciar_agregados)
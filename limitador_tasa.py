@@ -0,0 +1,54 @@
+import time
+import threading
+
+
+class LimitadorTasa:
+    """
+    Cubeta de fichas: permite `por_segundo` operaciones sostenidas y
+    ráfagas de hasta `rafaga`. tomar() bloquea hasta que haya ficha, así
+    que los hilos que comparten un limitador se reparten la tasa.
+    """
+
+    def __init__(self, por_segundo, rafaga=None):
+        self.por_segundo = float(por_segundo)
+        self.rafaga = float(rafaga or max(1.0, self.por_segundo))
+        self._fichas = self.rafaga
+        self._ultimo = time.monotonic()
+        self._lock = threading.Lock()
+        self._contadores = {"tomadas": 0, "esperas": 0, "espera_total_s": 0.0}
+
+    def _rellenar(self, ahora):
+        # Llamar con self._lock tomado
+        self._fichas = min(self.rafaga, self._fichas + (ahora - self._ultimo) * self.por_segundo)
+        self._ultimo = ahora
+
+    def tomar(self, fichas=1, timeout=None):
+        """Espera a que haya `fichas`; devuelve False si se agotó el timeout."""
+        limite = None if timeout is None else time.monotonic() + timeout
+        esperado = 0.0
+        while True:
+            with self._lock:
+                ahora = time.monotonic()
+                self._rellenar(ahora)
+                if self._fichas >= fichas:
+                    self._fichas -= fichas
+                    self._contadores["tomadas"] += 1
+                    if esperado:
+                        self._contadores["esperas"] += 1
+                        self._contadores["espera_total_s"] += esperado
+                    return True
+                falta = (fichas - self._fichas) / self.por_segundo
+            if limite is not None and ahora + falta > limite:
+                return False
+            time.sleep(falta)
+            esperado += falta
+
+    def metricas(self):
+        with self._lock:
+            self._rellenar(time.monotonic())
+            return {
+                **self._contadores,
+                "espera_total_s": round(self._contadores["espera_total_s"], 3),
+                "fichas": round(self._fichas, 2),
+                "por_segundo": self.por_segundo,
+            }
@@ -0,0 +1,84 @@
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict
+from arranque import importar_perezoso
+np = importar_perezoso("numpy")
+from dotenv import load_dotenv
+from servicios import supabase
+from indice_fragmentos import parsear_vector
+from indice_intenciones import normalizar
+from servicio_embeddings import obtener_embeddings
+
+# ✅ Cargar variables de entorno
+load_dotenv()
+
+# ⏳ La caché se invalida al guardar un resumen; el TTL cubre a los demás procesos
+MEMORIA_USUARIO_TTL = int(os.getenv("MEMORIA_USUARIO_TTL", 600))
+MEMORIA_USUARIO_MAX = int(os.getenv("MEMORIA_USUARIO_MAX", 5000))
+
+_cache = OrderedDict()
+_lock = threading.Lock()
+
+
+class MemoriaUsuario:
+    """Últimos resúmenes de un usuario y el centroide normalizado de sus vectores."""
+    __slots__ = ("texto", "centroide")
+
+    def __init__(self, texto, centroide):
+        self.texto = texto
+        self.centroide = centroide
+
+    def similitud(self, vector):
+        return float(self.centroide @ normalizar(vector))
+
+
+def _cargar(user_id, cuantos):
+    resultado = supabase.from_("user_summary_embeddings")\
+        .select("resumen_texto, embedding_vector, created_at")\
+        .eq("user_id", user_id)\
+        .order("created_at", desc=True)\
+        .limit(cuantos)\
+        .execute()
+    filas = [f for f in reversed(resultado.data or []) if f.get("resumen_texto")]
+    if not filas:
+        return None
+
+    vectores = [parsear_vector(f.get("embedding_vector")) for f in filas]
+    # Resúmenes antiguos sin vector guardado: se embeben (y quedan en la caché de embeddings)
+    sin_vector = [i for i, v in enumerate(vectores) if v is None]
+    if sin_vector:
+        for i, vector in zip(sin_vector, obtener_embeddings([filas[i]["resumen_texto"] for i in sin_vector])):
+            vectores[i] = vector
+
+    centroide = normalizar(normalizar(np.asarray(vectores, dtype=np.float32)).mean(axis=0))
+    texto = "\n".join(f["resumen_texto"] for f in filas)
+    return MemoriaUsuario(texto, centroide)
+
+
+# ✅ Memoria del usuario desde caché; solo consulta Supabase si caducó o cambió
+def obtener_memoria_usuario(user_id, cuantos=3):
+    with _lock:
+        guardado = _cache.get(user_id)
+        if guardado and guardado[0] > time.monotonic() and guardado[1] == cuantos:
+            _cache.move_to_end(user_id)
+            return guardado[2]
+
+    try:
+        memoria = _cargar(user_id, cuantos)
+    except Exception as e:
+        logging.error(f"❌ Error obteniendo memoria del usuario: {e}")
+        return None
+
+    with _lock:
+        _cache[user_id] = (time.monotonic() + MEMORIA_USUARIO_TTL, cuantos, memoria)
+        _cache.move_to_end(user_id)
+        while len(_cache) > MEMORIA_USUARIO_MAX:
+            _cache.popitem(last=False)
+    return memoria
+
+
+def invalidar_memoria_usuario(user_id):
+    with _lock:
+        _cache.pop(user_id, None)
@@ -0,0 +1,291 @@
+import os
+import time
+import atexit
+import zlib
+import queue
+import logging
+import threading
+from collections import deque
+from concurrent.futures import Future
+from arranque import importar_perezoso
+from dotenv import load_dotenv
+from limitador_tasa import LimitadorTasa
+from estadisticas import percentil
+from trazas import dependencia, contexto_actual
+from servicios import sesion_http
+
+requests = importar_perezoso("requests")
+excepciones_urllib3 = importar_perezoso("urllib3.exceptions")
+
+# ✅ Cargar variables de entorno
+load_dotenv()
+
+TWILIO_SID = os.getenv("TWILIO_ACCOUNT_SID")
+TWILIO_AUTH = os.getenv("TWILIO_AUTH_TOKEN")
+TWILIO_WHATSAPP_NUMBER = os.getenv("TWILIO_WHATSAPP_NUMBER")
+TWILIO_API_URL = os.getenv("TWILIO_API_URL", "https://api.twilio.com")
+FB_GRAPH_URL = os.getenv("FB_GRAPH_URL", "https://graph.facebook.com/v17.0")
+
+# 📤 Carriles de envío: un mismo destino siempre usa el mismo, así sus mensajes llegan en orden
+MENSAJERIA_CARRILES = int(os.getenv("MENSAJERIA_CARRILES", 8))
+# Tasa sostenida por número/página remitente (mensajes por segundo)
+MENSAJERIA_POR_S_REMITENTE = float(os.getenv("MENSAJERIA_POR_S_REMITENTE", 20))
+MENSAJERIA_MAX_INTENTOS = int(os.getenv("MENSAJERIA_MAX_INTENTOS", 4))
+MENSAJERIA_TIMEOUT_S = float(os.getenv("MENSAJERIA_TIMEOUT_S", 10))
+REINTENTABLES = {429, 500, 502, 503, 504}
+
+
+class ErrorEnvio(Exception):
+    def __init__(self, mensaje, status=None):
+        super().__init__(mensaje)
+        self.status = status
+
+
+def _sin_conectar(error):
+    """La petición no salió (no hubo conexión): solo entonces reenviar no puede duplicar."""
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    causa = error.args[0] if error.args else None
+    # requests envuelve MaxRetryError; su `reason` dice si falló al conectar o ya con la conexión abierta
+    causa = getattr(causa, "reason", causa)
+    return isinstance(causa, (excepciones_urllib3.NewConnectionError, excepciones_urllib3.ConnectTimeoutError))
+
+
+def con_prefijo(numero, prefijo="whatsapp:"):
+    """'+521...' o 'whatsapp:+521...' -> 'whatsapp:+521...' (sin duplicar el prefijo)."""
+    numero = (numero or "").strip()
+    return numero if numero.startswith(prefijo) else f"{prefijo}{numero}"
+
+
+class Mensaje:
+    __slots__ = ("canal", "destino", "texto", "extra", "futuro", "encolado", "contexto")
+
+    def __init__(self, canal, destino, texto, extra):
+        self.canal = canal
+        self.destino = destino
+        self.texto = texto
+        self.extra = extra
+        self.futuro = Future()
+        self.encolado = time.monotonic()
+        # El envío se mide dentro de la traza de quien lo encoló
+        self.contexto = contexto_actual()
+
+
+# === Canales ===
+class CanalWhatsApp:
+    """WhatsApp por la API REST de Twilio. extra: persistent_action=[...], media_url=..."""
+    nombre = "whatsapp"
+    servicio = "twilio"
+
+    def __init__(self, sid=TWILIO_SID, token=TWILIO_AUTH, numero=TWILIO_WHATSAPP_NUMBER, base_url=TWILIO_API_URL):
+        self.sid = sid
+        self.token = token
+        self.numero = con_prefijo(numero)
+        self.url = f"{base_url}/2010-04-01/Accounts/{sid}/Messages.json"
+
+    def remitente(self, mensaje):
+        return self.numero
+
+    def enviar(self, sesion, mensaje):
+        datos = [("From", self.numero), ("To", con_prefijo(mensaje.destino)), ("Body", mensaje.texto)]
+        for accion in mensaje.extra.get("persistent_action") or []:
+            datos.append(("PersistentAction", accion))
+        if mensaje.extra.get("media_url"):
+            datos.append(("MediaUrl", mensaje.extra["media_url"]))
+        return sesion.post(self.url, data=datos, auth=(self.sid, self.token), timeout=MENSAJERIA_TIMEOUT_S)
+
+    def identificador(self, respuesta):
+        try:
+            return respuesta.json().get("sid")
+        except ValueError:
+            return None
+
+
+class CanalMessenger:
+    """Facebook Messenger por la Graph API (Send API)."""
+    nombre = "messenger"
+    servicio = "messenger"
+
+    def __init__(self, token=None, base_url=FB_GRAPH_URL):
+        self.token = token or os.getenv("FB_PAGE_ACCESS_TOKEN")
+        self.url = f"{base_url}/me/messages"
+
+    def remitente(self, mensaje):
+        return "messenger"
+
+    def enviar(self, sesion, mensaje):
+        payload = {"recipient": {"id": mensaje.destino}, "message": {"text": mensaje.texto}}
+        return sesion.post(self.url, params={"access_token": self.token}, json=payload, timeout=MENSAJERIA_TIMEOUT_S)
+
+    def identificador(self, respuesta):
+        try:
+            return respuesta.json().get("message_id")
+        except ValueError:
+            return None
+
+
+class ServicioMensajeria:
+    """
+    Todos los mensajes salientes pasan por aquí.
+
+    enviar() encola y devuelve un Future con el id del proveedor (sid de
+    Twilio, message_id de Messenger). Cada carril es un hilo; el destino
+    elige el carril, así que los mensajes a un usuario salen en orden.
+    Usa la sesión HTTP compartida de servicios.py, limita la tasa por
+    remitente y reintenta con espera exponencial los 429/5xx y los errores
+    de conexión, respetando Retry-After. Un timeout de lectura no se
+    reintenta: el mensaje pudo haber salido.
+    """
+
+    def __init__(self, num_carriles=MENSAJERIA_CARRILES, por_s_remitente=MENSAJERIA_POR_S_REMITENTE,
+                 max_intentos=MENSAJERIA_MAX_INTENTOS, sesion=None):
+        self.num_carriles = max(1, num_carriles)
+        self.por_s_remitente = por_s_remitente
+        self.max_intentos = max_intentos
+        self._sesion = sesion
+        self._canales = {}
+        self._limitadores = {}
+        self._colas = [queue.Queue() for _ in range(self.num_carriles)]
+        self._hilos = []
+        self._lock = threading.Lock()
+        self._latencias = deque(maxlen=1000)
+        self._entregados_en = deque(maxlen=10000)
+        self._contadores = {"encolados": 0, "enviados": 0, "fallidos": 0, "reintentos": 0, "inciertos": 0}
+        self._por_canal = {}
+
+    @property
+    def sesion(self):
+        return self._sesion or sesion_http()
+
+    def registrar_canal(self, canal):
+        self._canales[canal.nombre] = canal
+
+    def _asegurar_hilos(self):
+        if self._hilos:
+            return
+        with self._lock:
+            if self._hilos:
+                return
+            for i, cola in enumerate(self._colas):
+                hilo = threading.Thread(target=self._trabajar, args=(cola,), name=f"mensajeria-{i}", daemon=True)
+                hilo.start()
+                self._hilos.append(hilo)
+
+    def enviar(self, destino, texto, canal="whatsapp", **extra):
+        if canal not in self._canales:
+            raise ValueError(f"Canal de mensajería desconocido: {canal}")
+        self._asegurar_hilos()
+        mensaje = Mensaje(canal, destino, texto, extra)
+        # "+521..." y "whatsapp:+521..." son el mismo destino y van al mismo carril
+        carril = zlib.crc32(f"{canal}:{destino.split(':')[-1]}".encode("utf-8")) % self.num_carriles
+        with self._lock:
+            self._contadores["encolados"] += 1
+        self._colas[carril].put(mensaje)
+        return mensaje.futuro
+
+    def _limitador(self, remitente):
+        with self._lock:
+            limitador = self._limitadores.get(remitente)
+            if limitador is None:
+                limitador = self._limitadores[remitente] = LimitadorTasa(self.por_s_remitente)
+            return limitador
+
+    def _trabajar(self, cola):
+        while True:
+            mensaje = cola.get()
+            try:
+                mensaje.contexto.run(self._entregar, mensaje)
+            except Exception as e:
+                # No debería pasar: _entregar resuelve el Future en todos los casos
+                if not mensaje.futuro.done():
+                    mensaje.futuro.set_exception(e)
+                logging.error(f"❌ Error inesperado en mensajería: {e}")
+            finally:
+                cola.task_done()
+
+    def _entregar(self, mensaje):
+        canal = self._canales[mensaje.canal]
+        limitador = self._limitador(canal.remitente(mensaje))
+        error = None
+
+        for intento in range(1, self.max_intentos + 1):
+            limitador.tomar()
+            espera = 0.5 * 2 ** (intento - 1)
+            try:
+                with dependencia(canal.servicio, "enviar", intento=intento) as span:
+                    respuesta = canal.enviar(self.sesion, mensaje)
+                    span.atributos["status"] = respuesta.status_code
+            except requests.RequestException as e:
+                if _sin_conectar(e):
+                    # No llegó a conectarse: reenviar no puede duplicar el mensaje
+                    error, reintentable = ErrorEnvio(f"Error de red: {e}"), True
+                else:
+                    # Timeout de lectura, conexión cortada, etc. con la petición ya enviada: el proveedor
+                    # pudo aceptarla, y un POST a Messages.json repetido le llega dos veces al usuario
+                    error, reintentable = ErrorEnvio(f"Resultado incierto, no se reintenta: {e}"), False
+                    with self._lock:
+                        self._contadores["inciertos"] += 1
+            else:
+                if respuesta.status_code < 300:
+                    self._registrar_entrega(mensaje)
+                    mensaje.futuro.set_result(canal.identificador(respuesta))
+                    return
+                error = ErrorEnvio(f"HTTP {respuesta.status_code}: {respuesta.text[:200]}", respuesta.status_code)
+                reintentable = respuesta.status_code in REINTENTABLES
+                retry_after = respuesta.headers.get("Retry-After")
+                if retry_after and retry_after.isdigit():
+                    espera = max(espera, int(retry_after))
+
+            if not reintentable or intento == self.max_intentos:
+                break
+            with self._lock:
+                self._contadores["reintentos"] += 1
+            logging.warning(f"⚠️ Reintentando {mensaje.canal} a {mensaje.destino} en {espera}s (intento {intento}): {error}")
+            time.sleep(espera)
+
+        with self._lock:
+            self._contadores["fallidos"] += 1
+            self._por_canal.setdefault(mensaje.canal, {"enviados": 0, "fallidos": 0})["fallidos"] += 1
+        logging.error(f"❌ No se pudo enviar {mensaje.canal} a {mensaje.destino}: {error}")
+        mensaje.futuro.set_exception(error)
+
+    def _registrar_entrega(self, mensaje):
+        ahora = time.monotonic()
+        with self._lock:
+            self._contadores["enviados"] += 1
+            self._por_canal.setdefault(mensaje.canal, {"enviados": 0, "fallidos": 0})["enviados"] += 1
+            self._latencias.append(ahora - mensaje.encolado)
+            self._entregados_en.append(ahora)
+
+    def esperar_pendientes(self, timeout=10):
+        """Espera (hasta timeout) a que se vacíen los carriles; útil al apagar o en scripts."""
+        limite = time.monotonic() + timeout
+        for cola in self._colas:
+            while cola.unfinished_tasks and time.monotonic() < limite:
+                time.sleep(0.05)
+
+    def metricas(self):
+        ahora = time.monotonic()
+        with self._lock:
+            latencias = sorted(self._latencias)
+            ultimo_minuto = sum(1 for t in self._entregados_en if ahora - t <= 60)
+
+            def en_ms(p):
+                valor = percentil(latencias, p)
+                return None if valor is None else round(valor * 1000, 1)
+
+            return {
+                **self._contadores,
+                "en_cola": sum(c.qsize() for c in self._colas),
+                "por_canal": {c: dict(v) for c, v in self._por_canal.items()},
+                "enviados_ultimo_minuto": ultimo_minuto,
+                "latencia_ms": {"p50": en_ms(0.50), "p95": en_ms(0.95), "p99": en_ms(0.99)},
+                "limitadores": {r: l.metricas() for r, l in self._limitadores.items()},
+            }
+
+
+mensajeria = ServicioMensajeria()
+mensajeria.registrar_canal(CanalWhatsApp())
+mensajeria.registrar_canal(CanalMessenger())
+# 🧯 Lo que quede en los carriles se intenta enviar antes de apagar el proceso
+atexit.register(mensajeria.esperar_pendientes)
@@ -0,0 +1,163 @@
+import os
+import json
+import logging
+import threading
+import unicodedata
+from collections import deque
+from functools import lru_cache
+
+# 📁 Frases extra por negocio: {"categoria": ["frase", ...]} (se suman a las de base)
+PALABRAS_CLAVE_ARCHIVO = os.getenv("PALABRAS_CLAVE_ARCHIVO")
+
+# ✅ Todas las listas de frases del bot, por categoría
+CATEGORIAS_BASE = {
+    "ubicacion": [
+        "ubicacion", "direccion", "donde estan", "donde se ubican",
+        "estan ubicados", "me puede mandar la ubicacion", "donde se encuentran"
+    ],
+    "horarios": [
+        "horario", "a que hora", "cuando abren", "cuando cierran",
+        "cual es su horario", "estan abiertos"
+    ],
+    "precios": [
+        "precio", "cuanto cuesta", "tienen precios", "tarifas", "costo", "vale"
+    ],
+    "reserva": [
+        "reservar", "reserva", "agendar", "quiero una cita",
+        "quiero hacer una cita", "quiero hacer una reserva",
+        "agenda", "necesito una cita", "quiero agendar",
+        "me puedes apartar", "quiero una mesa", "hacer cita"
+    ],
+    "reagendar": [
+        "cambiar mi cita", "modificar mi cita", "reagendar", "reprogramar",
+        "mover la cita", "cambiar la hora", "otra hora", "otra fecha",
+        "cambiar fecha", "nueva fecha", "nueva hora", "ajustar cita", "editar cita"
+    ],
+    "cierre": [
+        "eso es todo", "sería todo", "me despido", "nos vemos", "adiós",
+        "puedes cerrar la conversación", "no tengo más dudas", "por el momento es todo",
+        "hasta luego", "gracias por tu ayuda", "gracias por la información",
+        "puedes finalizar", "puedes cerrar", "listo", "ya está", "ya quedó", "ok gracias"
+    ],
+    "promocion": ["promocion", "promo", "descuento", "oferta", "rebaja"],
+    "rechazo": ["luego", "revisar", "pensarlo", "pienso"],
+    "interes": ["me interesa", "cuánto cuesta", "quiero"],
+    "urgencia": ["urge", "lo necesito", "ya"],
+    "cotizacion": ["cotiza"],
+}
+
+
+def normalizar_texto(texto):
+    """Minúsculas y sin acentos; texto y frases se comparan así."""
+    return "".join(
+        c for c in unicodedata.normalize("NFD", (texto or "").lower())
+        if unicodedata.category(c) != "Mn"
+    )
+
+
+class Automata:
+    """
+    Aho-Corasick sobre las frases de todas las categorías.
+    Recorre el texto una sola vez y devuelve las categorías encontradas
+    (coincidencia por subcadena, igual que `frase in texto`).
+    """
+
+    def __init__(self, categorias):
+        self._siguiente = [{}]
+        self._fallo = [0]
+        self._salida = [frozenset()]
+
+        for categoria, frases in categorias.items():
+            for frase in frases:
+                frase = normalizar_texto(frase)
+                if frase:
+                    self._agregar(frase, categoria)
+        self._enlazar()
+
+    def _agregar(self, frase, categoria):
+        estado = 0
+        for c in frase:
+            siguiente = self._siguiente[estado].get(c)
+            if siguiente is None:
+                siguiente = len(self._siguiente)
+                self._siguiente[estado][c] = siguiente
+                self._siguiente.append({})
+                self._fallo.append(0)
+                self._salida.append(frozenset())
+            estado = siguiente
+        self._salida[estado] = self._salida[estado] | {categoria}
+
+    def _enlazar(self):
+        cola = deque(self._siguiente[0].values())
+        while cola:
+            estado = cola.popleft()
+            for c, hijo in self._siguiente[estado].items():
+                cola.append(hijo)
+                fallo = self._fallo[estado]
+                while fallo and c not in self._siguiente[fallo]:
+                    fallo = self._fallo[fallo]
+                destino = self._siguiente[fallo].get(c, 0)
+                self._fallo[hijo] = destino if destino != hijo else 0
+                self._salida[hijo] = self._salida[hijo] | self._salida[self._fallo[hijo]]
+
+    def buscar(self, texto_normalizado):
+        encontradas = set()
+        estado = 0
+        siguiente, fallo, salida = self._siguiente, self._fallo, self._salida
+        for c in texto_normalizado:
+            while estado and c not in siguiente[estado]:
+                estado = fallo[estado]
+            estado = siguiente[estado].get(c, 0)
+            if salida[estado]:
+                encontradas |= salida[estado]
+        return frozenset(encontradas)
+
+
+_categorias = {categoria: list(frases) for categoria, frases in CATEGORIAS_BASE.items()}
+_automata = None
+_lock = threading.Lock()
+
+
+def _cargar_archivo():
+    if not PALABRAS_CLAVE_ARCHIVO:
+        return
+    try:
+        with open(PALABRAS_CLAVE_ARCHIVO, encoding="utf-8") as f:
+            extras = json.load(f)
+        for categoria, frases in extras.items():
+            _categorias.setdefault(categoria, []).extend(frases)
+        logging.info(f"🔤 Frases de negocio cargadas desde {PALABRAS_CLAVE_ARCHIVO}")
+    except Exception as e:
+        logging.error(f"❌ Error cargando {PALABRAS_CLAVE_ARCHIVO}: {e}")
+
+
+def _reconstruir():
+    # Llamar con _lock tomado
+    global _automata
+    _automata = Automata(_categorias)
+    categorias_en.cache_clear()
+
+
+# ✅ Agrega (o reemplaza) frases de una categoría y recompila el autómata
+def registrar_frases(categoria, frases, reemplazar=False):
+    with _lock:
+        if reemplazar:
+            _categorias[categoria] = list(frases)
+        else:
+            _categorias.setdefault(categoria, []).extend(frases)
+        _reconstruir()
+
+
+# ✅ Categorías presentes en el texto: se normaliza una vez y se recorre una vez
+@lru_cache(maxsize=2048)
+def categorias_en(texto):
+    return _automata.buscar(normalizar_texto(texto))
+
+
+def contiene(texto, categoria):
+    return categoria in categorias_en(texto)
+
+
+with _lock:
+    _cargar_archivo()
+    _reconstruir()
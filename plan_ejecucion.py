@@ -0,0 +1,55 @@
+import os
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from trazas import etapa as etapa_trazada, contexto_actual
+
+# 🧵 Hilos compartidos por todos los mensajes para las etapas que corren en paralelo
+PLAN_MAX_HILOS = int(os.getenv("PLAN_MAX_HILOS", 16))
+
+_executor = ThreadPoolExecutor(max_workers=PLAN_MAX_HILOS, thread_name_prefix="plan")
+
+
+class PlanEjecucion:
+    """
+    Etapas independientes de un mensaje que corren a la vez.
+
+    lanzar() arranca una etapa en el pool compartido; esperar() da su
+    resultado (y propaga su excepción) solo cuando hace falta. Las etapas
+    que son puro efecto secundario se juntan con esperar_todo().
+    Una etapa no debe lanzar ni esperar otras etapas: el pool es acotado.
+    """
+
+    def __init__(self, nombre="mensaje"):
+        self.nombre = nombre
+        self._tareas = {}
+        self._duraciones = {}
+        self._inicio = time.monotonic()
+
+    def lanzar(self, etapa, funcion, *args, **kwargs):
+        def medir():
+            inicio = time.monotonic()
+            try:
+                with etapa_trazada(etapa):
+                    return funcion(*args, **kwargs)
+            finally:
+                self._duraciones[etapa] = time.monotonic() - inicio
+
+        # La etapa corre en otro hilo pero sus spans van a la traza de este mensaje
+        self._tareas[etapa] = _executor.submit(contexto_actual().run, medir)
+        return self._tareas[etapa]
+
+    def esperar(self, etapa):
+        return self._tareas.pop(etapa).result()
+
+    def esperar_todo(self):
+        tareas, self._tareas = self._tareas, {}
+        for etapa, tarea in tareas.items():
+            try:
+                tarea.result()
+            except Exception as e:
+                logging.error(f"❌ Error en etapa '{etapa}' del plan: {e}")
+
+        if self._duraciones:
+            detalle = ", ".join(f"{etapa} {segundos:.2f}s" for etapa, segundos in self._duraciones.items())
+            logging.info(f"⏱️ Plan {self.nombre}: {time.monotonic() - self._inicio:.2f}s total ({detalle})")
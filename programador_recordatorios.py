@@ -0,0 +1,293 @@
+import os
+import time
+import heapq
+import logging
+import threading
+import itertools
+from datetime import datetime, timezone, timedelta
+from dateutil import parser
+from dotenv import load_dotenv
+from servicios import supabase
+from trazas import traza
+
+# ✅ Cargar variables de entorno
+load_dotenv()
+
+# 🔄 Cada cuánto se leen las reservas nuevas o modificadas (por marca de agua)
+RECORDATORIOS_REFRESCO_S = int(os.getenv("RECORDATORIOS_REFRESCO_S", 60))
+# Columna de reservaciones que cambia en cada insert/update (timestamptz, ver sql/reservaciones_updated_at.sql)
+RECORDATORIOS_COLUMNA_CAMBIO = os.getenv("RECORDATORIOS_COLUMNA_CAMBIO", "updated_at")
+# Un evento que se atrasó más que esto (p. ej. el proceso estuvo caído) ya no se envía
+RECORDATORIOS_GRACIA_MIN = int(os.getenv("RECORDATORIOS_GRACIA_MIN", 30))
+RECORDATORIOS_PAGINA = 500
+
+COLUMNAS = "id, user_id, cliente_nombre, fecha_reserva, estado, conversation_id, recordatorio_24h_enviado, recordatorio_1h_enviado"
+
+# tipo -> (momento relativo a la cita, columna que marca el envío, cambios que reclaman el evento)
+EVENTOS = {
+    "recordatorio_24h": (timedelta(hours=-24), "recordatorio_24h_enviado", {"recordatorio_24h_enviado": True}),
+    "recordatorio_1h": (timedelta(hours=-1), "recordatorio_1h_enviado", {"recordatorio_1h_enviado": True}),
+    "seguimiento": (timedelta(minutes=10), None, {"estado": "esperando_confirmacion"}),
+}
+
+
+def _fecha(valor):
+    try:
+        fecha = parser.isoparse(valor)
+        return fecha if fecha.tzinfo else fecha.replace(tzinfo=timezone.utc)
+    except Exception:
+        return None
+
+
+class ProgramadorRecordatorios:
+    """
+    Recordatorios de citas a la hora exacta.
+
+    Guarda en un heap los eventos de cada reserva pendiente (24 h antes,
+    1 h antes y 10 min después) y un hilo duerme hasta el siguiente. Las
+    reservas se cargan una vez y después solo las nuevas o modificadas
+    desde la última marca de agua (columna RECORDATORIOS_COLUMNA_CAMBIO);
+    programar() agenda al instante las que cambian en este proceso.
+
+    Antes de enviar, cada evento se reclama con un update condicional
+    (solo si la reserva sigue pendiente y sin la marca): si el update no
+    devuelve la fila otro proceso ya lo tomó y aquí no se envía. Si el
+    envío falla, la marca se revierte.
+    """
+
+    def __init__(self, columna_cambio=RECORDATORIOS_COLUMNA_CAMBIO, refresco_s=RECORDATORIOS_REFRESCO_S,
+                 gracia_min=RECORDATORIOS_GRACIA_MIN, tam_pagina=RECORDATORIOS_PAGINA):
+        self.columna_cambio = columna_cambio
+        self.refresco_s = refresco_s
+        self.gracia = timedelta(minutes=gracia_min)
+        self.tam_pagina = tam_pagina
+        self._funciones = {}
+        self._heap = []
+        self._secuencia = itertools.count()
+        self._reservas = {}
+        self._programados = set()
+        self._marca_agua = None
+        self._incremental = True
+        self._condicion = threading.Condition()
+        self._hilo = None
+        self._contadores = {"enviados": 0, "atrasados": 0, "descartados": 0, "reclamados_por_otro": 0,
+                            "errores": 0, "filas_leidas": 0, "consultas": 0}
+
+    def registrar(self, tipo, funcion):
+        """funcion(reserva) envía el mensaje; si lanza excepción no se marca como enviado."""
+        self._funciones[tipo] = funcion
+
+    # ✅ Agenda (o reagenda) los eventos de una fila de reservaciones
+    def programar(self, reserva):
+        fecha_reserva = _fecha(reserva.get("fecha_reserva"))
+        if not reserva.get("id") or not fecha_reserva:
+            return
+        with self._condicion:
+            anterior = self._reservas.get(reserva["id"], {})
+            # Lo que este proceso ya envió cuenta aunque la fila leída aún no lo refleje
+            reserva = {**reserva}
+            for columna in ("recordatorio_24h_enviado", "recordatorio_1h_enviado"):
+                reserva[columna] = reserva.get(columna) or anterior.get(columna, False)
+            if anterior.get("estado") == "esperando_confirmacion" and reserva.get("estado") == "pendiente" \
+                    and anterior.get("fecha_reserva") == reserva.get("fecha_reserva"):
+                reserva["estado"] = anterior["estado"]
+            self._reservas[reserva["id"]] = reserva
+
+            if reserva.get("estado") != "pendiente":
+                return
+            limite = datetime.now(timezone.utc) - self.gracia
+            for tipo, (desfase, columna, _) in EVENTOS.items():
+                clave = (reserva["id"], tipo, reserva["fecha_reserva"])
+                if tipo not in self._funciones or (columna and reserva.get(columna)) or clave in self._programados:
+                    continue
+                # Una cita agendada con menos de 24 h de anticipación no lleva el aviso de 24 h
+                if fecha_reserva + desfase < limite:
+                    continue
+                self._programados.add(clave)
+                momento = (fecha_reserva + desfase).timestamp()
+                heapq.heappush(self._heap, (momento, next(self._secuencia), clave))
+            self._condicion.notify()
+
+    def iniciar(self):
+        if self._hilo is None:
+            self._hilo = threading.Thread(target=self._trabajar, name="programador-recordatorios", daemon=True)
+            self._hilo.start()
+            logging.info("⏰ Programador de recordatorios iniciado")
+
+    def _trabajar(self):
+        proxima_carga = 0.0
+        while True:
+            try:
+                ahora = datetime.now(timezone.utc).timestamp()
+                if ahora >= proxima_carga:
+                    self._cargar()
+                    proxima_carga = ahora + self.refresco_s
+                self._disparar_vencidos()
+
+                with self._condicion:
+                    siguiente = self._heap[0][0] if self._heap else proxima_carga
+                    espera = min(siguiente, proxima_carga) - datetime.now(timezone.utc).timestamp()
+                    if espera > 0:
+                        self._condicion.wait(timeout=espera)
+            except Exception as e:
+                logging.error(f"❌ Error en programador de recordatorios: {e}")
+                time.sleep(5)
+
+    # === Carga de reservas ===
+    def _cargar(self):
+        self._podar()
+        if self._marca_agua is None:
+            self._cargar_pendientes()
+        elif self._incremental:
+            try:
+                self._cargar_cambios()
+            except Exception as e:
+                # Sin columna de cambios se relee lo pendiente (filtrado en el servidor)
+                logging.warning(f"⚠️ No se pudo leer por {self.columna_cambio}, se recargan las pendientes: {e}")
+                self._incremental = False
+                self._cargar_pendientes()
+        else:
+            self._cargar_pendientes()
+
+    def _podar(self):
+        # Reservas cuyo último evento ya pasó: no hace falta recordarlas
+        limite = datetime.now(timezone.utc) - EVENTOS["seguimiento"][0] - self.gracia - timedelta(days=1)
+        with self._condicion:
+            for reserva_id in [i for i, r in self._reservas.items() if _fecha(r.get("fecha_reserva")) < limite]:
+                del self._reservas[reserva_id]
+
+    def _paginar(self, consulta, columna_orden, cursor=None):
+        """
+        Keyset: ordena por (columna_orden, id) y cada página pide las filas
+        posteriores a la última leída. Devuelve el cursor final (valor, id).
+        """
+        while True:
+            q = consulta()
+            if cursor is not None:
+                valor, ultimo_id = cursor
+                if ultimo_id is None:
+                    q = q.gte(columna_orden, valor)
+                else:
+                    q = q.or_(f'{columna_orden}.gt."{valor}",and({columna_orden}.eq."{valor}",id.gt.{ultimo_id})')
+            res = q.order(columna_orden).order("id").limit(self.tam_pagina).execute()
+            filas = res.data or []
+            with self._condicion:
+                self._contadores["consultas"] += 1
+                self._contadores["filas_leidas"] += len(filas)
+            for fila in filas:
+                self.programar(fila)
+            if filas:
+                cursor = (filas[-1][columna_orden], filas[-1]["id"])
+            if len(filas) < self.tam_pagina:
+                return cursor
+
+    def _cargar_pendientes(self):
+        inicio = datetime.now(timezone.utc)
+        # Solo las que aún pueden tener algún evento por enviar
+        desde = inicio - EVENTOS["seguimiento"][0] - self.gracia
+        self._paginar(
+            lambda: supabase.from_("reservaciones").select(COLUMNAS).eq("estado", "pendiente"),
+            "fecha_reserva",
+            cursor=(desde.isoformat(), None)
+        )
+        # Un poco hacia atrás por si el reloj del servidor va desfasado
+        self._marca_agua = ((inicio - timedelta(minutes=1)).isoformat(), None)
+        logging.info(f"⏰ Recordatorios cargados: {len(self._heap)} eventos programados")
+
+    def _cargar_cambios(self):
+        columna = self.columna_cambio
+        self._marca_agua = self._paginar(
+            lambda: supabase.from_("reservaciones").select(f"{COLUMNAS}, {columna}"),
+            columna,
+            cursor=self._marca_agua
+        )
+
+    # === Envío ===
+    def _disparar_vencidos(self):
+        ahora = datetime.now(timezone.utc)
+        with self._condicion:
+            vencidos = []
+            while self._heap and self._heap[0][0] <= ahora.timestamp():
+                momento, _, clave = heapq.heappop(self._heap)
+                vencidos.append((momento, clave))
+
+        for momento, (reserva_id, tipo, fecha_reserva) in vencidos:
+            with self._condicion:
+                self._programados.discard((reserva_id, tipo, fecha_reserva))
+                reserva = self._reservas.get(reserva_id)
+                columna = EVENTOS[tipo][1]
+                vigente = (
+                    reserva is not None
+                    and reserva.get("estado") == "pendiente"
+                    and reserva.get("fecha_reserva") == fecha_reserva
+                    and not (columna and reserva.get(columna))
+                )
+            if not vigente:
+                # La reserva se canceló, se movió o ya se envió desde otra carga
+                self._contadores["descartados"] += 1
+                continue
+            if ahora - datetime.fromtimestamp(momento, timezone.utc) > self.gracia:
+                self._contadores["atrasados"] += 1
+                logging.warning(f"⚠️ {tipo} de la reserva {reserva_id} ya no se envía: venció hace más de {self.gracia}")
+                continue
+
+            try:
+                reclamado = self._reclamar(reserva_id, tipo, fecha_reserva)
+            except Exception as e:
+                self._contadores["errores"] += 1
+                logging.error(f"❌ Error reclamando {tipo} de la reserva {reserva_id}: {e}")
+                continue
+            cambios = EVENTOS[tipo][2]
+            with self._condicion:
+                reserva.update(cambios)
+            if not reclamado:
+                # Otro proceso ya lo envió (o la reserva cambió en la base)
+                self._contadores["reclamados_por_otro"] += 1
+                continue
+
+            try:
+                with traza(tipo, reserva_id=reserva_id, conversation_id=reserva.get("conversation_id")):
+                    self._funciones[tipo](reserva)
+            except Exception as e:
+                self._contadores["errores"] += 1
+                logging.error(f"❌ Error enviando {tipo} de la reserva {reserva_id}: {e}")
+                self._liberar(reserva_id, tipo)
+                continue
+            self._contadores["enviados"] += 1
+
+    # ✅ Solo un proceso gana el update condicional: el que recibe la fila de vuelta envía
+    def _reclamar(self, reserva_id, tipo, fecha_reserva):
+        _, columna, cambios = EVENTOS[tipo]
+        # Con la fecha del evento: si la cita se movió y este proceso no se enteró, no se envía
+        consulta = supabase.from_("reservaciones").update(cambios)\
+            .eq("id", reserva_id).eq("estado", "pendiente").eq("fecha_reserva", fecha_reserva)
+        if columna:
+            # NULL cuenta como no enviado
+            consulta = consulta.not_.is_(columna, "true")
+        return bool(consulta.execute().data)
+
+    def _liberar(self, reserva_id, tipo):
+        _, columna, cambios = EVENTOS[tipo]
+        deshacer = {columna: False} if columna else {"estado": "pendiente"}
+        try:
+            supabase.from_("reservaciones").update(deshacer).eq("id", reserva_id).match(cambios).execute()
+        except Exception as e:
+            logging.error(f"❌ No se pudo liberar {tipo} de la reserva {reserva_id}: {e}")
+            return
+        with self._condicion:
+            reserva = self._reservas.get(reserva_id)
+            if reserva is not None:
+                reserva.update(deshacer)
+
+    def metricas(self):
+        with self._condicion:
+            return {
+                **self._contadores,
+                "eventos_programados": len(self._heap),
+                "reservas_en_memoria": len(self._reservas),
+                "proximo": datetime.fromtimestamp(self._heap[0][0], timezone.utc).isoformat() if self._heap else None,
+                "incremental": self._incremental,
+            }
+
+
+programador_recordatorios = ProgramadorRecordatorios()
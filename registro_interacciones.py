@@ -0,0 +1,169 @@
+import os
+import time
+import atexit
+import logging
+import threading
+from concurrent.futures import Future
+from dotenv import load_dotenv
+from servicios import supabase
+
+# ✅ Cargar variables de entorno
+load_dotenv()
+
+# ⏱️ Las filas se escriben en lote cada N ms o al juntar M filas, lo que pase primero
+REGISTRO_INTERVALO_MS = int(os.getenv("REGISTRO_INTERVALO_MS", 200))
+REGISTRO_MAX_FILAS = int(os.getenv("REGISTRO_MAX_FILAS", 100))
+REGISTRO_MAX_INTENTOS = 3
+
+
+class RegistroInteracciones:
+    """
+    Escritura diferida en lote de una tabla (por defecto interaction_history).
+
+    insertar() y actualizar() solo encolan y regresan al instante; un hilo
+    escribe las filas en inserts/upserts masivos (agrupados por on_conflict
+    y columnas) y después las actualizaciones. insertar() devuelve un Future
+    con el id de la fila (None si no se pudo guardar). vaciar() regresa
+    cuando todo lo encolado antes de llamarla ya se escribió.
+    """
+
+    def __init__(self, tabla="interaction_history", intervalo_ms=REGISTRO_INTERVALO_MS,
+                 max_filas=REGISTRO_MAX_FILAS, max_intentos=REGISTRO_MAX_INTENTOS):
+        self.tabla = tabla
+        self.intervalo_s = intervalo_ms / 1000
+        self.max_filas = max_filas
+        self.max_intentos = max_intentos
+        self._filas = []
+        self._actualizaciones = []
+        self._condicion = threading.Condition()
+        # Un vaciado a la vez: el que llega espera a que el hilo termine de escribir lo que ya tomó
+        self._vaciando = threading.Lock()
+        self._hilo = None
+        self._contadores = {"filas": 0, "lotes": 0, "actualizaciones": 0, "fallidas": 0}
+
+    def _asegurar_hilo(self):
+        # Llamar con self._condicion tomada
+        if self._hilo is None:
+            self._hilo = threading.Thread(target=self._trabajar, name="registro-interacciones", daemon=True)
+            self._hilo.start()
+
+    def insertar(self, fila, on_conflict=None):
+        if isinstance(on_conflict, (list, tuple)):
+            on_conflict = ",".join(on_conflict)
+        futuro = Future()
+        with self._condicion:
+            self._asegurar_hilo()
+            self._filas.append((on_conflict, fila, futuro))
+            if len(self._filas) >= self.max_filas:
+                self._condicion.notify()
+        return futuro
+
+    def actualizar(self, fila_id, cambios):
+        """fila_id puede ser el id o el Future que devolvió insertar()."""
+        with self._condicion:
+            self._asegurar_hilo()
+            self._actualizaciones.append((fila_id, cambios))
+
+    def _trabajar(self):
+        while True:
+            with self._condicion:
+                self._condicion.wait_for(lambda: len(self._filas) >= self.max_filas, timeout=self.intervalo_s)
+            self.vaciar()
+
+    def vaciar(self):
+        with self._vaciando:
+            with self._condicion:
+                filas, self._filas = self._filas, []
+                actualizaciones, self._actualizaciones = self._actualizaciones, []
+
+            # Primero los inserts: las actualizaciones pueden depender de sus ids
+            grupos = {}
+            for on_conflict, fila, futuro in filas:
+                grupos.setdefault((on_conflict, tuple(sorted(fila))), []).append((fila, futuro))
+            for (on_conflict, _), grupo in grupos.items():
+                self._escribir_grupo(on_conflict, grupo)
+
+            for fila_id, cambios in actualizaciones:
+                self._actualizar(fila_id, cambios)
+
+    def _escribir_grupo(self, on_conflict, grupo):
+        futuros_por_fila = []
+        if on_conflict:
+            # Un upsert masivo no puede tocar dos veces la misma fila: gana la última
+            por_clave = {}
+            for fila, futuro in grupo:
+                clave = tuple(fila.get(c.strip()) for c in on_conflict.split(","))
+                anterior = por_clave.get(clave)
+                por_clave[clave] = (fila, (anterior[1] if anterior else []) + [futuro])
+            futuros_por_fila = list(por_clave.values())
+        else:
+            futuros_por_fila = [(fila, [futuro]) for fila, futuro in grupo]
+
+        datos = self._ejecutar_con_reintentos(on_conflict, [fila for fila, _ in futuros_por_fila])
+        if datos is None and len(futuros_por_fila) > 1:
+            # El lote sigue fallando: se aísla la fila problemática escribiendo una por una
+            for fila, futuros in futuros_por_fila:
+                res = self._ejecutar_con_reintentos(on_conflict, [fila], intentos=1)
+                self._resolver(futuros, res[0] if res else None)
+            return
+
+        for i, (_, futuros) in enumerate(futuros_por_fila):
+            self._resolver(futuros, datos[i] if datos and i < len(datos) else None)
+
+    def _ejecutar_con_reintentos(self, on_conflict, filas, intentos=None):
+        intentos = intentos or self.max_intentos
+        for intento in range(1, intentos + 1):
+            try:
+                consulta = supabase.from_(self.tabla)
+                if on_conflict:
+                    res = consulta.upsert(filas, on_conflict=on_conflict).execute()
+                else:
+                    res = consulta.insert(filas).execute()
+                with self._condicion:
+                    self._contadores["filas"] += len(filas)
+                    self._contadores["lotes"] += 1
+                return res.data or []
+            except Exception as e:
+                logging.warning(f"⚠️ Error escribiendo {len(filas)} filas en {self.tabla} (intento {intento}): {e}")
+                if intento < intentos:
+                    time.sleep(0.5 * 2 ** (intento - 1))
+        with self._condicion:
+            self._contadores["fallidas"] += len(filas)
+        return None
+
+    @staticmethod
+    def _resolver(futuros, fila_guardada):
+        fila_id = fila_guardada.get("id") if fila_guardada else None
+        for futuro in futuros:
+            futuro.set_result(fila_id)
+
+    def _actualizar(self, fila_id, cambios):
+        if isinstance(fila_id, Future):
+            if not fila_id.done():
+                # Su insert aún no sale: se reintenta en la siguiente vuelta
+                with self._condicion:
+                    self._actualizaciones.append((fila_id, cambios))
+                return
+            fila_id = fila_id.result()
+        if not fila_id:
+            logging.warning(f"⚠️ Actualización de {self.tabla} descartada: la fila no se guardó")
+            return
+        for intento in range(1, self.max_intentos + 1):
+            try:
+                supabase.from_(self.tabla).update(cambios).eq("id", fila_id).execute()
+                with self._condicion:
+                    self._contadores["actualizaciones"] += 1
+                return
+            except Exception as e:
+                logging.warning(f"⚠️ Error actualizando {self.tabla} #{fila_id} (intento {intento}): {e}")
+                if intento < self.max_intentos:
+                    time.sleep(0.5 * 2 ** (intento - 1))
+
+    def metricas(self):
+        with self._condicion:
+            return {**self._contadores, "pendientes": len(self._filas) + len(self._actualizaciones)}
+
+
+registro_interacciones = RegistroInteracciones()
+# 🧯 Lo que quede en memoria se escribe al apagar el proceso
+atexit.register(registro_interacciones.vaciar)
@@ -1,11 +1,8 @@
 import logging
 from datetime import datetime
-from supabase import create_client
-from openai import OpenAI
-
-# Asume que estas variables están configuradas por fuera
-supabase: create_client
-client: OpenAI
+from servicios import supabase, cliente_openai as client
+from servicio_embeddings import obtener_embedding
+from memoria_usuario import invalidar_memoria_usuario
 
 def guardar_resumen_usuario(user_id, conversation_id=None):
     try:
@@ -72,11 +69,7 @@ Redacta un resumen útil para que la IA continúe la conversación con contexto.
         logging.info(f"📝 Resumen generado:\n{resumen}")
 
         # Embedding del resumen
-        embedding_response = client.embeddings.create(
-            model="text-embedding-ada-002",
-            input=resumen
-        )
-        vector = embedding_response.data[0].embedding
+        vector = obtener_embedding(resumen)
 
         # Guardar resumen y vector
         supabase.from_("user_summary_embeddings").upsert({
@@ -86,6 +79,7 @@ Redacta un resumen útil para que la IA continúe la conversación con contexto.
             "embedding_vector": vector,
             "updated_at": datetime.utcnow().isoformat()
         }, on_conflict=["user_id"]).execute()
+        invalidar_memoria_usuario(user_id)
 
         logging.info(f"🧠 Resumen actualizado guardado para {user_id}")
 
@@ -0,0 +1,228 @@
+import os
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from arranque import importar_perezoso
+np = importar_perezoso("numpy")
+from dotenv import load_dotenv
+from servicios import cliente_openai as client
+
+# ✅ Cargar variables de entorno
+load_dotenv()
+
+MODELO_EMBEDDINGS = os.getenv("MODELO_EMBEDDINGS", "text-embedding-ada-002")
+# Nivel en memoria: LRU con caducidad
+EMBEDDINGS_CACHE_MAX = int(os.getenv("EMBEDDINGS_CACHE_MAX", 5000))
+EMBEDDINGS_CACHE_TTL = int(os.getenv("EMBEDDINGS_CACHE_TTL", 3600))
+# Nivel en disco: SQLite por modelo + sha256 del texto
+EMBEDDINGS_SQLITE_PATH = os.getenv("EMBEDDINGS_SQLITE_PATH", os.path.join(".cache", "embeddings.sqlite3"))
+# Micro-lotes: se espera un instante para juntar pedidos concurrentes en una sola llamada
+EMBEDDINGS_LOTE_ESPERA_MS = int(os.getenv("EMBEDDINGS_LOTE_ESPERA_MS", 10))
+EMBEDDINGS_LOTE_MAX = 64
+
+
+class ServicioEmbeddings:
+    """
+    Embeddings compartidos por todo el proceso.
+
+    Busca primero en un LRU en memoria, luego en SQLite y solo al final
+    llama a la API. Los textos que faltan, aunque vengan de hilos distintos,
+    se juntan durante EMBEDDINGS_LOTE_ESPERA_MS y se piden en una sola
+    llamada; un mismo texto en vuelo no se pide dos veces.
+    """
+
+    def __init__(self, modelo=MODELO_EMBEDDINGS, ruta=EMBEDDINGS_SQLITE_PATH,
+                 max_memoria=EMBEDDINGS_CACHE_MAX, ttl_s=EMBEDDINGS_CACHE_TTL,
+                 espera_lote_ms=EMBEDDINGS_LOTE_ESPERA_MS, max_lote=EMBEDDINGS_LOTE_MAX):
+        self.modelo = modelo
+        self.ruta = ruta
+        self.max_memoria = max_memoria
+        self.ttl_s = ttl_s
+        self.espera_lote_s = espera_lote_ms / 1000
+        self.max_lote = max_lote
+        self._memoria = OrderedDict()
+        self._en_vuelo = {}
+        self._pendientes = []
+        self._lote_programado = False
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._contadores = {"memoria": 0, "disco": 0, "api": 0, "llamadas_api": 0}
+        carpeta = os.path.dirname(ruta)
+        if carpeta:
+            os.makedirs(carpeta, exist_ok=True)
+        self._conexion().execute(
+            "CREATE TABLE IF NOT EXISTS embeddings (clave TEXT PRIMARY KEY, vector BLOB NOT NULL, creado REAL NOT NULL)"
+        )
+
+    def _conexion(self):
+        conexion = getattr(self._local, "conexion", None)
+        if conexion is None:
+            conexion = sqlite3.connect(self.ruta, timeout=10, isolation_level=None)
+            conexion.execute("PRAGMA journal_mode=WAL")
+            conexion.execute("PRAGMA synchronous=NORMAL")
+            self._local.conexion = conexion
+        return conexion
+
+    def _clave(self, texto):
+        return f"{self.modelo}:{hashlib.sha256(texto.encode('utf-8')).hexdigest()}"
+
+    def _de_memoria(self, clave):
+        # Llamar con self._lock tomado
+        guardado = self._memoria.get(clave)
+        if guardado is None:
+            return None
+        expira, vector = guardado
+        if expira < time.monotonic():
+            del self._memoria[clave]
+            return None
+        self._memoria.move_to_end(clave)
+        return vector
+
+    def _a_memoria(self, clave, vector):
+        # Llamar con self._lock tomado
+        self._memoria[clave] = (time.monotonic() + self.ttl_s, vector)
+        self._memoria.move_to_end(clave)
+        while len(self._memoria) > self.max_memoria:
+            self._memoria.popitem(last=False)
+
+    def obtener(self, texto):
+        return self.obtener_lote([texto])[0]
+
+    def obtener_lote(self, textos):
+        claves = [self._clave(t) for t in textos]
+        vectores = [None] * len(textos)
+
+        with self._lock:
+            for i, clave in enumerate(claves):
+                vectores[i] = self._de_memoria(clave)
+                if vectores[i] is not None:
+                    self._contadores["memoria"] += 1
+
+        faltantes = [i for i, v in enumerate(vectores) if v is None]
+        if faltantes:
+            for i, vector in zip(faltantes, self._leer_disco([claves[i] for i in faltantes])):
+                vectores[i] = vector
+
+        faltantes = [i for i, v in enumerate(vectores) if v is None]
+        if faltantes:
+            futuros = self._pedir([(claves[i], textos[i]) for i in faltantes])
+            for i, futuro in zip(faltantes, futuros):
+                vectores[i] = futuro.result()
+
+        return [v.tolist() for v in vectores]
+
+    def _leer_disco(self, claves):
+        try:
+            marcas = ",".join("?" * len(claves))
+            filas = dict(self._conexion().execute(
+                f"SELECT clave, vector FROM embeddings WHERE clave IN ({marcas})", claves
+            ).fetchall())
+        except Exception as e:
+            logging.warning(f"⚠️ No se pudo leer la caché de embeddings en disco: {e}")
+            filas = {}
+
+        encontrados = []
+        with self._lock:
+            for clave in claves:
+                blob = filas.get(clave)
+                vector = np.frombuffer(blob, dtype=np.float32) if blob is not None else None
+                if vector is not None:
+                    self._a_memoria(clave, vector)
+                    self._contadores["disco"] += 1
+                encontrados.append(vector)
+        return encontrados
+
+    def _pedir(self, pares):
+        futuros = []
+        with self._lock:
+            for clave, texto in pares:
+                futuro = self._en_vuelo.get(clave)
+                if futuro is None:
+                    futuro = self._en_vuelo[clave] = Future()
+                    self._pendientes.append((clave, texto, futuro))
+                futuros.append(futuro)
+            lider = bool(self._pendientes) and not self._lote_programado
+            if lider:
+                self._lote_programado = True
+
+        # El primer hilo en llegar espera un instante y despacha el lote de todos
+        if lider:
+            if self.espera_lote_s:
+                time.sleep(self.espera_lote_s)
+            self._despachar()
+        return futuros
+
+    def _despachar(self):
+        while True:
+            with self._lock:
+                lote = self._pendientes[:self.max_lote]
+                del self._pendientes[:self.max_lote]
+                if not self._pendientes:
+                    self._lote_programado = False
+            if not lote:
+                return
+
+            try:
+                res = client.embeddings.create(model=self.modelo, input=[texto for _, texto, _ in lote])
+                vectores = [np.asarray(r.embedding, dtype=np.float32) for r in res.data]
+            except Exception as e:
+                with self._lock:
+                    for clave, _, futuro in lote:
+                        self._en_vuelo.pop(clave, None)
+                for _, _, futuro in lote:
+                    futuro.set_exception(e)
+                continue
+
+            try:
+                ahora = time.time()
+                self._conexion().executemany(
+                    "INSERT OR REPLACE INTO embeddings (clave, vector, creado) VALUES (?, ?, ?)",
+                    [(clave, vector.tobytes(), ahora) for (clave, _, _), vector in zip(lote, vectores)]
+                )
+            except Exception as e:
+                logging.warning(f"⚠️ No se pudo guardar la caché de embeddings en disco: {e}")
+
+            with self._lock:
+                self._contadores["llamadas_api"] += 1
+                self._contadores["api"] += len(lote)
+                for (clave, _, _), vector in zip(lote, vectores):
+                    self._a_memoria(clave, vector)
+                    self._en_vuelo.pop(clave, None)
+            for (_, _, futuro), vector in zip(lote, vectores):
+                futuro.set_result(vector)
+
+            if len(lote) > 1:
+                logging.info(f"🧮 {len(lote)} embeddings pedidos en una sola llamada")
+            with self._lock:
+                if not self._pendientes:
+                    return
+
+    def metricas(self):
+        with self._lock:
+            return {**self._contadores, "en_memoria": len(self._memoria)}
+
+
+_servicio = None
+_servicio_lock = threading.Lock()
+
+
+def obtener_servicio_embeddings():
+    global _servicio
+    if _servicio is None:
+        with _servicio_lock:
+            if _servicio is None:
+                _servicio = ServicioEmbeddings()
+    return _servicio
+
+
+# ✅ Atajos para el resto de los módulos
+def obtener_embedding(texto):
+    return obtener_servicio_embeddings().obtener(texto)
+
+
+def obtener_embeddings(textos):
+    return obtener_servicio_embeddings().obtener_lote(list(textos))
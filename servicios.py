@@ -0,0 +1,148 @@
+import os
+import time
+import logging
+import threading
+from dotenv import load_dotenv
+
+# ✅ Cargar variables de entorno
+load_dotenv()
+
+# 🔌 Un pool por backend para todo el proceso (todas las etapas y hilos lo comparten)
+SERVICIOS_MAX_CONEXIONES = int(os.getenv("SERVICIOS_MAX_CONEXIONES", 32))
+# Conexiones que se mantienen abiertas entre ráfagas (keep-alive)
+SERVICIOS_MAX_KEEPALIVE = int(os.getenv("SERVICIOS_MAX_KEEPALIVE", 16))
+SERVICIOS_KEEPALIVE_S = float(os.getenv("SERVICIOS_KEEPALIVE_S", 60))
+SUPABASE_TIMEOUT_S = float(os.getenv("SUPABASE_TIMEOUT_S", 20))
+OPENAI_TIMEOUT_S = float(os.getenv("OPENAI_TIMEOUT_S", 60))
+OPENAI_MAX_REINTENTOS = int(os.getenv("OPENAI_MAX_REINTENTOS", 2))
+
+_lock = threading.Lock()
+_instancias = {}
+_tiempos = {}
+
+
+def _limites():
+    import httpx
+    return httpx.Limits(
+        max_connections=SERVICIOS_MAX_CONEXIONES,
+        max_keepalive_connections=SERVICIOS_MAX_KEEPALIVE,
+        keepalive_expiry=SERVICIOS_KEEPALIVE_S
+    )
+
+
+def _obtener(nombre, fabrica):
+    instancia = _instancias.get(nombre)
+    if instancia is None:
+        with _lock:
+            instancia = _instancias.get(nombre)
+            if instancia is None:
+                inicio = time.perf_counter()
+                instancia = _instancias[nombre] = fabrica()
+                _tiempos[nombre] = time.perf_counter() - inicio
+                logging.info(f"🔌 Cliente {nombre} creado en {_tiempos[nombre]:.2f}s")
+    return instancia
+
+
+def _crear_supabase():
+    import httpx
+    from supabase import create_client
+    from trazas import instrumentar_supabase
+
+    cliente = create_client(os.getenv("SUPABASE_URL"), os.getenv("SUPABASE_SERVICE_ROLE_KEY"))
+    # supabase-py 2.13 no acepta un cliente httpx propio: se reemplaza la sesión de PostgREST
+    # por una igual pero con el pool ajustado (HTTP/2 y keep-alive largo)
+    anterior = cliente.postgrest.session
+    cliente.postgrest.session = httpx.Client(
+        base_url=anterior.base_url,
+        headers=anterior.headers,
+        timeout=SUPABASE_TIMEOUT_S,
+        limits=_limites(),
+        http2=True,
+        follow_redirects=True
+    )
+    anterior.close()
+    return instrumentar_supabase(cliente)
+
+
+def _crear_openai():
+    from openai import OpenAI, DefaultHttpxClient
+    from trazas import instrumentar_openai
+
+    cliente = OpenAI(
+        api_key=os.getenv("OPENAI_API_KEY"),
+        timeout=OPENAI_TIMEOUT_S,
+        max_retries=OPENAI_MAX_REINTENTOS,
+        http_client=DefaultHttpxClient(limits=_limites())
+    )
+    return instrumentar_openai(cliente)
+
+
+def _crear_sesion_http():
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    sesion = requests.Session()
+    adaptador = HTTPAdapter(pool_connections=4, pool_maxsize=SERVICIOS_MAX_CONEXIONES)
+    sesion.mount("https://", adaptador)
+    sesion.mount("http://", adaptador)
+    return sesion
+
+
+# ✅ Clientes compartidos: se crean la primera vez que se piden
+def obtener_supabase():
+    return _obtener("supabase", _crear_supabase)
+
+
+def obtener_openai():
+    return _obtener("openai", _crear_openai)
+
+
+def sesion_http():
+    """Sesión de requests para Twilio, Messenger y demás APIs REST."""
+    return _obtener("http", _crear_sesion_http)
+
+
+class _Perezoso:
+    """
+    Se comporta como el cliente pero no lo crea hasta el primer uso, así
+    que `from servicios import supabase` no abre nada al importar.
+    """
+
+    def __init__(self, nombre, obtener):
+        self._nombre = nombre
+        self._obtener = obtener
+
+    def __getattr__(self, atributo):
+        return getattr(self._obtener(), atributo)
+
+    def __repr__(self):
+        estado = "creado" if self._nombre in _instancias else "sin crear"
+        return f"<{self._nombre} compartido ({estado})>"
+
+
+supabase = _Perezoso("supabase", obtener_supabase)
+cliente_openai = _Perezoso("openai", obtener_openai)
+
+
+def metricas():
+    return {
+        "creados": sorted(_instancias),
+        "segundos_en_crear": {nombre: round(t, 3) for nombre, t in _tiempos.items()},
+        "max_conexiones": SERVICIOS_MAX_CONEXIONES,
+        "max_keepalive": SERVICIOS_MAX_KEEPALIVE,
+    }
+
+
+def cerrar():
+    """Cierra los pools (al apagar o en pruebas)."""
+    with _lock:
+        instancias = dict(_instancias)
+        _instancias.clear()
+    for nombre, instancia in instancias.items():
+        try:
+            if nombre == "supabase":
+                instancia.postgrest.session.close()
+            else:
+                instancia.close()
+        except Exception as e:
+            logging.warning(f"⚠️ Error cerrando cliente {nombre}: {e}")
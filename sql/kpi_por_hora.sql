@@ -0,0 +1,24 @@
+-- Contadores KPI por (negocio, tipo_evento, hora) compartidos por todos los procesos.
+-- Cada proceso suma sus contadores con sumar_kpi_por_hora (kpi.vaciar_agregados);
+-- /kpi/resumen los lee de aquí.
+
+create table if not exists kpi_por_hora (
+    negocio text not null,
+    tipo_evento text not null,
+    hora timestamptz not null,
+    eventos bigint not null default 0,
+    valor double precision not null default 0,
+    primary key (negocio, tipo_evento, hora)
+);
+
+create or replace function sumar_kpi_por_hora(filas jsonb)
+returns void
+language sql
+as $$
+    insert into kpi_por_hora (negocio, tipo_evento, hora, eventos, valor)
+    select f.negocio, f.tipo_evento, f.hora, f.eventos, f.valor
+    from jsonb_to_recordset(filas) as f(negocio text, tipo_evento text, hora timestamptz, eventos bigint, valor double precision)
+    on conflict (negocio, tipo_evento, hora) do update
+        set eventos = kpi_por_hora.eventos + excluded.eventos,
+            valor = kpi_por_hora.valor + excluded.valor;
+$$;
@@ -0,0 +1,23 @@
+-- updated_at de reservaciones se renueva en cada insert/update.
+-- El programador de recordatorios lee solo las reservas cambiadas desde su
+-- última marca de agua (RECORDATORIOS_COLUMNA_CAMBIO); sin este trigger, una
+-- cita reagendada o cancelada desde otro proceso no se vuelve a leer.
+
+alter table reservaciones add column if not exists updated_at timestamptz not null default now();
+
+create index if not exists reservaciones_updated_at on reservaciones (updated_at, id);
+
+create or replace function tocar_updated_at()
+returns trigger
+language plpgsql
+as $$
+begin
+    new.updated_at := now();
+    return new;
+end;
+$$;
+
+drop trigger if exists reservaciones_tocar_updated_at on reservaciones;
+create trigger reservaciones_tocar_updated_at
+    before insert or update on reservaciones
+    for each row execute function tocar_updated_at();
@@ -0,0 +1,22 @@
+-- Últimas `cuantas` interacciones de cada conversación en una sola llamada.
+-- La usa el seguimiento de leads silenciosos (bot.historiales_para_seguimiento):
+-- el límite es por conversación, así ninguna se queda sin historial por el
+-- tope de filas de PostgREST (max-rows) ni se descarga el historial completo.
+
+create index if not exists interaction_history_conversation_start
+    on interaction_history (conversation_id, start_time desc);
+
+create or replace function ultimas_interacciones(ids uuid[], cuantas int default 6)
+returns setof interaction_history
+language sql stable
+as $$
+    select h.*
+    from unnest(ids) as c(conversation_id)
+    cross join lateral (
+        select *
+        from interaction_history i
+        where i.conversation_id = c.conversation_id
+        order by i.start_time desc
+        limit cuantas
+    ) h;
+$$;
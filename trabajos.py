@@ -0,0 +1,191 @@
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+import traceback
+from estadisticas import resumir
+
+# 🗂️ Cola de trabajos persistente en un archivo SQLite local (sobrevive reinicios)
+TRABAJOS_SQLITE_PATH = os.getenv("TRABAJOS_SQLITE_PATH", os.path.join(".cache", "trabajos.sqlite3"))
+TRABAJOS_WORKERS = int(os.getenv("TRABAJOS_WORKERS", 4))
+TRABAJOS_MAX_INTENTOS = int(os.getenv("TRABAJOS_MAX_INTENTOS", 3))
+# Un trabajo "en_curso" por más de esto se considera abandonado (proceso caído)
+TRABAJOS_LEASE_S = int(os.getenv("TRABAJOS_LEASE_S", 600))
+# Los trabajos terminados se borran después de estos días
+TRABAJOS_RETENCION_DIAS = 7
+ESPERA_SIN_TRABAJO_S = 1.0
+
+
+class ColaTrabajos:
+    """
+    Trabajos en segundo plano con reintentos, guardados en SQLite (WAL).
+
+    Cada trabajo es un nombre registrado con registrar() y sus argumentos en
+    JSON. Varios hilos (y varios procesos sobre el mismo archivo) toman
+    trabajos pendientes; si uno falla se reintenta con espera exponencial
+    hasta max_intentos. Se guarda la duración de cada ejecución.
+    """
+
+    def __init__(self, ruta=TRABAJOS_SQLITE_PATH, num_workers=TRABAJOS_WORKERS, max_intentos=TRABAJOS_MAX_INTENTOS):
+        self.ruta = ruta
+        self.num_workers = max(1, num_workers)
+        self.max_intentos = max_intentos
+        self._funciones = {}
+        self._hilos = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._hay_trabajo = threading.Event()
+        # El archivo y la tabla se crean con la primera conexión, no al construir la cola
+        self._esquema_listo = False
+
+    def _conexion(self):
+        conexion = getattr(self._local, "conexion", None)
+        if conexion is None:
+            carpeta = os.path.dirname(self.ruta)
+            if carpeta:
+                os.makedirs(carpeta, exist_ok=True)
+            conexion = sqlite3.connect(self.ruta, timeout=10, isolation_level=None)
+            conexion.execute("PRAGMA journal_mode=WAL")
+            conexion.execute("PRAGMA synchronous=NORMAL")
+            self._local.conexion = conexion
+            with self._lock:
+                if not self._esquema_listo:
+                    conexion.executescript("""
+                        CREATE TABLE IF NOT EXISTS trabajos (
+                            id INTEGER PRIMARY KEY AUTOINCREMENT,
+                            nombre TEXT NOT NULL,
+                            argumentos TEXT NOT NULL,
+                            estado TEXT NOT NULL DEFAULT 'pendiente',
+                            intentos INTEGER NOT NULL DEFAULT 0,
+                            disponible_en REAL NOT NULL,
+                            creado_en REAL NOT NULL,
+                            tomado_en REAL,
+                            terminado_en REAL,
+                            duracion_s REAL,
+                            error TEXT
+                        );
+                        CREATE INDEX IF NOT EXISTS idx_trabajos_estado ON trabajos (estado, disponible_en);
+                    """)
+                    self._esquema_listo = True
+        return conexion
+
+    def registrar(self, nombre, funcion):
+        self._funciones[nombre] = funcion
+
+    def encolar(self, nombre, **argumentos):
+        if not self._hilos:
+            self.iniciar()
+        ahora = time.time()
+        cursor = self._conexion().execute(
+            "INSERT INTO trabajos (nombre, argumentos, disponible_en, creado_en) VALUES (?, ?, ?, ?)",
+            (nombre, json.dumps(argumentos, ensure_ascii=False, default=str), ahora, ahora)
+        )
+        self._hay_trabajo.set()
+        return cursor.lastrowid
+
+    def iniciar(self):
+        with self._lock:
+            if self._hilos:
+                return
+            for i in range(self.num_workers):
+                hilo = threading.Thread(target=self._trabajar, name=f"trabajos-{i}", daemon=True)
+                hilo.start()
+                self._hilos.append(hilo)
+        borrados = self.purgar_terminados()
+        if borrados:
+            logging.info(f"🧹 {borrados} trabajos antiguos eliminados")
+        logging.info(f"🧰 Cola de trabajos iniciada con {self.num_workers} workers ({self.ruta})")
+
+    def _reclamar(self):
+        conexion = self._conexion()
+        ahora = time.time()
+        conexion.execute("BEGIN IMMEDIATE")
+        try:
+            fila = conexion.execute("""
+                SELECT id, nombre, argumentos, intentos FROM trabajos
+                WHERE (estado = 'pendiente' AND disponible_en <= ?)
+                   OR (estado = 'en_curso' AND tomado_en < ?)
+                ORDER BY id LIMIT 1
+            """, (ahora, ahora - TRABAJOS_LEASE_S)).fetchone()
+            if fila:
+                conexion.execute(
+                    "UPDATE trabajos SET estado = 'en_curso', intentos = intentos + 1, tomado_en = ? WHERE id = ?",
+                    (ahora, fila[0])
+                )
+            conexion.execute("COMMIT")
+        except Exception:
+            conexion.execute("ROLLBACK")
+            raise
+        return fila
+
+    def _trabajar(self):
+        while True:
+            try:
+                trabajo = self._reclamar()
+            except Exception as e:
+                logging.error(f"❌ Error leyendo la cola de trabajos: {e}")
+                trabajo = None
+
+            if trabajo is None:
+                self._hay_trabajo.wait(ESPERA_SIN_TRABAJO_S)
+                self._hay_trabajo.clear()
+                continue
+            self._ejecutar(*trabajo)
+
+    def _ejecutar(self, trabajo_id, nombre, argumentos, intentos_previos):
+        intento = intentos_previos + 1
+        inicio = time.monotonic()
+        try:
+            funcion = self._funciones.get(nombre)
+            if funcion is None:
+                raise LookupError(f"trabajo no registrado: {nombre}")
+            funcion(**json.loads(argumentos))
+        except Exception as e:
+            duracion = time.monotonic() - inicio
+            error = "".join(traceback.format_exception_only(type(e), e)).strip()
+            if intento < self.max_intentos:
+                espera = 5 * 2 ** (intento - 1)
+                logging.warning(f"⚠️ Trabajo {nombre} #{trabajo_id} falló (intento {intento}), se reintenta en {espera}s: {e}")
+                self._conexion().execute(
+                    "UPDATE trabajos SET estado = 'pendiente', disponible_en = ?, duracion_s = ?, error = ? WHERE id = ?",
+                    (time.time() + espera, duracion, error, trabajo_id)
+                )
+            else:
+                logging.error(f"❌ Trabajo {nombre} #{trabajo_id} falló definitivamente tras {intento} intentos: {e}")
+                self._conexion().execute(
+                    "UPDATE trabajos SET estado = 'fallido', terminado_en = ?, duracion_s = ?, error = ? WHERE id = ?",
+                    (time.time(), duracion, error, trabajo_id)
+                )
+            return
+
+        duracion = time.monotonic() - inicio
+        self._conexion().execute(
+            "UPDATE trabajos SET estado = 'hecho', terminado_en = ?, duracion_s = ?, error = NULL WHERE id = ?",
+            (time.time(), duracion, trabajo_id)
+        )
+        logging.info(f"✅ Trabajo {nombre} #{trabajo_id} terminado en {duracion:.2f}s")
+
+    def purgar_terminados(self):
+        limite = time.time() - TRABAJOS_RETENCION_DIAS * 86400
+        cursor = self._conexion().execute(
+            "DELETE FROM trabajos WHERE estado IN ('hecho', 'fallido') AND terminado_en < ?", (limite,)
+        )
+        return cursor.rowcount
+
+    def metricas(self):
+        conexion = self._conexion()
+        por_estado = dict(conexion.execute("SELECT estado, COUNT(*) FROM trabajos GROUP BY estado").fetchall())
+        duraciones = {}
+        filas = conexion.execute("""
+            SELECT nombre, duracion_s FROM trabajos
+            WHERE estado = 'hecho' ORDER BY terminado_en DESC LIMIT 1000
+        """).fetchall()
+        for nombre, duracion in filas:
+            duraciones.setdefault(nombre, []).append(duracion)
+        return {
+            "por_estado": por_estado,
+            "duracion_s": {nombre: resumir(muestras, decimales=3) for nombre, muestras in duraciones.items()}
+        }
+
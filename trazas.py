@@ -0,0 +1,355 @@
+import os
+import json
+import time
+import heapq
+import uuid
+import atexit
+import logging
+import threading
+import itertools
+import contextvars
+from contextlib import contextmanager
+from functools import wraps
+
+# 🐢 Cuántas de las trazas más lentas se guardan completas (con todos sus spans)
+TRAZAS_LENTAS = int(os.getenv("TRAZAS_LENTAS", 20))
+# Si se define, las trazas más lentas se vuelcan a este archivo JSON al apagar
+TRAZAS_ARCHIVO = os.getenv("TRAZAS_ARCHIVO")
+# Límite de spans por traza (un bucle con cientos de consultas no debe llenar la memoria)
+TRAZAS_MAX_SPANS = int(os.getenv("TRAZAS_MAX_SPANS", 500))
+
+# Segundos; cubren desde una consulta rápida a Supabase hasta un mensaje de 30 s
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60)
+
+_traza_actual = contextvars.ContextVar("traza_actual", default=None)
+_span_actual = contextvars.ContextVar("span_actual", default=None)
+
+
+# === Métricas en formato Prometheus ===
+def _escapar(valor):
+    return str(valor).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _etiquetas(nombres, valores, extra=None):
+    pares = list(zip(nombres, valores)) + ([extra] if extra else [])
+    if not pares:
+        return ""
+    return "{" + ",".join(f'{n}="{_escapar(v)}"' for n, v in pares) + "}"
+
+
+class Histograma:
+    def __init__(self, nombre, ayuda, etiquetas=(), buckets=BUCKETS):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.etiquetas = tuple(etiquetas)
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observar(self, valor, *etiquetas):
+        with self._lock:
+            serie = self._series.get(etiquetas)
+            if serie is None:
+                serie = self._series[etiquetas] = [[0] * len(self.buckets), 0.0, 0]
+            for i, limite in enumerate(self.buckets):
+                if valor <= limite:
+                    serie[0][i] += 1
+            serie[1] += valor
+            serie[2] += 1
+
+    def exportar(self):
+        lineas = [f"# HELP {self.nombre} {self.ayuda}", f"# TYPE {self.nombre} histogram"]
+        with self._lock:
+            for etiquetas, (conteos, suma, total) in sorted(self._series.items()):
+                for limite, conteo in zip(self.buckets, conteos):
+                    lineas.append(f"{self.nombre}_bucket{_etiquetas(self.etiquetas, etiquetas, ('le', limite))} {conteo}")
+                lineas.append(f"{self.nombre}_bucket{_etiquetas(self.etiquetas, etiquetas, ('le', '+Inf'))} {total}")
+                lineas.append(f"{self.nombre}_sum{_etiquetas(self.etiquetas, etiquetas)} {suma:.6f}")
+                lineas.append(f"{self.nombre}_count{_etiquetas(self.etiquetas, etiquetas)} {total}")
+        return lineas
+
+
+class Contador:
+    def __init__(self, nombre, ayuda, etiquetas=()):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.etiquetas = tuple(etiquetas)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def sumar(self, valor=1, *etiquetas):
+        with self._lock:
+            self._series[etiquetas] = self._series.get(etiquetas, 0) + valor
+
+    def exportar(self):
+        lineas = [f"# HELP {self.nombre} {self.ayuda}", f"# TYPE {self.nombre} counter"]
+        with self._lock:
+            for etiquetas, valor in sorted(self._series.items()):
+                lineas.append(f"{self.nombre}{_etiquetas(self.etiquetas, etiquetas)} {valor}")
+        return lineas
+
+
+solicitudes_segundos = Histograma(
+    "aidana_solicitud_segundos", "Duración de cada solicitud trazada (webhook, recordatorio...)", ["nombre"]
+)
+etapa_segundos = Histograma("aidana_etapa_segundos", "Duración de cada etapa del pipeline", ["etapa"])
+dependencia_segundos = Histograma(
+    "aidana_dependencia_segundos", "Llamadas a Supabase, OpenAI y Twilio", ["servicio", "operacion", "etapa"]
+)
+dependencia_errores = Contador(
+    "aidana_dependencia_errores_total", "Llamadas a dependencias que fallaron", ["servicio", "operacion"]
+)
+openai_tokens = Contador("aidana_openai_tokens_total", "Tokens usados en OpenAI", ["modelo", "tipo"])
+
+_metricas = [solicitudes_segundos, etapa_segundos, dependencia_segundos, dependencia_errores, openai_tokens]
+
+
+def registrar_metrica(metrica):
+    _metricas.append(metrica)
+    return metrica
+
+
+# ✅ Todo lo anterior en el formato de texto de Prometheus (para /metrics)
+def exportar_prometheus():
+    lineas = []
+    for metrica in _metricas:
+        lineas.extend(metrica.exportar())
+    return "\n".join(lineas) + "\n"
+
+
+# === Trazas y spans ===
+class Span:
+    __slots__ = ("nombre", "tipo", "atributos", "inicio", "duracion", "error", "padre")
+
+    def __init__(self, nombre, tipo, atributos, padre=None):
+        self.nombre = nombre
+        self.tipo = tipo
+        self.atributos = atributos
+        self.inicio = time.perf_counter()
+        self.duracion = None
+        self.error = None
+        self.padre = padre
+
+    def a_dict(self, origen):
+        return {
+            "nombre": self.nombre,
+            "tipo": self.tipo,
+            "padre": self.padre.nombre if self.padre else None,
+            "inicio_ms": round((self.inicio - origen) * 1000, 1),
+            "duracion_ms": round(self.duracion * 1000, 1) if self.duracion is not None else None,
+            "error": self.error,
+            **({"atributos": self.atributos} if self.atributos else {}),
+        }
+
+
+class Traza:
+    """Una solicitud (un mensaje del webhook, un recordatorio) con todos sus spans."""
+
+    def __init__(self, nombre, atributos):
+        self.id = uuid.uuid4().hex[:16]
+        self.nombre = nombre
+        self.atributos = atributos
+        self.inicio = time.perf_counter()
+        self.iniciada_en = time.time()
+        self.duracion = None
+        self.spans = []
+        self.descartados = 0
+        self._lock = threading.Lock()
+
+    def agregar(self, span):
+        with self._lock:
+            if len(self.spans) < TRAZAS_MAX_SPANS:
+                self.spans.append(span)
+            else:
+                self.descartados += 1
+
+    def a_dict(self):
+        with self._lock:
+            spans = [s.a_dict(self.inicio) for s in self.spans]
+        return {
+            "id": self.id,
+            "nombre": self.nombre,
+            "iniciada_en": self.iniciada_en,
+            "duracion_ms": round(self.duracion * 1000, 1) if self.duracion is not None else None,
+            "atributos": self.atributos,
+            "spans": spans,
+            "spans_descartados": self.descartados,
+        }
+
+
+_lentas = []
+_secuencia = itertools.count()
+_lock_lentas = threading.Lock()
+
+
+def _guardar_si_lenta(traza):
+    with _lock_lentas:
+        entrada = (traza.duracion, next(_secuencia), traza)
+        if len(_lentas) < TRAZAS_LENTAS:
+            heapq.heappush(_lentas, entrada)
+        elif _lentas and traza.duracion > _lentas[0][0]:
+            heapq.heapreplace(_lentas, entrada)
+
+
+# ✅ Las N trazas más lentas, de la más lenta a la más rápida
+def trazas_lentas(n=None):
+    with _lock_lentas:
+        trazas = [t for _, _, t in sorted(_lentas, key=lambda e: e[0], reverse=True)]
+    return [t.a_dict() for t in trazas[:n]]
+
+
+def volcar_trazas_lentas(ruta=None):
+    ruta = ruta or TRAZAS_ARCHIVO
+    if not ruta:
+        return
+    try:
+        with open(ruta, "w", encoding="utf-8") as f:
+            json.dump(trazas_lentas(), f, ensure_ascii=False, indent=2, default=str)
+        logging.info(f"🐢 Trazas más lentas guardadas en {ruta}")
+    except Exception as e:
+        logging.error(f"❌ Error guardando trazas en {ruta}: {e}")
+
+
+@contextmanager
+def traza(nombre, **atributos):
+    """Abre una traza; los spans de este hilo (y de lo lanzado con su contexto) se le agregan."""
+    nueva = Traza(nombre, atributos)
+    token_traza = _traza_actual.set(nueva)
+    token_span = _span_actual.set(None)
+    try:
+        yield nueva
+    finally:
+        _span_actual.reset(token_span)
+        _traza_actual.reset(token_traza)
+        nueva.duracion = time.perf_counter() - nueva.inicio
+        solicitudes_segundos.observar(nueva.duracion, nombre)
+        _guardar_si_lenta(nueva)
+
+
+def trazar(nombre):
+    """Decorador: cada llamada a la función es una traza."""
+    def decorador(funcion):
+        @wraps(funcion)
+        def envuelta(*args, **kwargs):
+            with traza(nombre):
+                return funcion(*args, **kwargs)
+        return envuelta
+    return decorador
+
+
+# ✅ Agrega atributos a la traza en curso (p. ej. el conversation_id en cuanto se conoce)
+def etiquetar(**atributos):
+    actual = _traza_actual.get()
+    if actual is not None:
+        actual.atributos.update({k: v for k, v in atributos.items() if v is not None})
+
+
+def etapa_actual():
+    span = _span_actual.get()
+    while span is not None and span.tipo != "etapa":
+        span = span.padre
+    return span.nombre if span else "sin_etapa"
+
+
+@contextmanager
+def span(nombre, tipo="interno", **atributos):
+    padre = _span_actual.get()
+    nuevo = Span(nombre, tipo, atributos, padre)
+    token = _span_actual.set(nuevo)
+    try:
+        yield nuevo
+    except BaseException as e:
+        nuevo.error = f"{type(e).__name__}: {e}"[:200]
+        raise
+    finally:
+        _span_actual.reset(token)
+        nuevo.duracion = time.perf_counter() - nuevo.inicio
+        actual = _traza_actual.get()
+        if actual is not None:
+            actual.agregar(nuevo)
+
+
+@contextmanager
+def etapa(nombre):
+    """Span de una etapa del pipeline (intencion, lead_score, respuesta, cierre...). También sirve de decorador."""
+    with span(nombre, "etapa") as nuevo:
+        try:
+            yield nuevo
+        finally:
+            etapa_segundos.observar(time.perf_counter() - nuevo.inicio, nombre)
+
+
+@contextmanager
+def dependencia(servicio, operacion, **atributos):
+    """Span de una llamada a Supabase, OpenAI o Twilio; alimenta el histograma por servicio y etapa."""
+    etiqueta_etapa = etapa_actual()
+    with span(f"{servicio} {operacion}", servicio, **atributos) as nuevo:
+        try:
+            yield nuevo
+        except BaseException:
+            dependencia_errores.sumar(1, servicio, operacion)
+            raise
+        finally:
+            dependencia_segundos.observar(time.perf_counter() - nuevo.inicio, servicio, operacion, etiqueta_etapa)
+
+
+def contexto_actual():
+    """Copia del contexto (traza y span en curso) para correr trabajo en otro hilo: contexto.run(fn, ...)."""
+    return contextvars.copy_context()
+
+
+# === Instrumentación de clientes ===
+def instrumentar_supabase(cliente):
+    """Mide cada petición a PostgREST envolviendo el send() de su sesión httpx."""
+    sesion = cliente.postgrest.session
+    if getattr(sesion, "_trazas_instrumentada", False):
+        return cliente
+    enviar_original = sesion.send
+
+    def send(request, *args, **kwargs):
+        ruta = request.url.path.split("/rest/v1/", 1)[-1]
+        operacion = f"rpc {ruta[4:]}" if ruta.startswith("rpc/") else f"{request.method} {ruta}"
+        with dependencia("supabase", operacion) as nuevo:
+            respuesta = enviar_original(request, *args, **kwargs)
+            nuevo.atributos["status"] = respuesta.status_code
+            if respuesta.status_code >= 400:
+                dependencia_errores.sumar(1, "supabase", operacion)
+            return respuesta
+
+    sesion.send = send
+    sesion._trazas_instrumentada = True
+    return cliente
+
+
+def instrumentar_openai(cliente):
+    """Mide chat.completions.create y embeddings.create, con modelo y tokens usados."""
+    def envolver(recurso, operacion):
+        original = recurso.create
+        if getattr(original, "_trazas_instrumentada", False):
+            return
+
+        @wraps(original)
+        def create(*args, **kwargs):
+            modelo = kwargs.get("model", "desconocido")
+            with dependencia("openai", f"{operacion} {modelo}", modelo=modelo) as nuevo:
+                respuesta = original(*args, **kwargs)
+                uso = getattr(respuesta, "usage", None)
+                if uso is not None:
+                    entrada = getattr(uso, "prompt_tokens", 0) or 0
+                    salida = getattr(uso, "completion_tokens", 0) or 0
+                    nuevo.atributos.update(prompt_tokens=entrada, completion_tokens=salida)
+                    openai_tokens.sumar(entrada, modelo, "prompt")
+                    if salida:
+                        openai_tokens.sumar(salida, modelo, "completion")
+                return respuesta
+
+        create._trazas_instrumentada = True
+        recurso.create = create
+
+    envolver(cliente.chat.completions, "chat")
+    envolver(cliente.embeddings, "embeddings")
+    return cliente
+
+
+# 🐢 Al apagar, las trazas más lentas quedan en TRAZAS_ARCHIVO (si está definido)
+atexit.register(volcar_trazas_lentas)
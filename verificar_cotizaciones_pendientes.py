@@ -1,21 +1,7 @@
-import os
 import logging
 from datetime import datetime, timedelta, timezone
-from dotenv import load_dotenv
-from supabase import create_client
-from twilio.rest import Client as TwilioClient
-
-load_dotenv()
-
-# 🔐 Configuración
-SUPABASE_URL = os.getenv("SUPABASE_URL")
-SUPABASE_KEY = os.getenv("SUPABASE_SERVICE_ROLE_KEY")
-supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
-
-TWILIO_SID = os.getenv("TWILIO_ACCOUNT_SID")
-TWILIO_AUTH = os.getenv("TWILIO_AUTH_TOKEN")
-TWILIO_WHATSAPP_NUMBER = os.getenv("TWILIO_WHATSAPP_NUMBER")
-twilio_client = TwilioClient(TWILIO_SID, TWILIO_AUTH)
+from servicios import supabase
+from mensajeria import mensajeria
 
 # 📩 Mensaje de seguimiento
 MENSAJE_RECORDATORIO = (
@@ -24,15 +10,14 @@ MENSAJE_RECORDATORIO = (
 )
 
 def enviar_whatsapp(to: str, mensaje: str):
+    # mensajeria agrega el prefijo "whatsapp:" una sola vez (antes quedaba duplicado en el remitente)
     try:
-        message = twilio_client.messages.create(
-            body=mensaje,
-            from_=f"whatsapp:{TWILIO_WHATSAPP_NUMBER}",
-            to=f"whatsapp:{to}"
-        )
+        mensajeria.enviar(to, mensaje).result()
         logging.info(f"📨 Recordatorio enviado a {to}")
+        return True
     except Exception as e:
         logging.error(f"❌ Error al enviar WhatsApp a {to}: {e}")
+        return False
 
 def verificar_cotizaciones_pendientes():
     try:
@@ -51,7 +36,8 @@ def verificar_cotizaciones_pendientes():
 
         for row in pendientes:
             user_id = row["user_id"]
-            enviar_whatsapp(user_id, MENSAJE_RECORDATORIO)
+            if not enviar_whatsapp(user_id, MENSAJE_RECORDATORIO):
+                continue
 
             # Opcional: marcar que ya se envió un recordatorio para no repetirlo
             supabase.from_("conversation_history").update({
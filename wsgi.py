@@ -0,0 +1,8 @@
+# 🚀 Punto de entrada WSGI para gunicorn: `gunicorn wsgi:app`
+# Cada worker crea su app, arranca sus hilos de fondo y se calienta antes de que /health diga 200.
+from bot import crear_app, iniciar_servicios_en_segundo_plano, pasos_calentamiento
+from arranque import calentar_en_segundo_plano
+
+app = crear_app()
+iniciar_servicios_en_segundo_plano()
+calentar_en_segundo_plano(pasos_calentamiento())